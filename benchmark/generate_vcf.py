@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+
+## number of variants for the predefined benchmark scales
+BENCHMARK_SCALES = {'1k': 1000, '100k': 100000, '1M': 1000000, '5M': 5000000}
+
+CHROMOSOME_LENGTHS = {
+    'grch38': [('1', 248956422), ('2', 242193529), ('3', 198295559), ('4', 190214555), ('5', 181538259), ('6', 170805979),
+               ('7', 159345973), ('8', 145138636), ('9', 138394717), ('10', 133797422), ('11', 135086622), ('12', 133275309),
+               ('13', 114364328), ('14', 107043718), ('15', 101991189), ('16', 90338345), ('17', 83257441), ('18', 80373285),
+               ('19', 58617616), ('20', 64444167), ('21', 46709983), ('22', 50818468), ('X', 156040895), ('Y', 57227415)],
+    'grch37': [('1', 249250621), ('2', 243199373), ('3', 198022430), ('4', 191154276), ('5', 180915260), ('6', 171115067),
+               ('7', 159138663), ('8', 146364022), ('9', 141213431), ('10', 135534747), ('11', 135006516), ('12', 133851895),
+               ('13', 115169878), ('14', 107349540), ('15', 102531392), ('16', 90354753), ('17', 81195210), ('18', 78077248),
+               ('19', 59128983), ('20', 63025520), ('21', 48129895), ('22', 51304566), ('X', 155270560), ('Y', 59373566)]
+}
+
+BASES = ['A', 'C', 'G', 'T']
+
+## VEP CSQ fields as produced by the gvanno VEP configuration (--vcf, LoF and NearestExonJB plugins)
+VEP_CSQ_FIELDS = ['Allele', 'Consequence', 'IMPACT', 'SYMBOL', 'Gene', 'Feature_type', 'Feature', 'BIOTYPE', 'EXON', 'INTRON',
+                  'HGVSc', 'HGVSp', 'cDNA_position', 'CDS_position', 'Protein_position', 'Amino_acids', 'Codons',
+                  'Existing_variation', 'ALLELE_NUM', 'DISTANCE', 'STRAND', 'FLAGS', 'PICK', 'VARIANT_CLASS', 'SYMBOL_SOURCE',
+                  'HGNC_ID', 'CANONICAL', 'MANE_SELECT', 'MANE_PLUS_CLINICAL', 'TSL', 'APPRIS', 'CCDS', 'ENSP', 'SWISSPROT',
+                  'TREMBL', 'UNIPARC', 'UNIPROT_ISOFORM', 'RefSeq', 'DOMAINS', 'HGVS_OFFSET', 'gnomADe_AF', 'gnomADe_AFR_AF',
+                  'gnomADe_AMR_AF', 'gnomADe_ASJ_AF', 'gnomADe_EAS_AF', 'gnomADe_FIN_AF', 'gnomADe_NFE_AF', 'gnomADe_OTH_AF',
+                  'gnomADe_SAS_AF', 'CLIN_SIG', 'SOMATIC', 'PHENO', 'CHECK_REF', 'NearestExonJB', 'LoF', 'LoF_filter',
+                  'LoF_flags', 'LoF_info']
+
+## dbNSFP prediction algorithms (as in the DBNSFP tag of the gvanno vcfanno configuration)
+DBNSFP_ALGORITHMS = ['SIFT_pred', 'PROVEAN_pred', 'MutationTaster_pred', 'MutationAssessor_pred', 'FATHMM_pred', 'FATHMM_MKL_coding_pred',
+                     'MetaRNN_pred', 'M_CAP_pred', 'MutPred_score', 'DEOGEN2_pred', 'PrimateAI_pred', 'LIST_S2_pred', 'GERP_RS_score',
+                     'Aloft_pred', 'BayesDel_addAF_pred', 'splice_site_ada_pred', 'splice_site_rf_pred']
+
+CODING_CONSEQUENCES = ['missense_variant', 'synonymous_variant', 'stop_gained', 'frameshift_variant', 'inframe_deletion',
+                       'splice_donor_variant', 'splice_region_variant&intron_variant']
+NONCODING_CONSEQUENCES = ['intron_variant', 'upstream_gene_variant', 'downstream_gene_variant', '3_prime_UTR_variant',
+                          '5_prime_UTR_variant', 'non_coding_transcript_exon_variant']
+AMINO_ACIDS = ['Ala', 'Arg', 'Asn', 'Asp', 'Cys', 'Gln', 'Glu', 'Gly', 'His', 'Ile', 'Leu', 'Lys', 'Met', 'Phe', 'Pro', 'Ser',
+               'Thr', 'Trp', 'Tyr', 'Val']
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Generate a synthetic (sorted) VCF file for benchmarking of the gvanno workflow')
+    parser.add_argument('output_vcf', help='Output VCF file (.vcf or .vcf.gz - the latter is bgzipped and indexed)')
+    parser.add_argument('--scale', choices=sorted(BENCHMARK_SCALES.keys()), default=None,
+                        help='Predefined number of variants (overrides --n_variants)')
+    parser.add_argument('--n_variants', type=int, default=1000, help='Number of variant records, default: %(default)s')
+    parser.add_argument('--genome_assembly', choices=['grch37', 'grch38'], default='grch38', help='Genome assembly, default: %(default)s')
+    parser.add_argument('--snv_fraction', type=float, default=0.87, help='Fraction of SNVs (the remainder are indels), default: %(default)s')
+    parser.add_argument('--multiallelic_fraction', type=float, default=0.02, help='Fraction of multi-allelic records, default: %(default)s')
+    parser.add_argument('--filtered_fraction', type=float, default=0.1, help='Fraction of records with a non-PASS FILTER, default: %(default)s')
+    parser.add_argument('--n_samples', type=int, default=1, help='Number of sample (genotype) columns, default: %(default)s')
+    parser.add_argument('--annotated', action='store_true', help='Write a pre-annotated fixture VCF (synthetic VEP CSQ and vcfanno DBNSFP ' + \
+                        'tags) for library-level benchmarks, i.e. without running VEP/vcfanno')
+    parser.add_argument('--fasta', default=None, help='Reference FASTA - set REF alleles from the reference genome (bcftools norm --check-ref s)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the random number generator, default: %(default)s')
+    args = parser.parse_args()
+
+    n_variants = BENCHMARK_SCALES[args.scale] if not args.scale is None else args.n_variants
+    generate_vcf(args.output_vcf, n_variants, args.genome_assembly, args.snv_fraction, args.multiallelic_fraction,
+                 args.filtered_fraction, args.n_samples, args.annotated, args.fasta, args.seed)
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice(BASES) for i in range(length))
+
+
+def random_alleles(rng, snv_fraction, multiallelic):
+    """
+    Function that draws REF/ALT alleles of a synthetic variant (SNV, insertion or deletion of 1-10 bp)
+    """
+    n_alt = 2 if multiallelic else 1
+    if rng.random() < snv_fraction:
+        ref = rng.choice(BASES)
+        alts = rng.sample([b for b in BASES if b != ref], n_alt)
+        return ref, alts
+    anchor = rng.choice(BASES)
+    if rng.random() < 0.5:
+        ## insertion
+        alts = []
+        while len(alts) < n_alt:
+            alt = anchor + random_sequence(rng, rng.randint(1, 10))
+            if not alt in alts:
+                alts.append(alt)
+        return anchor, alts
+    ## deletion (second allele of multi-allelic deletions is a shorter deletion)
+    ref = anchor + random_sequence(rng, rng.randint(n_alt, 10))
+    alts = [anchor] if n_alt == 1 else [anchor, ref[:-1]]
+    return ref, alts
+
+
+def random_genotype(rng, n_alt):
+    draw = rng.random()
+    if draw < 0.03:
+        return './.'
+    if n_alt > 1 and draw < 0.3:
+        return '1/2'
+    if draw < 0.65:
+        return '0/1'
+    if draw < 0.95:
+        return '1/1'
+    return '0/0'
+
+
+def synthetic_csq(rng, alts, variant_class, gene_pool):
+    """
+    Function that composes a synthetic VEP CSQ tag (1-6 transcript blocks per allele, one PICK'ed block per allele)
+    """
+    csq_blocks = []
+    gene_idx = rng.randrange(len(gene_pool))
+    for allele_num, alt in enumerate(alts, start=1):
+        n_transcripts = rng.randint(1, 6)
+        coding = rng.random() < 0.3
+        for t in range(n_transcripts):
+            symbol, gene_id = gene_pool[gene_idx]
+            values = dict.fromkeys(VEP_CSQ_FIELDS, '')
+            consequence = rng.choice(CODING_CONSEQUENCES) if coding else rng.choice(NONCODING_CONSEQUENCES)
+            transcript_id = f'ENST{gene_idx:06d}{t:05d}'
+            protein_pos = rng.randint(1, 1500)
+            ref_aa = rng.choice(AMINO_ACIDS)
+            alt_aa = rng.choice(AMINO_ACIDS)
+            values['Allele'] = alt if variant_class == 'SNV' else (alt[1:] or '-')
+            values['Consequence'] = consequence
+            values['IMPACT'] = 'MODERATE' if coding else 'MODIFIER'
+            values['SYMBOL'] = symbol
+            values['Gene'] = gene_id
+            values['Feature_type'] = 'Transcript'
+            values['Feature'] = transcript_id
+            values['BIOTYPE'] = 'protein_coding'
+            values['STRAND'] = rng.choice(['1', '-1'])
+            values['ALLELE_NUM'] = str(allele_num)
+            values['VARIANT_CLASS'] = variant_class
+            values['SYMBOL_SOURCE'] = 'HGNC'
+            values['TSL'] = str(rng.randint(1, 5))
+            values['APPRIS'] = rng.choice(['P1', 'A2', ''])
+            values['gnomADe_AF'] = f'{rng.random() * 0.01:.6f}' if rng.random() < 0.5 else ''
+            for population in ['AFR', 'AMR', 'ASJ', 'EAS', 'FIN', 'NFE', 'OTH', 'SAS']:
+                values[f'gnomADe_{population}_AF'] = values['gnomADe_AF']
+            if rng.random() < 0.3:
+                values['Existing_variation'] = f'rs{rng.randint(1, 900000000)}'
+            if t == 0:
+                values['PICK'] = '1'
+                values['CANONICAL'] = 'YES'
+                values['MANE_SELECT'] = f'NM_{gene_idx:06d}.1'
+            if coding:
+                values['EXON'] = f'{rng.randint(1, 20)}/20'
+                values['HGVSc'] = f'{transcript_id}.1:c.{protein_pos * 3}{rng.choice(BASES)}>{rng.choice(BASES)}'
+                values['HGVSp'] = f'ENSP{gene_idx:06d}{t:05d}.1:p.{ref_aa}{protein_pos}{alt_aa}'
+                ## positions/lengths as reported with VEP's --total_length option
+                values['Protein_position'] = f'{protein_pos}/1500'
+                values['CDS_position'] = f'{protein_pos * 3}/4503'
+                values['cDNA_position'] = f'{protein_pos * 3 + 100}/4800'
+                amino_acid = rng.choice('ACDEFGHIKLMNPQRSTVWY')
+                values['Amino_acids'] = amino_acid if consequence == 'synonymous_variant' else \
+                    f'{amino_acid}/{rng.choice("ACDEFGHIKLMNPQRSTVWY*")}'
+                values['ENSP'] = f'ENSP{gene_idx:06d}{t:05d}'
+                values['DOMAINS'] = f'Pfam:PF{rng.randint(1, 20000):05d}&Gene3D:3.40.50.300'
+                if consequence in ['stop_gained', 'frameshift_variant', 'splice_donor_variant']:
+                    values['LoF'] = 'HC'
+            else:
+                values['INTRON'] = f'{rng.randint(1, 19)}/19'
+            csq_blocks.append('|'.join(values[field] for field in VEP_CSQ_FIELDS))
+    return ','.join(csq_blocks), gene_pool[gene_idx][1]
+
+
+def synthetic_dbnsfp(rng, gene_id):
+    """
+    Function that composes a synthetic DBNSFP tag (vcfanno) of a missense variant
+    """
+    ref_aa = rng.choice('ACDEFGHIKLMNPQRSTVWY')
+    alt_aa = rng.choice('ACDEFGHIKLMNPQRSTVWY')
+    predictions = [rng.choice(['D', 'T', 'N', 'P', '.']) for algorithm in DBNSFP_ALGORITHMS]
+    return f'{ref_aa}|{alt_aa}|uc001aaa.1|{gene_id}|ENST0|{rng.randint(1, 1500)}|' + '|'.join(predictions)
+
+
+def generate_vcf(output_vcf, n_variants, genome_assembly, snv_fraction, multiallelic_fraction, filtered_fraction,
+                 n_samples, annotated, fasta, seed):
+    """
+    Function that writes a sorted, synthetic VCF file with 'n_variants' records distributed over all chromosomes
+    (proportional to chromosome length), with a mix of SNVs/indels, multi-allelic records, non-PASS records and
+    genotypes for 'n_samples' samples
+    """
+    rng = random.Random(seed)
+    chromosomes = CHROMOSOME_LENGTHS[genome_assembly]
+    genome_length = sum([length for chrom, length in chromosomes])
+    gene_pool = [(f'GENE{i}', f'ENSG{i:011d}') for i in range(20000)]
+    sample_ids = [f'SAMPLE{i + 1}' for i in range(n_samples)]
+
+    out_vcf = output_vcf[:-3] if output_vcf.endswith('.gz') else output_vcf
+    with open(out_vcf, 'w') as out:
+        out.write('##fileformat=VCFv4.2\n')
+        out.write('##source=gvanno_benchmark_generate_vcf\n')
+        for chrom, length in chromosomes:
+            out.write(f'##contig=<ID={chrom},length={length},assembly={genome_assembly}>\n')
+        out.write('##FILTER=<ID=PASS,Description="All filters passed">\n')
+        out.write('##FILTER=<ID=LowQual,Description="Low quality">\n')
+        out.write('##INFO=<ID=DP,Number=1,Type=Integer,Description="Total depth">\n')
+        if annotated:
+            out.write('##VEP="v110" cache="synthetic"\n')
+            out.write('##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP. Format: ' + \
+                      '|'.join(VEP_CSQ_FIELDS) + '">\n')
+            out.write('##INFO=<ID=DBNSFP,Number=.,Type=String,Description="Format: ref_aa|alt_aa|ucsc_id|ensembl_gene_id|' + \
+                      'ensembl_transcript_id|aa_pos|' + '|'.join(DBNSFP_ALGORITHMS) + '">\n')
+        if n_samples > 0:
+            out.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+            out.write('##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">\n')
+            out.write('##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">\n')
+        columns = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
+        if n_samples > 0:
+            columns = columns + ['FORMAT'] + sample_ids
+        out.write('\t'.join(columns) + '\n')
+
+        n_written = 0
+        for i, (chrom, length) in enumerate(chromosomes):
+            n_chrom = round(n_variants * length / genome_length) if i < len(chromosomes) - 1 else n_variants - n_written
+            n_chrom = min(n_chrom, n_variants - n_written)
+            for pos in sorted(rng.sample(range(10000, length - 10000), n_chrom)):
+                ref, alts = random_alleles(rng, snv_fraction, rng.random() < multiallelic_fraction)
+                variant_class = 'SNV' if len(ref) == 1 and len(alts[0]) == 1 else ('insertion' if len(alts[0]) > len(ref) else 'deletion')
+                depth = rng.randint(10, 200)
+                info = f'DP={depth}'
+                if annotated:
+                    csq, gene_id = synthetic_csq(rng, alts, variant_class, gene_pool)
+                    info += f';CSQ={csq}'
+                    if variant_class == 'SNV' and 'missense_variant' in csq:
+                        info += f';DBNSFP={synthetic_dbnsfp(rng, gene_id)}'
+                fields = [chrom, str(pos), '.', ref, ','.join(alts), f'{rng.uniform(20, 5000):.1f}',
+                          'LowQual' if rng.random() < filtered_fraction else 'PASS', info]
+                if n_samples > 0:
+                    fields.append('GT:AD:DP')
+                    for sample_id in sample_ids:
+                        alt_depth = rng.randint(0, depth)
+                        allele_depths = [str(depth - alt_depth), str(alt_depth)] + ['0'] * (len(alts) - 1)
+                        fields.append(f'{random_genotype(rng, len(alts))}:{",".join(allele_depths)}:{depth}')
+                out.write('\t'.join(fields) + '\n')
+            n_written += n_chrom
+
+    if not fasta is None:
+        fixed_vcf = f'{out_vcf}.ref.vcf'
+        subprocess.check_call(f'bcftools norm --check-ref s -f {fasta} -o {fixed_vcf} {out_vcf} 2> /dev/null', shell=True)
+        os.replace(fixed_vcf, out_vcf)
+    if output_vcf.endswith('.gz'):
+        subprocess.check_call(f'bgzip -f {out_vcf}', shell=True)
+        subprocess.check_call(f'tabix -f -p vcf {output_vcf}', shell=True)
+    print(f'Wrote {n_written} synthetic variant records ({genome_assembly}, {n_samples} samples) to {output_vcf}', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    __main__()
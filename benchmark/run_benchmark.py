@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+GVANNO_SRC_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), 'src', 'gvanno')
+sys.path.insert(0, GVANNO_SRC_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from generate_vcf import BENCHMARK_SCALES, generate_vcf
+
+## hot paths of gvanno-summarise that are timed per call in the library benchmark
+LIBRARY_HOT_PATHS = ['parse_vep_csq', 'assign_cds_exon_intron_annotations', 'map_dbnsfp_predictions',
+                     'match_csq_mutation_hotspot', 'assign_oncogenicity_evidence']
+
+WORKFLOW_STEPS = ['validate', 'vep', 'vcfanno', 'summarise', 'annotate', 'vcf2tsv', 'finalize']
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Benchmark gvanno library hot paths (gvanno-summarise) on pre-annotated fixture VCFs, ' + \
+                                     'and the gvanno workflow steps on synthetic VCFs of increasing size, against recorded baselines')
+    subparsers = parser.add_subparsers(dest='mode')
+    subparsers.required = True
+
+    library_parser = subparsers.add_parser('library', help='Time the gvanno-summarise hot paths per call on a pre-annotated (CSQ/DBNSFP) VCF')
+    library_parser.add_argument('fixture_vcf', help='Pre-annotated VCF (e.g. from generate_vcf.py --annotated)')
+    library_parser.add_argument('gvanno_dir', help='gvanno base directory with accompanying data directory, e.g. /data')
+    library_parser.add_argument('--genome_assembly', default='grch38', choices=['grch37', 'grch38'], help='Genome assembly, default: %(default)s')
+    library_parser.add_argument('--vep_pick_order', default="mane_select,mane_plus_clinical,canonical,appris,biotype,ccds,rank,tsl,length",
+                                help='Comma-separated string of ordered transcript/variant properties for selection of primary variant consequence')
+    library_parser.add_argument('--repeat', default=1, type=int, help='Number of passes over the fixture VCF, default: %(default)s')
+
+    workflow_parser = subparsers.add_parser('workflow', help='Run the single-container gvanno workflow on synthetic VCFs and collect per-step metrics')
+    workflow_parser.add_argument('gvanno_dir', help='gvanno base directory with accompanying data directory, e.g. /data')
+    workflow_parser.add_argument('vep_cache_dir', help='Directory with VEP cache files')
+    workflow_parser.add_argument('work_dir', help='Directory for synthetic VCFs and workflow output')
+    workflow_parser.add_argument('--genome_assembly', default='grch38', choices=['grch37', 'grch38'], help='Genome assembly, default: %(default)s')
+    workflow_parser.add_argument('--scales', default='1k,100k', help='Comma-separated list of benchmark scales (' + \
+                                 ', '.join(BENCHMARK_SCALES.keys()) + '), default: %(default)s')
+    workflow_parser.add_argument('--n_samples', default=1, type=int, help='Number of sample (genotype) columns, default: %(default)s')
+    workflow_parser.add_argument('--workflow_options', default='', help='Additional options for gvanno_workflow.py, e.g. "--streaming --n_shards 4"')
+
+    for p in [library_parser, workflow_parser]:
+        p.add_argument('--baseline', default=os.path.join(BENCHMARK_DIR, 'baselines.json'), help='JSON file with baseline timings, default: %(default)s')
+        p.add_argument('--record_baseline', action='store_true', help='Record the timings of this run as the new baseline')
+        p.add_argument('--tolerance', default=0.2, type=float, help='Relative slowdown versus the baseline that is reported as a regression, default: %(default)s')
+        p.add_argument('--fail_on_regression', action='store_true', help='Exit with a non-zero status if any timing regressed')
+        p.add_argument('--output_json', default=None, help='Write the timings of this run to a JSON file')
+    args = parser.parse_args()
+
+    if args.mode == 'library':
+        key = f'library:{os.path.basename(args.fixture_vcf)}'
+        results = run_library_benchmark(args.fixture_vcf, args.gvanno_dir, args.genome_assembly, args.vep_pick_order, args.repeat)
+    else:
+        key = f'workflow:{args.workflow_options}'.rstrip(':')
+        results = run_workflow_benchmark(args.gvanno_dir, args.vep_cache_dir, args.work_dir, args.genome_assembly,
+                                         args.scales.split(','), args.n_samples, args.workflow_options)
+
+    if not args.output_json is None:
+        with open(args.output_json, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baselines = json.load(f)
+    num_regressions = compare_to_baseline(results, baselines.get(key, {}), args.tolerance)
+
+    if args.record_baseline:
+        baselines[key] = results
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent = 2, sort_keys = True)
+        print(f'Recorded baseline \'{key}\' in {args.baseline}')
+
+    if num_regressions > 0 and args.fail_on_regression:
+        sys.exit(1)
+
+
+def run_library_benchmark(fixture_vcf, gvanno_dir, genome_assembly, vep_pick_order, repeat):
+    """
+    Function that times the hot paths of gvanno-summarise (CSQ parsing, CDS/exon/intron annotation, dbNSFP prediction
+    mapping, hotspot matching, oncogenicity classification) per call on a pre-annotated VCF, plus the full
+    extend_vcf_annotations() procedure. Returns the timings as {name: {'calls', 'total_sec', 'usec_per_call'}}
+    """
+    import cyvcf2
+    from lib.gvanno.utils import getlogger
+    from lib.gvanno.annoutils import read_infotag_file, read_genexref_namemap, make_transcript_xref_map, assign_cds_exon_intron_annotations
+    from lib.gvanno.vep import parse_vep_csq
+    from lib.gvanno.dbnsfp import vep_dbnsfp_meta_header, map_dbnsfp_predictions, map_variant_effect_predictors
+    from lib.gvanno.mutation_hotspot import load_mutation_hotspots, match_csq_mutation_hotspot
+    from lib.gvanno.oncogenicity import assign_oncogenicity_evidence
+    from gvanno_summarise import extend_vcf_annotations
+
+    logger = getlogger('gvanno-benchmark')
+    ## synthetic transcripts are not found in the gene/transcript cross-references - keep the per-record warnings out of the timings
+    logger.setLevel(logging.ERROR)
+    gvanno_db_dir = os.path.join(gvanno_dir, 'data', genome_assembly)
+
+    vcf_info_metadata = read_infotag_file(os.path.join(gvanno_db_dir, 'vcf_infotags_gvanno.tsv'), scope = "gvanno")
+    vcf_info_metadata.update(read_infotag_file(os.path.join(gvanno_db_dir, 'vcf_infotags_vep.tsv'), scope = "vep"))
+    gene_transcript_xref_map = read_genexref_namemap(
+        os.path.join(gvanno_db_dir, 'gene', 'tsv', 'gene_transcript_xref', 'gene_transcript_xref_bedmap.tsv.gz'), logger)
+    cancer_hotspots = load_mutation_hotspots(os.path.join(gvanno_db_dir, 'misc', 'tsv', 'hotspot', 'hotspot.tsv.gz'), logger)
+
+    timings = {}
+    for name in LIBRARY_HOT_PATHS:
+        timings[name] = {'calls': 0, 'total_sec': 0.0}
+
+    def timed(name, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        timings[name]['total_sec'] += time.perf_counter() - start
+        timings[name]['calls'] += 1
+        return result
+
+    for i in range(repeat):
+        vcf = cyvcf2.VCF(fixture_vcf)
+        meta_vep_dbnsfp_info = vep_dbnsfp_meta_header(vcf, vcf_info_metadata)
+        for tag in sorted(vcf_info_metadata):
+            vcf.add_info_to_header({'ID': tag, 'Description': str(vcf_info_metadata[tag]['description']),
+                                    'Type': str(vcf_info_metadata[tag]['type']), 'Number': str(vcf_info_metadata[tag]['number'])})
+        vcf_info_element_types = {}
+        for e in vcf.header_iter():
+            header_element = e.info()
+            if 'ID' in header_element and 'HeaderType' in header_element and 'Type' in header_element:
+                vcf_info_element_types[str(header_element['ID'])] = str(header_element['Type'])
+
+        for rec in vcf:
+            if rec.INFO.get('CSQ') is None:
+                continue
+            transcript_xref_map = make_transcript_xref_map(rec, gene_transcript_xref_map, xref_tag = "GENE_TRANSCRIPT_XREF")
+            vep_csq_record_results = timed('parse_vep_csq', parse_vep_csq, rec, transcript_xref_map, meta_vep_dbnsfp_info['vep_csq_fieldmap'],
+                                           vep_pick_order, logger, pick_only = False, csq_identifier = 'CSQ')
+            for csq_record in vep_csq_record_results['picked_gene_csq']:
+                timed('assign_cds_exon_intron_annotations', assign_cds_exon_intron_annotations, dict(csq_record))
+
+            ## INFO tags of the picked consequence are set as in gvanno-summarise (not timed)
+            principal_csq_properties = {'hgvsp': '.', 'hgvsc': '.', 'entrezgene': '.', 'exon': '.', 'codon': '.', 'lof': '.'}
+            csq_record = vep_csq_record_results['picked_csq']
+            if not csq_record is None:
+                for k in csq_record:
+                    if not k in vcf_info_element_types or csq_record[k] is None:
+                        continue
+                    if vcf_info_element_types[k] == "Flag":
+                        if csq_record[k] == "1":
+                            rec.INFO[k] = True
+                        continue
+                    rec.INFO[k] = csq_record[k]
+                    if k == 'HGVSp_short':
+                        principal_csq_properties['hgvsp'] = csq_record[k]
+                        codon_match = re.findall(r'[A-Z][0-9]{1,}', csq_record[k])
+                        if re.match(r'^(p.[A-Z]{1}[0-9]{1,}[A-Za-z]{1,})', csq_record[k]) and len(codon_match) == 1:
+                            principal_csq_properties['codon'] = 'p.' + codon_match[0]
+                    if k == 'HGVSc':
+                        principal_csq_properties['hgvsc'] = csq_record[k].split(':')[1]
+                    if k == 'ENTREZGENE':
+                        principal_csq_properties['entrezgene'] = csq_record[k]
+                    if k == 'EXON' and '/' in csq_record[k]:
+                        principal_csq_properties['exon'] = csq_record[k].split('/')[0]
+
+            timed('match_csq_mutation_hotspot', match_csq_mutation_hotspot, vep_csq_record_results['all_csq'], cancer_hotspots,
+                  rec, principal_csq_properties)
+            if not rec.INFO.get('DBNSFP') is None:
+                timed('map_dbnsfp_predictions', map_dbnsfp_predictions, str(rec.INFO.get('DBNSFP')),
+                      meta_vep_dbnsfp_info['dbnsfp_prediction_algorithms'])
+                map_variant_effect_predictors(rec, meta_vep_dbnsfp_info['dbnsfp_prediction_algorithms'])
+            timed('assign_oncogenicity_evidence', assign_oncogenicity_evidence, rec, tumortype = "Any")
+        vcf.close()
+
+    ## end-to-end gvanno-summarise (per record)
+    timings['extend_vcf_annotations'] = {'calls': 0, 'total_sec': 0.0}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i in range(repeat):
+            summarise_args = {'vcf_file_in': fixture_vcf, 'vcf_file_out': os.path.join(tmp_dir, 'summarised.vcf'),
+                              'regulatory_annotation': 0, 'oncogenicity_annotation': 1, 'vep_pick_order': vep_pick_order,
+                              'gvanno_db_dir': gvanno_db_dir, 'compress_output_vcf': False, 'debug': False}
+            start = time.perf_counter()
+            counters = extend_vcf_annotations(summarise_args, logger)
+            timings['extend_vcf_annotations']['total_sec'] += time.perf_counter() - start
+            timings['extend_vcf_annotations']['calls'] += counters['records_in']
+
+    results = {}
+    for name in timings:
+        calls = timings[name]['calls']
+        results[name] = {'calls': calls, 'total_sec': round(timings[name]['total_sec'], 4),
+                         'usec_per_call': round(1e6 * timings[name]['total_sec'] / calls, 2) if calls > 0 else None}
+    return results
+
+
+def run_workflow_benchmark(gvanno_dir, vep_cache_dir, work_dir, genome_assembly, scales, n_samples, workflow_options):
+    """
+    Function that generates a synthetic VCF for each benchmark scale, runs the single-container gvanno workflow
+    (gvanno_workflow.py) on it, and collects the wall time of each step from the metrics file of the run
+    """
+    results = {}
+    for scale in scales:
+        if not scale in BENCHMARK_SCALES:
+            sys.exit(f'ERROR: Unknown benchmark scale \'{scale}\' - choose from ' + ', '.join(BENCHMARK_SCALES.keys()))
+        sample_id = f'BENCH_{scale}'
+        output_dir = os.path.join(work_dir, sample_id)
+        os.makedirs(output_dir, exist_ok = True)
+        input_vcf = os.path.join(work_dir, f'{sample_id}.vcf.gz')
+        if not os.path.exists(input_vcf):
+            generate_vcf(input_vcf, BENCHMARK_SCALES[scale], genome_assembly, n_samples = n_samples)
+
+        workflow_command = [sys.executable, os.path.join(GVANNO_SRC_DIR, 'gvanno_workflow.py'), gvanno_dir, vep_cache_dir,
+                            input_vcf, output_dir, genome_assembly, sample_id] + workflow_options.split()
+        print(f'Running gvanno workflow for scale {scale}: ' + ' '.join(workflow_command))
+        start = time.time()
+        subprocess.run(workflow_command, check = True)
+        wall_time = time.time() - start
+
+        with open(os.path.join(output_dir, f'{sample_id}_gvanno_metrics.json'), 'r') as f:
+            metrics = json.load(f)
+        results[scale] = {'total': {'wall_time_sec': round(wall_time, 3), 'records_per_sec': round(BENCHMARK_SCALES[scale] / wall_time, 1)}}
+        ## throughput in query variants per second (the metrics file has record counts only for steps with counters)
+        for step in WORKFLOW_STEPS:
+            if step in metrics['steps'] and not metrics['steps'][step].get('skipped', False):
+                step_wall_time = metrics['steps'][step]['wall_time_sec']
+                results[scale][step] = {'wall_time_sec': step_wall_time,
+                                        'records_per_sec': round(BENCHMARK_SCALES[scale] / step_wall_time, 1) if step_wall_time > 0 else None}
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Function that prints the timings of a benchmark run next to the baseline timings (time per call for library
+    hot paths, wall time for workflow steps), and returns the number of timings that regressed beyond 'tolerance'
+    """
+    rows = []
+    for name in results:
+        if 'usec_per_call' in results[name]:
+            rows.append((name, results[name]['usec_per_call'], baseline.get(name, {}).get('usec_per_call'), 'usec/call'))
+        else:
+            for step in results[name]:
+                rows.append((f'{name}:{step}', results[name][step]['wall_time_sec'],
+                             baseline.get(name, {}).get(step, {}).get('wall_time_sec'), 'sec'))
+
+    num_regressions = 0
+    print(f'{"benchmark":<45} {"current":>12} {"baseline":>12} {"ratio":>8}  unit')
+    for name, current, reference, unit in rows:
+        if current is None:
+            continue
+        if reference is None or reference == 0:
+            print(f'{name:<45} {current:>12} {"-":>12} {"-":>8}  {unit}')
+            continue
+        ratio = current / reference
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            num_regressions += 1
+        elif ratio < 1 - tolerance:
+            flag = '  improved'
+        print(f'{name:<45} {current:>12} {reference:>12} {ratio:>8.2f}  {unit}{flag}')
+    if num_regressions > 0:
+        print(f'{num_regressions} timing(s) regressed by more than {int(100 * tolerance)}% versus the baseline')
+    return num_regressions
+
+
+if __name__ == "__main__":
+    __main__()
@@ -48,11 +48,50 @@ def __main__():
    optional_vep.add_argument('--vep_coding_only', action = "store_true", help="Only return consequences that fall in the coding regions of transcripts (VEP), default: %(default)s")
    optional.add_argument('--vcfanno_n_processes', default = 4, help="Number of processes for vcfanno " + \
       "processing (see https://github.com/brentp/vcfanno#-p), default: %(default)s")
+   optional.add_argument('--annotation_engine', choices = ['vcfanno', 'native'], default = 'vcfanno', help="Engine for annotation against " + \
+      "ClinVar/dbNSFP/GWAS/ncER/gene transcript tracks:\nvcfanno, or native (tabix-indexed merge-join, one process per track, can not be combined with --streaming), default: %(default)s")
+   optional.add_argument('--vcfanno_per_track', action = "store_true", help="Run a separate vcfanno process per annotation track " + \
+      "(--vcfanno_n_processes shared by track size),\nmerged onto the query records by ordinal (can not be combined with --streaming), default: %(default)s")
    optional.add_argument('--oncogenicity_annotation', action ='store_true', help = 'Classify variants according to oncogenicity (Horak et al., Genet Med, 2022)')
    optional.add_argument("--debug", action="store_true", help="Print full Docker/Singularity commands to log and do not delete intermediate files with warnings etc.")
    optional.add_argument("--sif_file", help="gvanno SIF file for usage of gvanno workflow with option '--container singularity'", default = None)
-
-   required.add_argument('--query_vcf', help='VCF input file with query variants (SNVs/InDels).', required = True)
+   optional.add_argument("--single_container", action="store_true", help="Run all workflow steps (validation, VEP, vcfanno, summarise, vcf2tsv, finalize) " + \
+      "within a single container launch, default: %(default)s")
+   optional.add_argument("--streaming", action="store_true", help="Connect VEP, vcfanno and summarise through pipes, i.e. without compressing/indexing " + \
+      "intermediate VCF files (requires --single_container), default: %(default)s")
+   optional.add_argument("--n_shards", default = 1, type = int, help="Split the query VCF into a number of genomic chunks (balanced by variant density) that are " + \
+      "annotated in parallel\n(VEP, vcfanno, summarise), each chunk uses --vep_n_forks/--vcfanno_n_processes (requires --single_container), default: %(default)s")
+   optional.add_argument("--resume", action="store_true", help="Keep intermediate files and record a manifest (checksums of inputs/outputs, options and " + \
+      "versions) for each workflow step,\nre-runs skip all steps with a matching manifest (requires --single_container), default: %(default)s")
+   optional.add_argument("--query_vcf_list", help="Batch mode (instead of --query_vcf): file with one query VCF per line ('<sample_id> <query_vcf>'), the union " + \
+      "of unique sites is annotated\nonly once and projected back onto each query VCF, --sample_id is used as the batch identifier (requires --single_container)", default = None)
+   optional.add_argument("--annotation_cache_dir", help="Directory with a persistent annotation cache (shared across runs), only variants that are not " + \
+      "present in the cache\nare annotated with VEP/vcfanno (requires --single_container), default: %(default)s", default = None)
+   optional.add_argument("--annotation_cache_max_entries", default = 5000000, type = int, help="Maximum number of variants in the annotation cache " + \
+      "(least recently used variants are evicted), default: %(default)s")
+   optional.add_argument("--vep_n_workers", default = 0, type = int, help="Number of warm VEP worker processes fed with batches of --vep_buffer_size " + \
+      "records,\ni.e. VEP loads its cache once per worker (0: a single VEP process, can not be combined with --streaming), default: %(default)s")
+   optional.add_argument("--vep_n_chunks", default = 1, type = int, help="Number of genomic chunks (balanced by variant count) that are annotated by " + \
+      "independent VEP processes\nin parallel, each with --vep_n_forks forks (can not be combined with --streaming or --vep_n_workers), default: %(default)s")
+   optional.add_argument("--vep_store_dir", help="Directory with a persistent VEP store (shared across runs), only variants that are not " + \
+      "present in the store\nare annotated with VEP (can not be combined with --streaming), default: %(default)s", default = None)
+   optional.add_argument("--vep_store_max_entries", default = 5000000, type = int, help="Maximum number of variants in the VEP store " + \
+      "(least recently used variants are evicted), default: %(default)s")
+   optional.add_argument("--sort_max_memory_mb", default = 768, type = int, help="Maximum memory (MB) for sorting the query VCF - query VCFs that are " + \
+      "already sorted are not re-sorted, default: %(default)s")
+   optional.add_argument("--target_bed", help="BED file with target regions (e.g. panel/exome), only query variants in target regions are " + \
+      "annotated, default: %(default)s", default = None)
+   optional.add_argument("--target_padding", default = 0, type = int, help="Padding (bp) added on each side of the target regions, default: %(default)s")
+   optional.add_argument("--keep_off_target", action="store_true", help="Pass off-target variants (--target_bed) through to the output VCF/TSV " + \
+      "without annotation,\ninstead of skipping them (requires --single_container), default: %(default)s")
+   optional.add_argument("--genotype_depth", action="store_true", help="Keep sample depth (DP) and allelic depths (AD) of the query VCF next to " + \
+      "genotypes (GT),\nappended to the TSV output as SAMPLE_DP/SAMPLE_AD, default: %(default)s")
+   optional.add_argument("--auto_tune", action="store_true", help="Pick --vep_n_forks, --vep_buffer_size and --vcfanno_n_processes from the CPUs/memory " + \
+      "available to the container\n(cgroup-aware) and the number of query variants, overrides these options (requires --single_container), default: %(default)s")
+   optional.add_argument("--metrics_record_counts", action="store_true", help="Count the records of all input/output files of each step for the " + \
+      "metrics file\n(extra passes over these files, requires --single_container), default: %(default)s")
+
+   required.add_argument('--query_vcf', help='VCF input file with query variants (SNVs/InDels).')
    required.add_argument('--gvanno_dir',help='Directory that contains the gvanno data bundle, e.g. ~/gvanno-' + str(GVANNO_VERSION), required = True)
    required.add_argument('--output_dir',help='Output directory', required = True)
    required.add_argument('--genome_assembly',choices = ['grch37','grch38'], help='Genome assembly build: grch37 or grch38', required = True)
@@ -86,6 +125,74 @@ def __main__():
       err_msg = "Option --oncogenicity_annotation requires --vep_lof_prediction turned on"
       gvanno_error_message(err_msg, logger)
 
+   if arg_dict['streaming'] is True and arg_dict['single_container'] is False:
+      err_msg = "Option --streaming requires --single_container turned on"
+      gvanno_error_message(err_msg, logger)
+
+   if arg_dict['n_shards'] < 1 or (arg_dict['n_shards'] > 1 and arg_dict['single_container'] is False):
+      err_msg = "Option --n_shards must be a positive number, and values above 1 require --single_container turned on"
+      gvanno_error_message(err_msg, logger)
+
+   if arg_dict['resume'] is True and arg_dict['single_container'] is False:
+      err_msg = "Option --resume requires --single_container turned on"
+      gvanno_error_message(err_msg, logger)
+
+   if not arg_dict['query_vcf_list'] is None and (arg_dict['single_container'] is False or arg_dict['resume'] is True):
+      err_msg = "Option --query_vcf_list requires --single_container turned on (and can not be combined with --resume)"
+      gvanno_error_message(err_msg, logger)
+
+   if not arg_dict['annotation_cache_dir'] is None and arg_dict['single_container'] is False:
+      err_msg = "Option --annotation_cache_dir requires --single_container turned on"
+      gvanno_error_message(err_msg, logger)
+
+   if not arg_dict['vep_store_dir'] is None and arg_dict['streaming'] is True:
+      err_msg = "Option --vep_store_dir can not be combined with --streaming"
+      gvanno_error_message(err_msg, logger)
+
+   if arg_dict['annotation_engine'] == 'native' and arg_dict['streaming'] is True:
+      err_msg = "Option --annotation_engine native can not be combined with --streaming"
+      gvanno_error_message(err_msg, logger)
+
+   if arg_dict['vcfanno_per_track'] is True and arg_dict['streaming'] is True:
+      err_msg = "Option --vcfanno_per_track can not be combined with --streaming"
+      gvanno_error_message(err_msg, logger)
+
+   if arg_dict['vep_n_workers'] < 0 or (arg_dict['vep_n_workers'] > 0 and arg_dict['streaming'] is True):
+      err_msg = "Option --vep_n_workers must be zero or a positive number (and can not be combined with --streaming)"
+      gvanno_error_message(err_msg, logger)
+
+   if arg_dict['vep_n_chunks'] < 1 or (arg_dict['vep_n_chunks'] > 1 and (arg_dict['streaming'] is True or arg_dict['vep_n_workers'] > 0)):
+      err_msg = "Option --vep_n_chunks must be a positive number (and can not be combined with --streaming or --vep_n_workers)"
+      gvanno_error_message(err_msg, logger)
+
+   if arg_dict['auto_tune'] is True and arg_dict['single_container'] is False:
+      err_msg = "Option --auto_tune requires --single_container turned on"
+      gvanno_error_message(err_msg, logger)
+
+   if arg_dict['metrics_record_counts'] is True and arg_dict['single_container'] is False:
+      err_msg = "Option --metrics_record_counts requires --single_container turned on"
+      gvanno_error_message(err_msg, logger)
+
+   if arg_dict['target_padding'] < 0:
+      err_msg = "Option --target_padding must be zero or a positive number"
+      gvanno_error_message(err_msg, logger)
+
+   if arg_dict['keep_off_target'] is True and (arg_dict['target_bed'] is None or arg_dict['single_container'] is False):
+      err_msg = "Option --keep_off_target requires --target_bed and --single_container"
+      gvanno_error_message(err_msg, logger)
+
+   if arg_dict['sort_max_memory_mb'] < 1:
+      err_msg = "Option --sort_max_memory_mb must be a positive number"
+      gvanno_error_message(err_msg, logger)
+
+   if arg_dict['annotation_cache_max_entries'] < 1:
+      err_msg = "Option --annotation_cache_max_entries must be a positive number"
+      gvanno_error_message(err_msg, logger)
+
+   if arg_dict['vep_store_max_entries'] < 1:
+      err_msg = "Option --vep_store_max_entries must be a positive number"
+      gvanno_error_message(err_msg, logger)
+
    logger = getlogger('gvanno-check-files')
 
    # check that script and Docker image version correspond
@@ -121,10 +228,13 @@ def verify_input_files(arg_dict, logger):
    input_vcf_basename = "NA"
    input_conf_basename = "NA"
    
-   ## check that query_vcf exist
-   if arg_dict['query_vcf'] is None:
+   ## check that query_vcf (or a batch of query VCFs) exist
+   if arg_dict['query_vcf'] is None and arg_dict['query_vcf_list'] is None:
       err_msg = "Please specifiy a VCF input file (--query_vcf)"
       gvanno_error_message(err_msg,logger)
+   if not arg_dict['query_vcf'] is None and not arg_dict['query_vcf_list'] is None:
+      err_msg = "Please specify either a single VCF input file (--query_vcf) or a batch of VCF input files (--query_vcf_list), not both"
+      gvanno_error_message(err_msg,logger)
    
    ## check the existence of given output folder
    output_dir_full = os.path.abspath(arg_dict['output_dir'])
@@ -205,8 +315,40 @@ def verify_input_files(arg_dict, logger):
          'latest software and data bundle (see https://github.com/sigven/gvanno for instructions)'
       gvanno_error_message(err_msg,logger)
    
+   annotation_cache_dir = 'NA'
+   if not arg_dict['annotation_cache_dir'] is None:
+      if not os.path.isdir(os.path.abspath(arg_dict['annotation_cache_dir'])):
+         err_msg = "Annotation cache directory (" + str(arg_dict['annotation_cache_dir']) + ") does not exist"
+         gvanno_error_message(err_msg,logger)
+      annotation_cache_dir = os.path.abspath(arg_dict['annotation_cache_dir'])
+
+   vep_store_dir = 'NA'
+   if not arg_dict['vep_store_dir'] is None:
+      if not os.path.isdir(os.path.abspath(arg_dict['vep_store_dir'])):
+         err_msg = "VEP store directory (" + str(arg_dict['vep_store_dir']) + ") does not exist"
+         gvanno_error_message(err_msg,logger)
+      vep_store_dir = os.path.abspath(arg_dict['vep_store_dir'])
+
+   target_bed_dir = 'NA'
+   target_bed_basename = 'NA'
+   if not arg_dict['target_bed'] is None:
+      if not os.path.exists(os.path.abspath(arg_dict['target_bed'])):
+         err_msg = "Target BED file (" + str(arg_dict['target_bed']) + ") does not exist"
+         gvanno_error_message(err_msg,logger)
+      target_bed_dir = os.path.dirname(os.path.abspath(arg_dict['target_bed']))
+      target_bed_basename = os.path.basename(arg_dict['target_bed'])
+
+   query_vcf_list_host = []
+   if not arg_dict['query_vcf_list'] is None:
+      query_vcf_list_host = verify_query_vcf_list(arg_dict, output_dir_full, logger)
+
    host_directories = {}
+   host_directories['query_vcf_list_host'] = query_vcf_list_host
    host_directories['input_vcf_dir_host'] = input_vcf_dir
+   host_directories['annotation_cache_dir_host'] = annotation_cache_dir
+   host_directories['vep_store_dir_host'] = vep_store_dir
+   host_directories['target_bed_dir_host'] = target_bed_dir
+   host_directories['target_bed_basename_host'] = target_bed_basename
    host_directories['db_dir_host'] = db_assembly_dir
    host_directories['base_dir_host'] = base_dir
    host_directories['output_dir_host'] = output_dir_full
@@ -215,6 +357,48 @@ def verify_input_files(arg_dict, logger):
    return host_directories
    
 
+def verify_query_vcf_list(arg_dict, output_dir_full, logger):
+   """
+   Function that checks the batch file with query VCFs ('<sample_id> <query_vcf>' per line), and the existence of each query VCF.
+   Returns a list of (sample_id, absolute path of query VCF)
+   """
+   if not os.path.exists(os.path.abspath(arg_dict['query_vcf_list'])):
+      err_msg = "Batch file with query VCFs (" + str(arg_dict['query_vcf_list']) + ") does not exist"
+      gvanno_error_message(err_msg,logger)
+
+   query_vcf_list = []
+   sample_ids = {}
+   list_dir = os.path.dirname(os.path.abspath(arg_dict['query_vcf_list']))
+   for line in open(os.path.abspath(arg_dict['query_vcf_list']), 'r'):
+      if line.strip() == '' or line.startswith('#'):
+         continue
+      fields = line.strip().split()
+      if len(fields) != 2 or fields[0] in sample_ids:
+         err_msg = "Batch file " + str(arg_dict['query_vcf_list']) + " should list one sample (unique identifier) per line: '<sample_id> <query_vcf>' - found '" + \
+            line.strip() + "'"
+         gvanno_error_message(err_msg,logger)
+      sample_ids[fields[0]] = 1
+      query_vcf = fields[1] if os.path.isabs(fields[1]) else os.path.join(list_dir, fields[1])
+      if not os.path.exists(query_vcf) or not (query_vcf.endswith('.vcf') or query_vcf.endswith('.vcf.gz')):
+         err_msg = "Input file (" + str(query_vcf) + ") does not exist or does not have the correct file extension (.vcf or .vcf.gz)"
+         gvanno_error_message(err_msg,logger)
+      if query_vcf.endswith('.vcf.gz') and not os.path.exists(query_vcf + '.tbi'):
+         err_msg = "Tabix file (i.e. '.gz.tbi') is not present for the bgzipped VCF input file (" + str(query_vcf) + \
+            "). Please make sure your input VCF is properly compressed and indexed (bgzip + tabix)"
+         gvanno_error_message(err_msg,logger)
+      output_vcf = os.path.join(str(output_dir_full),str(fields[0])) + '_gvanno_' + str(arg_dict['genome_assembly']) + '.vcf.gz'
+      if os.path.exists(output_vcf) and arg_dict['force_overwrite'] is False:
+         err_msg = "Output files (e.g. " + str(output_vcf) + ") already exist - please specify different sample identifiers or add option --force_overwrite"
+         gvanno_error_message(err_msg,logger)
+      query_vcf_list.append((fields[0], os.path.abspath(query_vcf)))
+
+   if len(query_vcf_list) == 0:
+      err_msg = "Batch file " + str(arg_dict['query_vcf_list']) + " does not list any query VCF files"
+      gvanno_error_message(err_msg,logger)
+
+   return query_vcf_list
+
+
 def check_subprocess(command):
    try:
       output = subprocess.check_output(str(command), stderr=subprocess.STDOUT, shell=True)
@@ -317,6 +501,41 @@ def run_gvanno(arg_dict, host_directories):
    elif host_directories['input_vcf_dir_host'] != 'NA' and arg_dict['container'] == 'singularity':
       container_command_run1 = container_command_run1  + " -B " + str(input_vcf_volume_mapping)
 
+   ## persistent annotation cache (SQLite)
+   annotation_cache_docker = 'None'
+   if host_directories['annotation_cache_dir_host'] != 'NA':
+      annotation_cache_docker = '/workdir/annotation_cache/gvanno_annotation_cache.sqlite'
+      mount_option = " -v=" if arg_dict['container'] == 'docker' else " -B "
+      container_command_run1 = container_command_run1 + mount_option + str(host_directories['annotation_cache_dir_host']) + ":/workdir/annotation_cache"
+
+   ## persistent VEP store (SQLite)
+   vep_store_docker = 'None'
+   if host_directories['vep_store_dir_host'] != 'NA':
+      vep_store_docker = '/workdir/vep_store/gvanno_vep_store.sqlite'
+      mount_option = " -v=" if arg_dict['container'] == 'docker' else " -B "
+      container_command_run1 = container_command_run1 + mount_option + str(host_directories['vep_store_dir_host']) + ":/workdir/vep_store"
+
+   ## target regions (BED)
+   target_bed_docker = 'None'
+   if host_directories['target_bed_dir_host'] != 'NA':
+      target_bed_docker = '/workdir/target_bed/' + str(host_directories['target_bed_basename_host'])
+      mount_option = " -v=" if arg_dict['container'] == 'docker' else " -B "
+      container_command_run1 = container_command_run1 + mount_option + str(host_directories['target_bed_dir_host']) + ":/workdir/target_bed"
+
+   ## batch mode - mount each directory with query VCFs, and list the container paths of query VCFs in the output directory
+   query_vcf_list_docker = 'None'
+   if host_directories['query_vcf_list_host']:
+      query_vcf_dirs_host = []
+      query_vcf_list_docker = os.path.join(output_dir, f'{arg_dict["sample_id"]}.query_vcf_list.tsv')
+      with open(os.path.join(host_directories['output_dir_host'], f'{arg_dict["sample_id"]}.query_vcf_list.tsv'), 'w') as f:
+         for sample_id, query_vcf in host_directories['query_vcf_list_host']:
+            if not os.path.dirname(query_vcf) in query_vcf_dirs_host:
+               query_vcf_dirs_host.append(os.path.dirname(query_vcf))
+            f.write(f'{sample_id}\t/workdir/input_vcf_{query_vcf_dirs_host.index(os.path.dirname(query_vcf))}/{os.path.basename(query_vcf)}\n')
+      for i, query_vcf_dir in enumerate(query_vcf_dirs_host):
+         mount_option = " -v=" if arg_dict['container'] == 'docker' else " -B "
+         container_command_run1 = container_command_run1 + mount_option + str(query_vcf_dir) + ":/workdir/input_vcf_" + str(i)
+
    if arg_dict['container'] == 'docker':
       container_command_run1 = container_command_run1 + " -w=/workdir/output " + str(DOCKER_IMAGE_VERSION) + " sh -c \""
    elif arg_dict['container'] == 'singularity':
@@ -341,6 +560,60 @@ def run_gvanno(arg_dict, host_directories):
    logger.info("Sample name: " + str(arg_dict['sample_id']))
    logger.info("Genome assembly: " + str(arg_dict['genome_assembly']))
    
+   ## options of the single-container workflow (gvanno_workflow.py/gvanno_batch.py)
+   gvanno_workflow_options = (
+         f'--vep_pick_order {conf_options["conf"]["vep"]["vep_pick_order"]} '
+         f'--vep_buffer_size {int(conf_options["conf"]["vep"]["vep_buffer_size"])} '
+         f'--vep_n_forks {int(conf_options["conf"]["vep"]["vep_n_forks"])} '
+         f'{"--vep_regulatory " if conf_options["conf"]["vep"]["vep_regulatory"] else ""}'
+         f'{"--vep_gencode_basic " if conf_options["conf"]["vep"]["vep_gencode_basic"] else ""}'
+         f'{"--vep_lof_prediction " if conf_options["conf"]["vep"]["vep_lof_prediction"] else ""}'
+         f'{"--vep_no_intergenic " if conf_options["conf"]["vep"]["vep_no_intergenic"] else ""}'
+         f'{"--vep_coding_only " if conf_options["conf"]["vep"]["vep_coding_only"] else ""}'
+         f'--vcfanno_n_processes {int(arg_dict["vcfanno_n_processes"])} '
+         f'--annotation_engine {arg_dict["annotation_engine"]} '
+         f'{"--vcfanno_per_track " if arg_dict["vcfanno_per_track"] else ""}'
+         f'{"--oncogenicity_annotation " if arg_dict["oncogenicity_annotation"] else ""}'
+         f'{"--streaming " if arg_dict["streaming"] else ""}'
+         f'--n_shards {int(arg_dict["n_shards"])} '
+         f'{"--resume " if arg_dict["resume"] else ""}'
+         f'{"--annotation_cache " + annotation_cache_docker + " " if not annotation_cache_docker == "None" else ""}'
+         f'--annotation_cache_max_entries {int(arg_dict["annotation_cache_max_entries"])} '
+         f'--vep_n_workers {int(arg_dict["vep_n_workers"])} '
+         f'--vep_n_chunks {int(arg_dict["vep_n_chunks"])} '
+         f'{"--vep_store " + vep_store_docker + " " if not vep_store_docker == "None" else ""}'
+         f'--vep_store_max_entries {int(arg_dict["vep_store_max_entries"])} '
+         f'{"--auto_tune " if arg_dict["auto_tune"] else ""}'
+         f'{"--metrics_record_counts " if arg_dict["metrics_record_counts"] else ""}'
+         f'--sort_max_memory_mb {int(arg_dict["sort_max_memory_mb"])} '
+         f'{"--genotype_depth " if arg_dict["genotype_depth"] else ""}'
+         f'{"--target_bed " + target_bed_docker + " " if not target_bed_docker == "None" else ""}'
+         f'--target_padding {int(arg_dict["target_padding"])} '
+         f'{"--keep_off_target " if arg_dict["keep_off_target"] else ""}'
+         f'{"--debug " if debug else ""}'
+   )
+
+   ## gvanno|batch - annotate the union of sites in a batch of query VCFs once, within a single container
+   if not query_vcf_list_docker == 'None':
+      gvanno_batch_command = (
+         f'{container_command_run1}'
+         f'gvanno_batch.py '
+         f'{data_dir} '
+         f'{vep_dir} '
+         f'{query_vcf_list_docker} '
+         f'{output_dir} '
+         f'{conf_options["genome_assembly"]} '
+         f'{conf_options["sample_id"]} '
+         f'{gvanno_workflow_options}'
+         f'{docker_command_run_end}'
+      )
+      if debug:
+         logger.info(gvanno_batch_command)
+      check_subprocess(gvanno_batch_command)
+      if not debug:
+         os.remove(os.path.join(host_directories['output_dir_host'], f'{arg_dict["sample_id"]}.query_vcf_list.tsv'))
+      return
+
    if not input_vcf_docker == 'None':
       
       # Define temporary output file names
@@ -356,6 +629,26 @@ def run_gvanno(arg_dict, host_directories):
       output_vcf2tsv =         f'{prefix}.vcf2tsv.tsv'
       output_pass_vcf2tsv =    f'{prefix}.pass.vcf2tsv.tsv'
       output_pass_tsv =        f'{prefix}.pass.tsv.gz'      
+      genotype_store =         f'{prefix}.genotypes.npz'
+
+      ## gvanno|workflow - run all steps, file moves and clean-up within a single container
+      if arg_dict['single_container']:
+         gvanno_workflow_command = (
+            f'{container_command_run1}'
+            f'gvanno_workflow.py '
+            f'{data_dir} '
+            f'{vep_dir} '
+            f'{input_vcf_docker} '
+            f'{output_dir} '
+            f'{conf_options["genome_assembly"]} '
+            f'{conf_options["sample_id"]} '
+            f'{gvanno_workflow_options}'
+            f'{docker_command_run_end}'
+         )
+         if debug:
+            logger.info(gvanno_workflow_command)
+         check_subprocess(gvanno_workflow_command)
+         return
 
       # gvanno|validate_input - verify that VCF is of appropriate format
       logger = getlogger("gvanno-validate-input")
@@ -371,6 +664,11 @@ def run_gvanno(arg_dict, host_directories):
                 f'{conf_options["genome_assembly"]} '
                 f'{conf_options["sample_id"]} '                
                 f'--output_dir {output_dir} '
+                f'--sort_max_memory_mb {int(arg_dict["sort_max_memory_mb"])} '
+                f'--genotype_store {genotype_store} '
+                f'{"--genotype_depth " if arg_dict["genotype_depth"] else ""}'
+                f'{"--target_bed " + target_bed_docker + " " if not target_bed_docker == "None" else ""}'
+                f'--target_padding {int(arg_dict["target_padding"])} '
                 f'{"--debug " if debug else ""}'
                 f'{docker_command_run_end}'
                 )
@@ -393,6 +691,11 @@ def run_gvanno(arg_dict, host_directories):
                 f'{"--vep_gencode_basic" if conf_options["conf"]["vep"]["vep_gencode_basic"] else ""} '
                 f'{"--vep_lof_prediction" if conf_options["conf"]["vep"]["vep_lof_prediction"] else ""} '
                 f'{"--vep_no_intergenic" if conf_options["conf"]["vep"]["vep_no_intergenic"] else ""} '
+                f'--vep_n_workers {int(arg_dict["vep_n_workers"])} '
+                f'--vep_n_chunks {int(arg_dict["vep_n_chunks"])} '
+                f'--vep_infotags_tsv {os.path.join(data_dir, "data", str(arg_dict["genome_assembly"]), "vcf_infotags_vep.tsv")} '
+                f'{"--vep_store " + vep_store_docker + " " if not vep_store_docker == "None" else ""}'
+                f'--vep_store_max_entries {int(arg_dict["vep_store_max_entries"])} '
                 f'{"--debug " if debug else ""}'
                 f'{docker_command_run_end}'
          )
@@ -404,7 +707,7 @@ def run_gvanno(arg_dict, host_directories):
       logger.info("STEP 2: Clinical/functional variant annotations with gvanno-vcfanno (Clinvar, ncER, dbNSFP, GWAS catalog)")
       logger.info('vcfanno configuration - number of processes (-p): ' + str(arg_dict['vcfanno_n_processes']))
       gvanno_vcfanno_command = str(container_command_run2) + "gvanno_vcfanno.py --num_processes "  + str(arg_dict['vcfanno_n_processes']) + \
-         " --dbnsfp --gene_transcript_xref --clinvar --ncer --gwas " + str(vep_vcf) + ".gz " + str(vep_vcfanno_vcf) + \
+         " --annotation_engine " + str(arg_dict['annotation_engine']) + (" --vcfanno_per_track" if arg_dict['vcfanno_per_track'] else "") + " --dbnsfp --gene_transcript_xref --clinvar --ncer --gwas " + str(vep_vcf) + ".gz " + str(vep_vcfanno_vcf) + \
          " " + os.path.join(data_dir, "data", str(arg_dict['genome_assembly'])) + docker_command_run_end
       
       if arg_dict['debug']:
@@ -451,15 +754,12 @@ def run_gvanno(arg_dict, host_directories):
          check_subprocess(clean_command)
       
       print("----")
-      ## gvanno|vcf2tsv - convert VCF to TSV with https://github.com/sigven/vcf2tsv
+      ## gvanno|vcf2tsv - convert VCF to TSV (PASS and non-PASS variants, PASS variants only) in a single pass
       logger = getlogger("gvanno-vcf2tsv")
-      logger.info("STEP 4: Converting genomic VCF to TSV with https://github.com/sigven/vcf2tsvpy")
-      gvanno_vcf2tsv_command_pass = str(container_command_run2) + "vcf2tsvpy --input_vcf " + str(output_pass_vcf) + " --compress --out_tsv " + str(output_vcf2tsv) + docker_command_run_end
-      gvanno_vcf2tsv_command_all = str(container_command_run2) + "vcf2tsvpy --input_vcf " + str(output_vcf) + " --compress --keep_rejected --out_tsv " + str(output_pass_vcf2tsv) + docker_command_run_end
-      logger.info("Conversion of VCF variant data to records of tab-separated values - PASS variants only")
-      check_subprocess(gvanno_vcf2tsv_command_pass)
-      logger.info("Conversion of VCF variant data to records of tab-separated values - PASS and non-PASS variants")
-      check_subprocess(gvanno_vcf2tsv_command_all)
+      logger.info("STEP 4: Converting genomic VCF to TSV - PASS and non-PASS variants, and PASS variants only")
+      gvanno_vcf2tsv_command = str(container_command_run2) + "gvanno_vcf2tsv.py " + str(output_vcf) + " " + str(output_pass_vcf2tsv) + ".gz " + \
+         str(output_vcf2tsv) + ".gz" + docker_command_run_end
+      check_subprocess(gvanno_vcf2tsv_command)
       logger.info("Finished")
 
       print("----")
@@ -473,14 +773,15 @@ def run_gvanno(arg_dict, host_directories):
          f'{output_pass_vcf2tsv}.gz ' 
          f'{output_pass_tsv} '
          f'{arg_dict["genome_assembly"]} '
-         f'{arg_dict["sample_id"]}'         
+         f'{arg_dict["sample_id"]} '
+         f'--genotype_store {genotype_store}'
          f'{docker_command_run_end}'
       )
       check_subprocess(gvanno_append_tsv_command)
       logger.info("Finished")
       if not debug:
          clean_command2 = str(container_command_run2) + 'rm -f ' + str(output_pass_vcf2tsv) + '* ' + \
-            str(output_vcf2tsv) + "* "  + docker_command_run_end
+            str(output_vcf2tsv) + "* " + str(genotype_store) + " " + docker_command_run_end
          check_subprocess(clean_command2)
       
       
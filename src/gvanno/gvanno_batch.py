@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import argparse
+import copy
+import sys
+
+from lib.gvanno.utils import getlogger, check_subprocess
+from lib.gvanno.annoutils import write_pass_vcf
+from lib.gvanno.batch import read_query_vcf_list, write_union_sites, project_site_annotations
+from lib.gvanno.metrics import get_resource_usage, init_metrics, count_records
+from lib.gvanno.tuning import auto_tune_resources
+from gvanno_validate_input import validate_gvanno_input
+from gvanno_workflow import add_workflow_arguments, get_workflow_files, get_conf_options, get_vcfanno_tracks, get_summarise_args, \
+    run_annotation, run_sharded_annotation, run_cached_annotation, move_summarised_output, run_output_conversion, remove_files, \
+    record_metrics
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Run the gvanno workflow for a batch of query VCF files, annotating the union of ' + \
+                                     'unique sites (VEP, vcfanno, summarise) only once')
+    parser.add_argument('gvanno_dir', help='Docker location of gvanno base directory with accompanying data directory, e.g. /data')
+    parser.add_argument('vep_cache_dir', help='Directory with VEP cache files')
+    parser.add_argument('query_vcf_list', help="File with one query VCF per line, i.e. '<sample_id> <query_vcf>'")
+    parser.add_argument('output_dir', help='Output directory')
+    parser.add_argument('genome_assembly', help='Genome assembly (grch37/grch38)')
+    parser.add_argument('sample_id', help='Batch identifier - prefix for batch-level (union of sites) files')
+    add_workflow_arguments(parser)
+    args = parser.parse_args()
+
+    arg_dict = vars(args)
+    run_gvanno_batch(arg_dict)
+
+
+def run_gvanno_batch(arg_dict):
+    """
+    Function that runs the gvanno workflow for a batch of query VCF files:
+    1. Each query VCF is validated
+    2. The union of unique CHROM/POS/REF/ALT sites across all query VCFs is annotated once (VEP, vcfanno, summarise)
+    3. Site annotations are projected back onto the records of each query VCF, and the usual per-sample
+       output files (VCF, TSV) are produced
+
+    Metrics of batch-level steps are written to '<batch_id>_gvanno_metrics.json', metrics of per-sample
+    steps to '<sample_id>_gvanno_metrics.json'
+    """
+    debug = arg_dict['debug']
+    logger = getlogger("gvanno-batch")
+    samples = read_query_vcf_list(arg_dict['query_vcf_list'], logger)
+    logger.info(f"Annotating a batch of {len(samples)} query VCF files")
+
+    ## checkpoints are not used in batch mode
+    arg_dict['resume'] = False
+    fused_annotation = arg_dict['streaming'] or arg_dict['n_shards'] > 1 or not arg_dict['annotation_cache'] is None
+    metrics_files = get_workflow_files(arg_dict['output_dir'], arg_dict['sample_id'], arg_dict['genome_assembly'])
+    init_metrics(metrics_files['metrics'], arg_dict['sample_id'], arg_dict['genome_assembly'])
+
+    ## gvanno|validate_input - verify that each query VCF is of appropriate format
+    sample_files = {}
+    for sample_id, query_vcf in samples:
+        sample_files[sample_id] = get_workflow_files(arg_dict['output_dir'], sample_id, arg_dict['genome_assembly'])
+        init_metrics(sample_files[sample_id]['metrics'], sample_id, arg_dict['genome_assembly'])
+        start_usage = get_resource_usage(arg_dict['metrics_record_counts'])
+        logger = getlogger("gvanno-validate-input")
+        print('')
+        logger.info(f"gvanno - STEP 0: Validate input data and options - {sample_id}")
+        ret = validate_gvanno_input(arg_dict['gvanno_dir'], query_vcf, sample_files[sample_id]['input_vcf_validated'],
+                                    sample_id, arg_dict['genome_assembly'], arg_dict['output_dir'], debug,
+                                    sort_max_memory_mb = arg_dict['sort_max_memory_mb'], genotype_store = sample_files[sample_id]['genotype_store'],
+                                    genotype_depth = arg_dict['genotype_depth'], target_bed = arg_dict['target_bed'],
+                                    target_padding = arg_dict['target_padding'],
+                                    off_target_vcf = sample_files[sample_id]['off_target_vcf'] if arg_dict['keep_off_target'] else None)
+        if ret != 0:
+            sys.exit(-1)
+        logger.info('Finished gvanno-validate-input')
+        record_metrics(sample_files[sample_id], 'validate', start_usage, [query_vcf], [f'{sample_files[sample_id]["input_vcf_validated"]}.gz'])
+
+    ## gvanno|batch - union of unique sites across all query VCFs
+    print('----')
+    logger = getlogger("gvanno-batch")
+    logger.info("Collecting unique sites (CHROM/POS/REF/ALT) across all query VCF files")
+    batch_arg_dict = copy.deepcopy(arg_dict)
+    batch_arg_dict['sample_id'] = f'{arg_dict["sample_id"]}.union'
+    batch_files = get_workflow_files(arg_dict['output_dir'], batch_arg_dict['sample_id'], arg_dict['genome_assembly'])
+    batch_files['metrics'] = metrics_files['metrics']
+    start_usage = get_resource_usage(arg_dict['metrics_record_counts'])
+    write_union_sites([f'{sample_files[sample_id]["input_vcf_validated"]}.gz' for sample_id, query_vcf in samples],
+                      batch_files['input_vcf_validated'], logger)
+    if not fused_annotation:
+        check_subprocess(logger, f'bgzip -f {batch_files["input_vcf_validated"]}', debug)
+        check_subprocess(logger, f'tabix -f -p vcf {batch_files["input_vcf_validated"]}.gz', debug)
+    union_vcf = batch_files['input_vcf_validated'] if fused_annotation else f'{batch_files["input_vcf_validated"]}.gz'
+    record_metrics(batch_files, 'union', start_usage, [f'{sample_files[sample_id]["input_vcf_validated"]}.gz' for sample_id, query_vcf in samples],
+                   [union_vcf])
+
+    ## gvanno|vep, gvanno|vcfanno, gvanno|summarise - annotate the union of sites once
+    if arg_dict['auto_tune']:
+        batch_arg_dict.update(auto_tune_resources(count_records(union_vcf), arg_dict['n_shards'], arg_dict['vep_n_chunks'], arg_dict['vep_n_workers'],
+                                                  arg_dict['streaming'], getlogger('gvanno-auto-tune')))
+    conf_options = get_conf_options(batch_arg_dict)
+    vcfanno_tracks = get_vcfanno_tracks()
+    summarise_args = get_summarise_args(batch_arg_dict, batch_files)
+    start_usage = get_resource_usage(arg_dict['metrics_record_counts'])
+    if not arg_dict['annotation_cache'] is None:
+        counters = run_cached_annotation(batch_arg_dict, conf_options, batch_files, vcfanno_tracks, summarise_args)
+    elif arg_dict['n_shards'] > 1:
+        counters = run_sharded_annotation(batch_arg_dict, conf_options, batch_files, vcfanno_tracks, summarise_args)
+    else:
+        counters = run_annotation(batch_arg_dict, conf_options, batch_files, vcfanno_tracks, summarise_args)
+    annotated_sites_vcf = f'{batch_files["vep_vcfanno_summarised_vcf"]}.gz'
+    record_metrics(batch_files, 'annotate', start_usage, [union_vcf], [annotated_sites_vcf], counters)
+
+    ## gvanno|batch - project site annotations onto each query VCF, and produce per-sample output
+    for sample_id, query_vcf in samples:
+        print('----')
+        logger = getlogger("gvanno-batch")
+        logger.info(f"Projecting site annotations onto query VCF records - {sample_id}")
+        workflow_files = sample_files[sample_id]
+        start_usage = get_resource_usage(arg_dict['metrics_record_counts'])
+        project_site_annotations(f'{workflow_files["input_vcf_validated"]}.gz', annotated_sites_vcf,
+                                 workflow_files['vep_vcfanno_summarised_vcf'], logger)
+        check_subprocess(logger, f'bgzip -f {workflow_files["vep_vcfanno_summarised_vcf"]}', debug)
+        check_subprocess(logger, f'tabix -f -p vcf {workflow_files["vep_vcfanno_summarised_vcf"]}.gz', debug)
+        write_pass_vcf(f'{workflow_files["vep_vcfanno_summarised_vcf"]}.gz', logger)
+        move_summarised_output(workflow_files)
+        record_metrics(workflow_files, 'project', start_usage, [f'{workflow_files["input_vcf_validated"]}.gz', annotated_sites_vcf],
+                       [workflow_files['output_vcf']])
+        if not debug:
+            remove_files([f'{workflow_files["input_vcf_validated"]}*', workflow_files['off_target_vcf']])
+
+        sample_arg_dict = copy.deepcopy(arg_dict)
+        sample_arg_dict['sample_id'] = sample_id
+        run_output_conversion(sample_arg_dict, workflow_files, debug)
+
+    if not debug:
+        remove_files([f'{batch_files["input_vcf_validated"]}*', f'{batch_files["vep_vcf"]}*', f'{batch_files["vep_vcfanno_vcf"]}*',
+                      f'{batch_files["vep_vcfanno_summarised_vcf"]}*', f'{batch_files["vep_vcfanno_summarised_pass_vcf"]}*'])
+    logger = getlogger("gvanno-batch")
+    logger.info(f"Finished annotation of {len(samples)} query VCF files")
+
+
+if __name__ == "__main__":
+    __main__()
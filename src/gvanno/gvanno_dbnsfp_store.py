@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+
+from lib.gvanno.utils import getlogger, error_message
+from lib.gvanno.annoutils import read_vcfanno_tag_file
+from lib.gvanno.dbnsfp_store import get_dbnsfp_store_dir, build_dbnsfp_store, read_dbnsfp_store_manifest
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Build the columnar dbNSFP store of a gvanno data bundle (position-sorted, memory-mapped ' + \
+                                     'arrays), used by the native annotation engine (--annotation_engine native) instead of the dbNSFP VCF',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('gvanno_db_dir', help='gvanno assembly-specific data directory')
+    parser.add_argument('--force', action="store_true", default=False,
+                        help="Rebuild the store even if it matches the dbNSFP VCF of the bundle")
+
+    args = parser.parse_args()
+
+    logger = getlogger('gvanno-dbnsfp-store')
+
+    dbnsfp_vcf = os.path.join(args.gvanno_db_dir, 'variant', 'vcf', 'dbnsfp', 'dbnsfp.vcf.gz')
+    dbnsfp_tags_fname = os.path.join(args.gvanno_db_dir, 'variant', 'vcf', 'dbnsfp', 'dbnsfp.vcfanno.vcf_info_tags.txt')
+    if not os.path.exists(dbnsfp_vcf):
+        error_message(f'dbNSFP VCF ({dbnsfp_vcf}) does not exist', logger)
+    dbnsfp_tags = list(read_vcfanno_tag_file(dbnsfp_tags_fname, logger).keys())
+    if len(dbnsfp_tags) != 1:
+        error_message(f'dbNSFP store requires a single dbNSFP INFO tag ({dbnsfp_tags_fname} lists {len(dbnsfp_tags)})', logger)
+
+    store_dir = get_dbnsfp_store_dir(args.gvanno_db_dir)
+    if not args.force and not read_dbnsfp_store_manifest(store_dir, dbnsfp_vcf, dbnsfp_tags[0]) is None:
+        logger.info(f'dbNSFP store {store_dir} matches {dbnsfp_vcf} - nothing to do')
+        return
+    logger.info(f'Building dbNSFP store from {dbnsfp_vcf} ({dbnsfp_tags[0]})')
+    build_dbnsfp_store(dbnsfp_vcf, dbnsfp_tags[0], store_dir, logger)
+    logger.info('Finished')
+
+
+if __name__ == "__main__":
+    __main__()
@@ -5,6 +5,7 @@ import argparse
 
 from lib.gvanno.variant import append_annotations, clean_annotations
 from lib.gvanno.utils import getlogger
+from lib.gvanno.genotype_store import join_genotypes
 
 
 def __main__():
@@ -14,6 +15,7 @@ def __main__():
     parser.add_argument('tsv_file_out', help='TSV file with cleaned gvanno-annotated variants (SNVs/InDels)')
     parser.add_argument('genome_assembly', help='Genome assembly')
     parser.add_argument('sample_id', help='Sample identifier')
+    parser.add_argument('--genotype_store', default=None, help='Genotype store (.npz) with sample data of the query VCF (gvanno-validate-input)')
     parser.add_argument("--debug", action="store_true", default=False, help="Print full commands to log, default: %(default)s")
     args = parser.parse_args()
 
@@ -21,11 +23,22 @@ def __main__():
     
     arg_dict = vars(args)
    
+    finalize_variant_set(arg_dict['gvanno_db_dir'], arg_dict['tsv_file_in'], arg_dict['tsv_file_out'],
+                         arg_dict['genome_assembly'], arg_dict['sample_id'], logger, genotype_store = arg_dict['genotype_store'])
+
+
+def finalize_variant_set(gvanno_db_dir, tsv_file_in, tsv_file_out, genome_assembly, sample_id, logger, genotype_store = None):
+    """
+    Function that appends ClinVar traits, gene names and protein domain annotations to the
+    vcf2tsv-converted variant set, joins sample data (genotypes) from the genotype store (if any),
+    and writes the cleaned variant set as a gzipped TSV file
+    """
     variant_set = \
         append_annotations(
-            arg_dict['tsv_file_in'], gvanno_db_dir = arg_dict['gvanno_db_dir'], logger = logger)
-    variant_set = clean_annotations(variant_set, arg_dict['sample_id'], arg_dict['genome_assembly'], logger = logger)        
-    variant_set.fillna('.').to_csv(arg_dict['tsv_file_out'], sep="\t", compression="gzip", index=False)
+            tsv_file_in, gvanno_db_dir = gvanno_db_dir, logger = logger)
+    variant_set = join_genotypes(variant_set, genotype_store, logger)
+    variant_set = clean_annotations(variant_set, sample_id, genome_assembly, logger = logger)        
+    variant_set.fillna('.').to_csv(tsv_file_out, sep="\t", compression="gzip", index=False)
     
 
 if __name__=="__main__": __main__()
@@ -8,7 +8,7 @@ import os
 
 from lib.gvanno.annoutils import read_infotag_file, make_transcript_xref_map, read_genexref_namemap, write_pass_vcf, map_regulatory_variant_annotations
 from lib.gvanno.vep import parse_vep_csq
-from lib.gvanno.dbnsfp import vep_dbnsfp_meta_vcf, map_variant_effect_predictors
+from lib.gvanno.dbnsfp import vep_dbnsfp_meta_header, map_variant_effect_predictors
 from lib.gvanno.oncogenicity import assign_oncogenicity_evidence
 from lib.gvanno.mutation_hotspot import load_mutation_hotspots, match_csq_mutation_hotspot
 from lib.gvanno.utils import error_message, check_subprocess, getlogger
@@ -51,7 +51,8 @@ def extend_vcf_annotations(arg_dict, logger):
        Variant oncogenicity levels are provided for all variants using a recommended five-level scheme ("Oncogenic", "Likely oncogenic", "VUS", "Likely Benign", "Benign")
        - Recommended scoring scheme for variant oncogenicity classification outlined by VICC/ClinGen consortia (Horak et al., Genet Med, 2022)
 
-    List of VCF INFO tags appended by this procedure is defined by the 'infotags' files in the gvanno_db_dir
+    List of VCF INFO tags appended by this procedure is defined by the 'infotags' files in the gvanno_db_dir.
+    Returns a set of counters (records processed/written, records without CSQ, CSQ blocks parsed, hotspot hits etc.)
     """
     
     vcf_infotags = {}
@@ -68,11 +69,12 @@ def extend_vcf_annotations(arg_dict, logger):
 
     out_vcf = re.sub(r'(\.gz)$','',arg_dict['vcf_file_out'])
 
-    meta_vep_dbnsfp_info = vep_dbnsfp_meta_vcf(arg_dict['vcf_file_in'], vcf_info_metadata)
+    ## 'vcf_file_in' may also be a file descriptor (streaming mode) - the VCF is thus opened only once
+    vcf = cyvcf2.VCF(arg_dict['vcf_file_in'])
+    meta_vep_dbnsfp_info = vep_dbnsfp_meta_header(vcf, vcf_info_metadata)
     dbnsfp_prediction_algorithms = meta_vep_dbnsfp_info['dbnsfp_prediction_algorithms']
     vep_csq_fields_map = meta_vep_dbnsfp_info['vep_csq_fieldmap']
     
-    vcf = cyvcf2.VCF(arg_dict['vcf_file_in'])
     for tag in sorted(vcf_info_metadata):
         if arg_dict['regulatory_annotation'] == 0:
             if not tag.startswith('REGULATORY_'):
@@ -92,8 +94,13 @@ def extend_vcf_annotations(arg_dict, logger):
             fieldtype = str(header_element['Type'])
             vcf_info_element_types[identifier] = fieldtype
 
+    counters = {}
+    for counter in ['records_in', 'records_out', 'records_no_csq', 'csq_blocks_parsed', 'hotspot_hits', 'dbnsfp_records']:
+        counters[counter] = 0
+
     vars_no_csq = list()
     for rec in vcf:
+        counters['records_in'] += 1
         alt_allele = ','.join(rec.ALT)
         pos = rec.start + 1
         variant_id = f"g.{rec.CHROM}:{pos}{rec.REF}>{alt_allele}"
@@ -106,12 +113,15 @@ def extend_vcf_annotations(arg_dict, logger):
                     logger.info(f"Completed summary of functional annotations for {num_chromosome_records_processed} variants on chr{current_chrom}")
                 current_chrom = str(rec.CHROM)
                 num_chromosome_records_processed = 0
-        if rec.INFO.get('CSQ') is None:
+        csq = rec.INFO.get('CSQ')
+        if csq is None:
             
             vars_no_csq.append(variant_id)
+            counters['records_no_csq'] += 1
             continue
 
         num_chromosome_records_processed += 1
+        counters['csq_blocks_parsed'] += csq.count(',') + 1
         transcript_xref_map = make_transcript_xref_map(rec, gene_transcript_xref_map, xref_tag = "GENE_TRANSCRIPT_XREF")
 
         vep_csq_record_results = {}
@@ -164,9 +174,12 @@ def extend_vcf_annotations(arg_dict, logger):
         if 'all_csq' in vep_csq_record_results:
             rec.INFO['VEP_ALL_CSQ'] = ','.join(vep_csq_record_results['all_csq'])
             match_csq_mutation_hotspot(vep_csq_record_results['all_csq'], cancer_hotspots, rec, principal_csq_properties)
+            if not rec.INFO.get('MUTATION_HOTSPOT') is None:
+                counters['hotspot_hits'] += 1
 
         if not rec.INFO.get('DBNSFP') is None:
             map_variant_effect_predictors(rec, dbnsfp_prediction_algorithms)
+            counters['dbnsfp_records'] += 1
         
         if arg_dict['oncogenicity_annotation'] == 1:
             assign_oncogenicity_evidence(rec, tumortype = "Any")
@@ -176,6 +189,7 @@ def extend_vcf_annotations(arg_dict, logger):
             if not gene_xref_tag is None:
                 del rec.INFO['GENE_TRANSCRIPT_XREF']                
         w.write_record(rec)
+        counters['records_out'] += 1
     if vars_no_csq:
         logger.warning(f"There were {len(vars_no_csq)} records with no CSQ tag from VEP (was --vep_no_intergenic flag set?). Skipping them and showing (up to) the first 100:")
         print('----')
@@ -198,5 +212,9 @@ def extend_vcf_annotations(arg_dict, logger):
     else:
         error_message('No remaining PASS variants found in query VCF - exiting and skipping STEP 4', logger)
 
+    logger.info(f"Summarised {counters['records_out']} of {counters['records_in']} records ({counters['csq_blocks_parsed']} CSQ blocks parsed, " + \
+                f"{counters['records_no_csq']} records with no CSQ, {counters['hotspot_hits']} mutation hotspot hits)")
+    return counters
+
 if __name__=="__main__":
     __main__()
@@ -12,7 +12,11 @@ from cyvcf2 import VCF
 
 from lib.gvanno.vcf import check_existing_vcf_info_tags
 from lib.gvanno.annoutils import read_infotag_file
-from lib.gvanno.utils import getlogger, random_id_generator, check_subprocess, remove_file
+from lib.gvanno.utils import getlogger, check_subprocess, error_message
+from lib.gvanno.normalize import get_chromosomes_to_keep, normalize_vcf
+from lib.gvanno.tuning import get_available_cpus
+from lib.gvanno.target import read_target_regions
+from lib.gvanno.gvanno_vars import VCF_SORT_MAX_MEMORY_MB, VCF_SORT_MAX_PROC, BGZIP_N_THREADS
 
 
 def __main__():
@@ -24,112 +28,159 @@ def __main__():
    parser.add_argument('genome_assembly',help='grch37 or grch38')
    parser.add_argument('sample_id',help='Sample identifier')
    parser.add_argument('--output_dir', dest='output_dir', help='Output directory', default='/workdir/output')
+   parser.add_argument('--sort_max_memory_mb', type=int, default=VCF_SORT_MAX_MEMORY_MB, help='Maximum memory (MB) for sorting an unsorted input VCF, default: %(default)s')
+   parser.add_argument('--genotype_store', default=None, help='Genotype store (.npz) with sample data (GT) of the input VCF, written if the input VCF has samples')
+   parser.add_argument('--genotype_depth', action='store_true', help='Keep sample depth (DP) and allelic depths (AD) in the genotype store')
+   parser.add_argument('--target_bed', default=None, help='BED file with target regions, only variants in target regions are annotated')
+   parser.add_argument('--target_padding', type=int, default=0, help='Padding (bp) added on each side of the target regions, default: %(default)s')
+   parser.add_argument('--off_target_vcf', default=None, help='VCF file with off-target variants (passed through without annotation), off-target variants are skipped if not given')
    parser.add_argument('--debug', action='store_true', help="Print debug messages")
    args = parser.parse_args()
    
-   ret = validate_gvanno_input(args.gvanno_dir, args.input_vcf, args.validated_vcf, args.sample_id, args.genome_assembly, args.output_dir, args.debug)
+   ret = validate_gvanno_input(args.gvanno_dir, args.input_vcf, args.validated_vcf, args.sample_id, args.genome_assembly, args.output_dir, args.debug,
+                               sort_max_memory_mb = args.sort_max_memory_mb, genotype_store = args.genotype_store, genotype_depth = args.genotype_depth,
+                               target_bed = args.target_bed, target_padding = args.target_padding, off_target_vcf = args.off_target_vcf)
    if ret != 0:
       sys.exit(-1)
 
 
 
-def simplify_vcf(input_vcf, validated_vcf, vcf, output_dir, sample_id, logger, debug):
+def scan_input_vcf(vcf, logger):
+    """
+    vcf: parsed cyvcf2 object (not yet iterated)
+    Function that reads all records of the input VCF in a single streaming pass, and collects
+    1. the number of records, and the number of records on autosomal/sex/mito chromosomes (other contigs are filtered)
+    2. multiallelic sites (variants with multiple alternative alleles)
+    3. whether the records are sorted (each contig in a single block, contigs in the order of the VCF header, increasing positions)
+    """
+    chrom_to_keep = {}
+    for chrom in get_chromosomes_to_keep():
+        chrom_to_keep[chrom] = 1
+    header_contig_order = {}
+    for line in vcf.raw_header.split('\n'):
+        if line.startswith('##contig=<ID='):
+            header_contig_order[line[13:].split(',')[0].rstrip('>')] = len(header_contig_order)
+
+    vcf_scan = {}
+    vcf_scan['num_records'] = 0
+    vcf_scan['num_records_kept'] = 0
+    vcf_scan['filtered_contigs'] = {}
+    vcf_scan['num_multiallelic'] = 0
+    vcf_scan['multiallelic_sites'] = []
+    vcf_scan['sorted'] = True
+
+    current_chrom = None
+    previous_start = -1
+    seen_chroms = {}
+    for rec in vcf:
+        vcf_scan['num_records'] += 1
+        chrom = rec.CHROM
+        if chrom != current_chrom:
+            if chrom in seen_chroms:
+                vcf_scan['sorted'] = False
+            elif current_chrom in header_contig_order and chrom in header_contig_order and \
+                    header_contig_order[chrom] < header_contig_order[current_chrom]:
+                vcf_scan['sorted'] = False
+            seen_chroms[chrom] = 1
+            current_chrom = chrom
+            previous_start = -1
+        elif rec.start < previous_start:
+            vcf_scan['sorted'] = False
+        previous_start = rec.start
+
+        if chrom in chrom_to_keep:
+            vcf_scan['num_records_kept'] += 1
+        else:
+            vcf_scan['filtered_contigs'][chrom] = vcf_scan['filtered_contigs'].get(chrom, 0) + 1
+
+        if len(rec.ALT) > 1:
+            vcf_scan['num_multiallelic'] += 1
+            if len(vcf_scan['multiallelic_sites']) < 100:
+                alt = ",".join(str(n) for n in rec.ALT)
+                vcf_scan['multiallelic_sites'].append(f"{chrom}:{rec.start + 1}_{rec.REF}->{alt}")
+
+    logger.info(f"Input VCF: {vcf_scan['num_records']} records, {vcf_scan['num_records_kept']} on autosomal/sex/mito chromosomes, " + \
+                f"{vcf_scan['num_multiallelic']} multiallelic sites, {'sorted' if vcf_scan['sorted'] else 'not sorted'}")
+    if vcf_scan['filtered_contigs']:
+        filtered_contigs = sorted(vcf_scan['filtered_contigs'].items(), key = lambda x: -x[1])
+        logger.info(f"Skipping {vcf_scan['num_records'] - vcf_scan['num_records_kept']} records on other contigs (showing up to 10): " + \
+                    ', '.join(f'{chrom} ({n})' for chrom, n in filtered_contigs[:10]))
+    return vcf_scan
+
+
+def simplify_vcf(input_vcf, validated_vcf, vcf_scan, output_dir, sample_id, logger, debug, compress_output = True,
+                 sort_max_memory_mb = VCF_SORT_MAX_MEMORY_MB, genotype_store = None, genotype_depth = False, target_index = None,
+                 off_target_vcf = None):
     """
     input_vcf: path to input VCF
     validated_vcf: path to validated VCF
-    vcf: parsed cyvcf2 object
+    vcf_scan: properties of the input VCF records (scan_input_vcf)
+    compress_output: compress and index the validated VCF (bgzip + tabix), if False, the uncompressed VCF is kept (streaming mode)
+    sort_max_memory_mb: maximum memory used for sorting an unsorted input VCF
+    target_index: interval index of target regions (lib.gvanno.target), only variants in target regions are kept
+    off_target_vcf: file with off-target variants (passed through to the output without annotation), skipped if None
+    genotype_store: file with sample data (GT, and DP/AD with 'genotype_depth') of the input VCF (lib.gvanno.genotype_store), joined with the annotated variants in gvanno-finalize
     Function that performs the following on the validated input VCF:
-    1. Strip of any genotype data
+    1. Variants on autosomal/sex/mito chromosomes are kept ('chr' prefix stripped), and any genotype data is stripped (kept in 'genotype_store' if given)
     2. If VCF has variants with multiple alternative alleles ("multiallelic", e.g. 'A,T'), 
        these are decomposed into variants with a single alternative allele
-    3. Final VCF file is sorted and indexed (bgzip + tabix)
+    3. If the input VCF is not sorted, variants are sorted (bounded-memory external merge sort, parallel run generation)
+    4. If 'target_index' is given, variants outside the target regions are skipped (or written to 'off_target_vcf')
+    5. Final VCF file is compressed and indexed (bgzip + tabix)
+    Steps 1-4 are done in a single streaming pass (lib.gvanno.normalize)
     """
 
-    random_id = random_id_generator(15) 
-
-    temp_files = {}
-    temp_files['vcf_1'] = \
-        os.path.join(output_dir, f'{sample_id}.gvanno_validate.bcftools.{random_id}_1.vcf')
-    temp_files['vcf_2'] = \
-        os.path.join(output_dir, f'{sample_id}.gvanno_validate.bcftools.{random_id}_2.vcf.gz')
-    temp_files['vcf_3'] = \
-        os.path.join(output_dir, f'{sample_id}.gvanno_validate.bftools.{random_id}_3.vcf.gz')
-    bcftools_simplify_log = \
-        os.path.join(output_dir, f'{sample_id}.gvanno_validate.bcftools.{random_id}.log')
-    vt_decompose_log = \
-        os.path.join(output_dir, f'{sample_id}.gvanno_validate.vt_decompose.{random_id}.log')
-
-    multiallelic_list = list()
-    for rec in vcf:
-        POS = rec.start + 1
-        alt = ",".join(str(n) for n in rec.ALT)
-        if len(rec.ALT) > 1:
-            variant_id = f"{rec.CHROM}:{POS}_{rec.REF}->{alt}"
-            multiallelic_list.append(variant_id)
-
-    logger.info('Extracting variants on autosomal/sex/mito chromosomes only (1-22,X,Y, M/MT) with bcftools')
-    # bgzip + tabix required for sorting
-    cmd_vcf1 = f'bcftools view {input_vcf} | bgzip -cf > {temp_files["vcf_2"]} && tabix -p vcf {temp_files["vcf_2"]} && ' + \
-        f'bcftools sort --temp-dir {output_dir} -Oz {temp_files["vcf_2"]} > {temp_files["vcf_3"]} 2> {bcftools_simplify_log} && ' + \
-        f'tabix -p vcf {temp_files["vcf_3"]}'
-    # Keep only autosomal/sex/mito chrom (handle hg38 and hg19), remove FORMAT metadata lines, keep cols 1-8, sub chr prefix
-    chrom_to_keep = [str(x) for x in [*range(1,23), 'X', 'Y', 'M', 'MT']]
-    chrom_to_keep = ','.join([*['chr' + chrom for chrom in chrom_to_keep], *[chrom for chrom in chrom_to_keep]])
-    cmd_vcf2 = f'bcftools view --regions {chrom_to_keep} {temp_files["vcf_3"]} | egrep -v \'^##FORMAT=\' ' + \
-        f'| cut -f1-8 | sed \'s/^chr//\' > {temp_files["vcf_1"]}'
-
-    check_subprocess(logger, cmd_vcf1, debug)
-    check_subprocess(logger, cmd_vcf2, debug)
-
-    if multiallelic_list:
-        logger.warning(f"There were {len(multiallelic_list)} multiallelic sites detected. Showing (up to) the first 100:")
+    if vcf_scan['num_records_kept'] == 0:
+        error_message("Input VCF contains NO variants on autosomal/sex/mito chromosomes - quitting workflow", logger)
+
+    sort_records = not vcf_scan['sorted']
+    sort_n_processes = min(get_available_cpus(), VCF_SORT_MAX_PROC)
+    if sort_records:
+        logger.info(f'Input VCF is not sorted - sorting variants (max. memory {sort_max_memory_mb} MB, {sort_n_processes} process(es))')
+    else:
+        logger.info('Input VCF is sorted - skipping sorting')
+
+    decompose = vcf_scan['num_multiallelic'] > 0
+    if decompose:
+        logger.warning(f"There were {vcf_scan['num_multiallelic']} multiallelic sites detected. Showing (up to) the first 100:")
         print('----')
-        print(', '.join(multiallelic_list[:100]))
+        print(', '.join(vcf_scan['multiallelic_sites']))
         print('----')
-        logger.info('Decomposing multi-allelic sites in input VCF file using \'vt decompose\'')
-        command_decompose = f'vt decompose -s {temp_files["vcf_1"]} > {validated_vcf} 2> {vt_decompose_log}'
-        check_subprocess(logger, command_decompose, debug)
+        logger.info('Decomposing multi-allelic sites in input VCF file')
     else:
         logger.info('All sites seem to be decomposed - skipping decomposition!')
-        check_subprocess(logger, f'cp {temp_files["vcf_1"]} {validated_vcf}', debug)
-
-    keep_uncompressed = False
-    # need to keep uncompressed copy for vcf2maf.pl if selected
-    bgzip_cmd = f"bgzip -cf {validated_vcf} > {validated_vcf}.gz" if keep_uncompressed else f"bgzip -f {validated_vcf}"
-    check_subprocess(logger, bgzip_cmd, debug)
-    check_subprocess(logger, f'tabix -p vcf {validated_vcf}.gz', debug)
-
-    if os.path.exists(f'{validated_vcf}.gz') and os.path.getsize(f'{validated_vcf}.gz') > 0:
-        vcf = VCF(f'{validated_vcf}.gz')
-        i = 0
-        for rec in vcf:
-            i = i + 1
-        if len(vcf.seqnames) == 0 or i == 0:
-            logger.info('')
-            logger.info("Input VCF contains NO valid variants after VCF cleaning - quitting workflow")
-            logger.info('')
-            exit(1)
-
-    if not debug:
-        remove_file(temp_files["vcf_1"])
-        remove_file(temp_files["vcf_2"])
-        remove_file(temp_files["vcf_3"])
-        remove_file(temp_files["vcf_2"] + str('.tbi'))
-        remove_file(temp_files["vcf_3"] + str('.tbi'))
-        remove_file(bcftools_simplify_log)
-        remove_file(vt_decompose_log)
-
-def validate_gvanno_input(gvanno_directory, input_vcf, validated_vcf, sample_id, genome_assembly, output_dir, debug):
+
+    logger.info('Extracting variants on autosomal/sex/mito chromosomes only (1-22,X,Y, M/MT), removing genotype data')
+    with open(validated_vcf, 'wb') as out:
+        num_written = normalize_vcf(input_vcf, out, decompose, logger, sort_records = sort_records, temp_dir = output_dir,
+                                    sort_max_memory_mb = sort_max_memory_mb, sort_n_processes = sort_n_processes,
+                                    genotype_store = genotype_store, genotype_depth = genotype_depth, target_index = target_index,
+                                    off_target_vcf = off_target_vcf)
+
+    if num_written == 0:
+        target_info = ' in target regions' if not target_index is None else ''
+        error_message(f"Input VCF contains NO valid variants{target_info} after VCF cleaning - quitting workflow", logger)
+
+    if compress_output is True:
+        check_subprocess(logger, f'bgzip -f -@ {BGZIP_N_THREADS} {validated_vcf}', debug)
+        check_subprocess(logger, f'tabix -p vcf {validated_vcf}.gz', debug)
+
+def validate_gvanno_input(gvanno_directory, input_vcf, validated_vcf, sample_id, genome_assembly, output_dir, debug, compress_output = True,
+                          sort_max_memory_mb = VCF_SORT_MAX_MEMORY_MB, genotype_store = None, genotype_depth = False,
+                          target_bed = None, target_padding = 0, off_target_vcf = None):
    """
    Function that reads the input file to gvanno (VCF file) and performs the following checks:
    1. Check that no INFO annotation tags in the query VCF coincides with those generated by gvanno
-   2. Check that if VCF have variants with multiple alternative alleles (e.g. 'A,T') run vt decompose
-   3. Any genotype data from VCF input file is stripped, and the resulting VCF file is sorted and indexed (bgzip + tabix) 
+   2. Check that if VCF have variants with multiple alternative alleles (e.g. 'A,T') decompose these into biallelic records
+   3. Any genotype data from VCF input file is stripped, and the resulting VCF file is sorted (unless already sorted) and indexed (bgzip + tabix) 
+   4. If 'target_bed' is given, only variants in target regions (+/- 'target_padding' bp) are kept, off-target variants are
+      written to 'off_target_vcf' if given (passed through to the output without annotation)
+   The input VCF is opened once, i.e. the header check and a single pass over all records (scan_input_vcf)
    """
    logger = getlogger('gvanno-validate-input')
 
    if not input_vcf == 'None':
-      vcf_object = VCF(input_vcf)
+      vcf = VCF(input_vcf)
 
       ## Check that VCF does not contain INFO tags that will be appended with gvanno annotation
       vcf_infotags = {}
@@ -140,12 +191,18 @@ def validate_gvanno_input(gvanno_directory, input_vcf, validated_vcf, sample_id,
       vcf_infotags['gvanno'].update(vcf_infotags['vep'])
       vcf_tags_gvanno = vcf_infotags['gvanno']
         
-      tag_check = check_existing_vcf_info_tags(vcf_object, vcf_tags_gvanno, logger)
+      tag_check = check_existing_vcf_info_tags(vcf, vcf_tags_gvanno, logger)
       if tag_check == -1:
          return -1     
       
-      vcf = VCF(input_vcf)
-      simplify_vcf(input_vcf, validated_vcf, vcf, output_dir, sample_id, logger, debug)
+      vcf_scan = scan_input_vcf(vcf, logger)
+      vcf.close()
+      target_index = None
+      if not target_bed is None:
+         target_index = read_target_regions(target_bed, target_padding, logger)
+      simplify_vcf(input_vcf, validated_vcf, vcf_scan, output_dir, sample_id, logger, debug, compress_output = compress_output,
+                   sort_max_memory_mb = sort_max_memory_mb, genotype_store = genotype_store, genotype_depth = genotype_depth,
+                   target_index = target_index, off_target_vcf = off_target_vcf)
    
    return 0
    
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import argparse
+import subprocess
+
+from cyvcf2 import VCF
+
+from lib.gvanno.utils import getlogger, error_message
+from lib.gvanno.gvanno_vars import GVANNO_VERSION
+
+## TSV layout of vcf2tsvpy (https://github.com/sigven/vcf2tsvpy): a version line, fixed VCF columns, and INFO tags sorted by name
+VCF2TSV_VERSION_LINE = f'#https://github.com/sigven/gvanno (gvanno-vcf2tsv) version={GVANNO_VERSION}'
+VCF2TSV_FIXED_COLUMNS = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER']
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Convert a gvanno-annotated VCF file to TSV - all variants and PASS variants in a single pass')
+    parser.add_argument('vcf_file_in', help='Bgzipped VCF file with gvanno-annotated variants (SNVs/InDels)')
+    parser.add_argument('tsv_file_all', help='Gzipped TSV file with all (PASS and non-PASS) variants')
+    parser.add_argument('tsv_file_pass', help='Gzipped TSV file with PASS variants only')
+    args = parser.parse_args()
+
+    logger = getlogger('gvanno-vcf2tsv')
+    convert_vcf_to_tsv(args.vcf_file_in, args.tsv_file_all, args.tsv_file_pass, logger)
+
+
+def format_info_value(value, info_type):
+    """
+    Function that formats a (cyvcf2) INFO value as a TSV field, as done by vcf2tsvpy
+    """
+    if info_type == 'Flag':
+        return 'False' if value is None else 'True'
+    if isinstance(value, (list, tuple)):
+        return ','.join(str(n) for n in value)
+    if value is None:
+        return '.'
+    if info_type == 'Float':
+        return '{0:.7f}'.format(value) if isinstance(value, float) else '.'
+    if info_type == 'String' or info_type == 'Character':
+        return value.encode('ascii', 'ignore').decode('ascii') if isinstance(value, str) else '.'
+    return str(value)
+
+
+def open_gzip_writer(tsv_fname):
+    """
+    Function that opens a gzip process that compresses (in parallel to the conversion) to 'tsv_fname'
+    """
+    out = open(tsv_fname, 'wb')
+    proc = subprocess.Popen(['gzip', '-c'], stdin = subprocess.PIPE, stdout = out)
+    out.close()
+    return proc
+
+
+def convert_vcf_to_tsv(vcf_file_in, tsv_file_all, tsv_file_pass, logger):
+    """
+    Function that converts a sites-only VCF file (gvanno output, genotypes are removed by gvanno-validate-input) to TSV
+    in a single pass over the VCF, writing both all variants ('tsv_file_all', as 'vcf2tsvpy --keep_rejected') and PASS
+    variants only ('tsv_file_pass'), gzipped. Values are formatted as with vcf2tsvpy
+    """
+    vcf = VCF(vcf_file_in)
+    if len(vcf.samples) > 0:
+        error_message(f'Expected a VCF file without genotype data (sites only) for TSV conversion - found {len(vcf.samples)} sample(s)', logger)
+
+    info_types = {}
+    for e in vcf.header_iter():
+        header_element = e.info()
+        if 'ID' in header_element.keys() and 'HeaderType' in header_element.keys():
+            if header_element['HeaderType'] == 'INFO':
+                info_types[str(header_element['ID'])] = str(header_element['Type'])
+    info_tags = sorted(info_types.keys())
+    info_index = {}
+    for i, tag in enumerate(info_tags):
+        info_index[tag] = i
+    ## values of INFO tags that are absent from a record
+    missing_info_values = ['False' if info_types[tag] == 'Flag' else '.' for tag in info_tags]
+
+    header = VCF2TSV_VERSION_LINE + '\n' + '\t'.join(VCF2TSV_FIXED_COLUMNS + info_tags) + '\n'
+    gzip_all = open_gzip_writer(tsv_file_all)
+    gzip_pass = open_gzip_writer(tsv_file_pass)
+    gzip_all.stdin.write(header.encode())
+    gzip_pass.stdin.write(header.encode())
+
+    num_all = 0
+    num_pass = 0
+    for rec in vcf:
+        rec_filter = 'PASS' if rec.FILTER is None else str(rec.FILTER)
+        fields = [str(rec.CHROM), str(rec.start + 1), '.' if rec.ID is None else str(rec.ID), str(rec.REF),
+                  ','.join(str(n) for n in rec.ALT), '.' if rec.QUAL is None else '{0:.2f}'.format(rec.QUAL), rec_filter]
+        info_values = list(missing_info_values)
+        for tag, value in rec.INFO:
+            if tag in info_index:
+                info_values[info_index[tag]] = format_info_value(value, info_types[tag])
+        line = ('\t'.join(fields + info_values) + '\n').encode()
+        gzip_all.stdin.write(line)
+        num_all += 1
+        if 'PASS' in rec_filter:
+            gzip_pass.stdin.write(line)
+            num_pass += 1
+    vcf.close()
+
+    for proc in [gzip_all, gzip_pass]:
+        proc.stdin.close()
+        if proc.wait() != 0:
+            error_message(f'Compression of TSV output failed (gzip exit code {proc.returncode})', logger)
+    logger.info(f'Converted {num_all} variant records to TSV ({num_pass} PASS variants)')
+
+
+if __name__ == "__main__":
+    __main__()
@@ -1,14 +1,21 @@
 #!/usr/bin/env python
 
 import argparse
-import random
 import re, os
 import glob
+import subprocess
+import threading
 
-from lib.gvanno.vcf import get_vcf_info_tags, print_vcf_header
-from lib.gvanno.utils import check_subprocess, random_id_generator, getlogger, remove_file
+from lib.gvanno.vcf import get_vcf_info_tags, read_vcf_header_lines, get_vcf_info_tag_numbers
+from lib.gvanno.utils import check_subprocess, random_id_generator, getlogger, remove_file, error_message
+from lib.gvanno.shard import open_vcf_output
+from lib.gvanno.trackanno import run_track_annotation, merge_track_annotations
+from lib.gvanno.dbnsfp_store import get_dbnsfp_store_dir, read_dbnsfp_store_manifest
 from lib.gvanno.annoutils import read_vcfanno_tag_file
 
+## vcfanno operations for BED tracks (value in column 4), all fields of VCF tracks are concatenated
+BED_TRACK_OPS = {'ncer': 'mean', 'gerp': 'mean', 'gene_transcript_xref': 'concat', 'rmsk': 'concat'}
+
 
 def __main__():
     parser = argparse.ArgumentParser(description='Run brentp/vcfanno - annotate a VCF file against multiple VCF files in parallel',
@@ -31,6 +38,10 @@ def __main__():
                         help="Annotate VCF with transcript annotations from PCGR (drug targets, actionable genes, cancer gene roles, etc)")
     parser.add_argument("--gwas", action="store_true",
                         help="Annotate VCF against moderate-to-low cancer risk variants, as identified from genome-wide association studies (GWAS)")
+    parser.add_argument("--annotation_engine", choices=['vcfanno', 'native'], default='vcfanno',
+                        help="Annotate with vcfanno, or with the native engine (tabix-indexed merge-join, one process per track)")
+    parser.add_argument("--vcfanno_per_track", action="store_true", default=False,
+                        help="Run a separate vcfanno process per track (processes shared by track size), merged by record ordinal")
     parser.add_argument("--debug", action="store_true", default=False,
                         help="Print full commands to log, keep temporary and log files, default: %(default)s")
 
@@ -38,13 +49,6 @@ def __main__():
 
     logger = getlogger('gvanno-vcfanno')
 
-    query_info_tags = get_vcf_info_tags(args.query_vcf)
-    vcfheader_file = args.out_vcf + '.tmp.' + \
-        str(random.randrange(0, 10000000)) + '.header.txt'
-    conf_fname = args.out_vcf + '.tmp.conf.toml'
-    print_vcf_header(args.query_vcf, vcfheader_file,
-                     logger, chromline_only=False)
-    
     vcfanno_tracks = {}
     ## BED   
     vcfanno_tracks['gene_transcript_xref'] = args.gene_transcript_xref
@@ -56,20 +60,200 @@ def __main__():
     vcfanno_tracks['ncer'] = args.ncer
     vcfanno_tracks['gene_transcript_xref'] = args.gene_transcript_xref
 
-    run_vcfanno(args.num_processes, args.query_vcf, vcfanno_tracks, query_info_tags, vcfheader_file,
-                args.gvanno_db_dir, conf_fname, args.out_vcf, args.debug, logger)
+    annotate_vcf(args.query_vcf, args.out_vcf, args.gvanno_db_dir, vcfanno_tracks, 
+                 args.num_processes, args.debug, logger, annotation_engine = args.annotation_engine,
+                 vcfanno_per_track = args.vcfanno_per_track)
+
+
+def annotate_vcf(query_vcf, out_vcf, gvanno_db_dir, vcfanno_tracks, num_processes, debug, logger, annotation_engine = 'vcfanno',
+                 vcfanno_per_track = False):
+    """
+    Function that sets up the VCF header and configuration files for vcfanno, and annotates 
+    the query VCF against the tracks that are switched on in 'vcfanno_tracks'. With annotation_engine 'native',
+    the tracks are annotated without vcfanno (lib.gvanno.trackanno), with the same VCF header and INFO output.
+    With 'vcfanno_per_track', each track is annotated by a separate vcfanno process
+    """
+
+    query_info_tags = get_vcf_info_tags(query_vcf)
+    conf_fname = out_vcf + '.tmp.conf.toml'
+
+    if annotation_engine == 'native':
+        tracks = get_annotation_tracks(vcfanno_tracks, query_info_tags, gvanno_db_dir, logger)
+        ## Number of the INFO tags of VCF tracks (values of Number=A tags are selected per ALT allele, as in vcfanno)
+        for track in tracks:
+            track['tag_numbers'] = get_vcf_info_tag_numbers(track['track_fname']) if track['format'] == 'vcf' else {}
+        set_dbnsfp_store(tracks, gvanno_db_dir, logger)
+        vcfheader_lines = get_output_vcf_header(query_vcf, [track['tags_fname'] for track in tracks])
+        logger.info(f'Annotation engine: native ({len(tracks)} tracks)')
+        run_track_annotation(query_vcf, tracks, vcfheader_lines, f'{out_vcf}.gz', num_processes, debug, logger)
+        check_subprocess(logger, f'tabix -f -p vcf {out_vcf}.gz', debug)
+        return
+
+    if vcfanno_per_track:
+        run_vcfanno_per_track(num_processes, query_vcf, vcfanno_tracks, query_info_tags,
+                              gvanno_db_dir, out_vcf, debug, logger)
+        return
+
+    run_vcfanno(num_processes, query_vcf, vcfanno_tracks, query_info_tags,
+                gvanno_db_dir, conf_fname, out_vcf, debug, logger)
+
+
+def set_dbnsfp_store(tracks, gvanno_db_dir, logger):
+    """
+    Function that switches the dbNSFP track to its columnar store (built with gvanno_dbnsfp_store.py), if the store
+    is present and was built from the dbNSFP VCF of the bundle
+    """
+    for track in tracks:
+        if track['name'] != 'dbnsfp' or len(track['tags']) != 1:
+            continue
+        store_dir = get_dbnsfp_store_dir(gvanno_db_dir)
+        manifest = read_dbnsfp_store_manifest(store_dir, track['track_fname'], track['tags'][0])
+        if manifest is None:
+            if os.path.exists(store_dir):
+                logger.warning(f'dbNSFP store {store_dir} does not match {track["track_fname"]} (rebuild with gvanno_dbnsfp_store.py) - ' + \
+                               'annotating with the dbNSFP VCF')
+            continue
+        track['store'] = {'dir': store_dir, 'manifest': manifest}
+        logger.info(f'dbNSFP store: {store_dir} ({sum(manifest["chromosomes"].values())} entries)')
+
+
+def get_output_vcf_header(query_vcf, tags_fnames):
+    """
+    Function that composes the header of the annotated VCF (in memory), i.e. the header of the query VCF with
+    the VCF INFO tags of annotation tracks ('tags_fnames') appended
+    """
+    vcfheader_lines, chrom_line = read_vcf_header_lines(query_vcf)
+    for tags_fname in tags_fnames:
+        with open(tags_fname, 'r') as f:
+            vcfheader_lines.extend([line for line in f if line.strip() != ''])
+    vcfheader_lines.append(chrom_line)
+    return vcfheader_lines
 
 
-def run_vcfanno(num_processes, query_vcf, vcfanno_tracks, query_info_tags, vcfheader_file, gvanno_db_dir, conf_fname,
+def run_vcfanno(num_processes, query_vcf, vcfanno_tracks, query_info_tags, gvanno_db_dir, conf_fname,
                 output_vcf, debug, logger):
 
     """
     Function that annotates a VCF file with vcfanno against a user-defined set of germline and somatic VCF files
     """
 
-    ## Collect metadata (VCF INFO tags) for annotations populated with vcfanno
-    metadata_vcf_infotags = {}
-    infotags = {}
+    ## Write vcfanno configuration file, and compose the output VCF header
+    vcfheader_lines = get_output_vcf_header(
+        query_vcf, write_vcfanno_conf(vcfanno_tracks, query_info_tags, gvanno_db_dir, conf_fname, logger))
+
+    random_id = random_id_generator(10)
+    query_prefix = re.sub(r'\.vcf.gz$', '', query_vcf)
+    
+    vcfanno_log = f"{query_prefix}.{random_id}.tmp.vcfanno.log"
+    vcfanno_command = f"vcfanno -p={num_processes} {conf_fname} {query_vcf}"
+    
+    if debug:
+        logger.info(f"vcfanno command: {vcfanno_command}")
+
+    ## Stream vcfanno output (stdout) straight into the BGZF-compressed output VCF, replacing the vcfanno header
+    ## with the composed header on the fly
+    with open(vcfanno_log, 'w') as log_fh, open_vcf_output(f'{output_vcf}.gz', logger) as out:
+        vcfanno_proc = subprocess.Popen(vcfanno_command, shell=True, stdout=subprocess.PIPE, stderr=log_fh,
+                                        universal_newlines=True)
+        out.writelines(vcfheader_lines)
+        for line in vcfanno_proc.stdout:
+            if not line.startswith('#'):
+                out.write(line)
+        vcfanno_proc.stdout.close()
+        vcfanno_proc.wait()
+    if vcfanno_proc.returncode != 0:
+        error_message(f'vcfanno exited with error code {vcfanno_proc.returncode} - see {vcfanno_log}', logger)
+    check_subprocess(logger, f'tabix -f -p vcf {output_vcf}.gz', debug)
+    if not debug:
+        for intermediate_file in glob.glob(f"{query_prefix}.{random_id}.tmp.vcfanno*"):
+            remove_file(intermediate_file)
+    
+    return
+
+
+def write_track_info_elements(vcfanno_stream, track_tags, annotation_fname):
+    """
+    Function that reads vcfanno output (single track) and writes only the INFO elements of the track tags, one line
+    per VCF record (in input order)
+    """
+    with open(annotation_fname, 'w') as out:
+        for line in vcfanno_stream:
+            if line.startswith('#'):
+                continue
+            info = line.rstrip('\n').split('\t', 8)[7]
+            out.write(';'.join([e for e in info.split(';') if e.partition('=')[0] in track_tags]) + '\n')
+
+
+def run_vcfanno_per_track(num_processes, query_vcf, vcfanno_tracks, query_info_tags, gvanno_db_dir, output_vcf, debug, logger):
+    """
+    Function that annotates a VCF file with one vcfanno process per annotation track, all running concurrently.
+    The vcfanno processes (-p) are shared between tracks by track file size (at least one per track), i.e. small
+    tracks finish independently of dbNSFP. Each run keeps only the INFO elements of its own track, and the
+    per-track annotations are merged onto the query records by ordinal
+    """
+    tracks = get_annotation_tracks(vcfanno_tracks, query_info_tags, gvanno_db_dir, logger)
+    vcfheader_lines = get_output_vcf_header(query_vcf, [track['tags_fname'] for track in tracks])
+
+    random_id = random_id_generator(10)
+    query_prefix = re.sub(r'\.vcf.gz$', '', query_vcf)
+    track_sizes = [os.path.getsize(track['track_fname']) for track in tracks]
+    vcfanno_runs = []
+    for track, track_size in zip(tracks, track_sizes):
+        track_prefix = f'{query_prefix}.{random_id}.tmp.vcfanno.{track["name"]}'
+        remove_file(f'{track_prefix}.conf.toml')
+        append_to_conf_file(track['name'], track['tags'], track['track_fname'], f'{track_prefix}.conf.toml')
+        track_processes = max(1, round(int(num_processes) * track_size / max(1, sum(track_sizes))))
+        vcfanno_command = f"vcfanno -p={track_processes} {track_prefix}.conf.toml {query_vcf}"
+        if debug:
+            logger.info(f"vcfanno command ({track['name']}): {vcfanno_command}")
+        log_fh = open(f'{track_prefix}.log', 'w')
+        vcfanno_proc = subprocess.Popen(vcfanno_command, shell=True, stdout=subprocess.PIPE, stderr=log_fh,
+                                        universal_newlines=True)
+        writer = threading.Thread(target=write_track_info_elements,
+                                  args=(vcfanno_proc.stdout, set(track['tags']), f'{track_prefix}.annotation.txt'))
+        writer.start()
+        vcfanno_runs.append({'track': track, 'proc': vcfanno_proc, 'writer': writer, 'log_fh': log_fh,
+                             'prefix': track_prefix, 'processes': track_processes})
+
+    for run in vcfanno_runs:
+        run['writer'].join()
+        run['proc'].stdout.close()
+        run['proc'].wait()
+        run['log_fh'].close()
+        if run['proc'].returncode != 0:
+            for other_run in vcfanno_runs:
+                other_run['proc'].kill()
+            error_message(f"vcfanno ({run['track']['name']}) exited with error code {run['proc'].returncode} - see {run['prefix']}.log", logger)
+        logger.info(f"vcfanno track {run['track']['name']}: finished ({run['processes']} processes)")
+
+    merge_track_annotations(query_vcf, [f"{run['prefix']}.annotation.txt" for run in vcfanno_runs], vcfheader_lines,
+                            f'{output_vcf}.gz', logger)
+    check_subprocess(logger, f'tabix -f -p vcf {output_vcf}.gz', debug)
+    if not debug:
+        for intermediate_file in glob.glob(f"{query_prefix}.{random_id}.tmp.vcfanno*"):
+            remove_file(intermediate_file)
+
+
+def write_vcfanno_conf(vcfanno_tracks, query_info_tags, gvanno_db_dir, conf_fname, logger):
+    """
+    Function that writes a vcfanno configuration file ('conf_fname') for all annotation tracks switched on in 'vcfanno_tracks'.
+    Returns the list of files with VCF INFO header lines for the annotation tracks in use
+    """
+
+    tags_fnames = []
+    for track in get_annotation_tracks(vcfanno_tracks, query_info_tags, gvanno_db_dir, logger):
+        ## append track to vcfanno configuration file
+        append_to_conf_file(track['name'], track['tags'], track['track_fname'], conf_fname)
+        tags_fnames.append(track['tags_fname'])
+
+    return tags_fnames
+
+
+def get_annotation_tracks(vcfanno_tracks, query_info_tags, gvanno_db_dir, logger):
+    """
+    Function that collects the annotation tracks switched on in 'vcfanno_tracks': source file (VCF/BED), file with
+    VCF INFO header lines, INFO tags (and their types) and the vcfanno operation ('concat'/'mean') of each track
+    """
 
     track_file_info = {}
 
@@ -88,50 +272,27 @@ def run_vcfanno(num_processes, query_vcf, vcfanno_tracks, query_info_tags, vcfhe
     track_file_info['tags_fname']['ncer'] = os.path.join(gvanno_db_dir,'misc','bed', 'ncer', 'ncer.vcfanno.vcf_info_tags.txt')
     track_file_info['track_fname']['ncer'] = os.path.join(gvanno_db_dir,'misc','bed', 'ncer', 'ncer.bed.gz')
     
-    
+    tracks = []
     for track in track_file_info['tags_fname']:
 
         if not vcfanno_tracks[track] is True:
             continue
 
         infotags_vcfanno = read_vcfanno_tag_file(track_file_info['tags_fname'][track], logger)
-        infotags[track] = infotags_vcfanno.keys()
         for tag in infotags_vcfanno:
             if tag in query_info_tags:
                 logger.warning("Query VCF has INFO tag " + str(tag) + ' - this is also present in the ' + str(
                     track) + ' VCF/BED annotation file. This tag will be overwritten if not renamed in the query VCF')
-            metadata_vcf_infotags[tag] = infotags_vcfanno[tag]
-        
-        ## append track to vcfanno configuration file
-        append_to_conf_file(track, infotags[track], track_file_info['track_fname'][track], conf_fname)
-
-        ## Append VCF INFO tags to VCF header file
-        check_subprocess(logger, f'cat {track_file_info["tags_fname"][track]} >> {vcfheader_file}', debug=False)
 
-    random_id = random_id_generator(10)
-    query_prefix = re.sub(r'\.vcf.gz$', '', query_vcf)
-    print_vcf_header(query_vcf, vcfheader_file, logger, chromline_only=True)
-    
-    vcfanno_command = (
-        f"vcfanno -p={num_processes} {conf_fname} {query_vcf} > {query_prefix}.{random_id}.tmp.vcfanno.unsorted.vcf 2> "
-        f"{query_prefix}.{random_id}.tmp.vcfanno.log"
-        )
-    
-    if debug:
-        logger.info(f"vcfanno command: {vcfanno_command}")
-    check_subprocess(logger, vcfanno_command, debug)
+        tracks.append({'name': track,
+                       'track_fname': track_file_info['track_fname'][track],
+                       'tags_fname': track_file_info['tags_fname'][track],
+                       'tags': list(infotags_vcfanno.keys()),
+                       'tag_types': {tag: infotags_vcfanno[tag].get('type') for tag in infotags_vcfanno},
+                       'format': 'bed' if track in BED_TRACK_OPS else 'vcf',
+                       'op': BED_TRACK_OPS.get(track, 'concat')})
 
-    check_subprocess(
-        logger, f'cat {vcfheader_file} > {output_vcf}', debug=False)
-    check_subprocess(
-        logger, f"cat {query_prefix}.{random_id}.tmp.vcfanno.unsorted.vcf | grep -v '^#' >> {output_vcf}", debug=False)
-    check_subprocess(logger, f'bgzip -f {output_vcf}', debug)
-    check_subprocess(logger, f'tabix -f -p vcf {output_vcf}.gz', debug)
-    if not debug:
-        for intermediate_file in glob.glob(f"{query_prefix}.{random_id}.tmp.vcfanno*"):
-            remove_file(intermediate_file)
-    
-    return
+    return tracks
 
 
 def append_to_conf_file(datasource, datasource_info_tags, datasource_track_fname, conf_fname):
@@ -142,16 +303,11 @@ def append_to_conf_file(datasource, datasource_info_tags, datasource_track_fname
     fh = open(conf_fname, 'a')
     fh.write('[[annotation]]\n')
     fh.write('file="' + str(datasource_track_fname) + '"\n')
-    if datasource == 'ncer' or datasource == 'gerp':        
-        fh.write('columns=[4]\n')
-        names_string = 'names=["' + '","'.join(datasource_info_tags) + '"]'
-        fh.write(names_string + '\n')
-        fh.write('ops=["mean"]\n\n')
-    elif datasource == 'gene_transcript_xref' or datasource == 'rmsk':       
+    if datasource in BED_TRACK_OPS:
         fh.write('columns=[4]\n')
         names_string = 'names=["' + '","'.join(datasource_info_tags) + '"]'
         fh.write(names_string + '\n')
-        fh.write('ops=["concat"]\n\n')
+        fh.write('ops=["' + BED_TRACK_OPS[datasource] + '"]\n\n')
     else:        
         fields_string = 'fields = ["' + '","'.join(datasource_info_tags) + '"]'
         ops = ['concat'] * len(datasource_info_tags)
@@ -2,8 +2,13 @@
 
 import os,re
 import argparse
+import subprocess
 
-from lib.gvanno.utils import get_loftee_dir, getlogger, check_subprocess
+from lib.gvanno.utils import get_loftee_dir, getlogger, check_subprocess, remove_file, error_message
+from lib.gvanno.shard import split_vcf_by_density, concat_vcf_shards
+from lib.gvanno.annotation_cache import get_vep_store_scope, split_cached_sites, merge_cached_annotations, evict_cache_entries
+from lib.gvanno.vep_pool import run_vep_pool
+from lib.gvanno.vep import get_vep_csq_fields
 from lib.gvanno import gvanno_vars
 
 
@@ -23,6 +28,16 @@ def __main__():
     parser.add_argument('--vep_lof_prediction',action="store_true",help='Perform LoF prediction with the LOFTEE plugin in VEP')
     parser.add_argument('--vep_coding_only', action="store_true", help="Only consider coding variants")
     parser.add_argument('--vep_no_intergenic', action="store_true", help="Skip intergenic variants")
+    parser.add_argument('--vep_infotags_tsv', default=None, help="VEP info tag file of the gvanno data bundle (vcf_infotags_vep.tsv), CSQ output " + \
+                        "of VEP is restricted to the listed fields (--fields), default: %(default)s")
+    parser.add_argument('--vep_n_workers', default=0, type=int, help="Number of warm VEP worker processes fed with batches of " + \
+                        "--vep_buffer_size records (0: a single VEP process per input file), default: %(default)s")
+    parser.add_argument('--vep_n_chunks', default=1, type=int, help="Number of genomic chunks (balanced by variant count) that are annotated " + \
+                        "by independent VEP processes in parallel, each with --vep_n_forks forks, default: %(default)s")
+    parser.add_argument('--vep_store', default=None, help="SQLite file with VEP annotations of previously seen variants (shared across runs), " + \
+                        "only novel variants are annotated with VEP, default: %(default)s")
+    parser.add_argument('--vep_store_max_entries', default=5000000, type=int, help="Maximum number of variants in the VEP store, " + \
+                        "least recently used variants are evicted, default: %(default)s")
     parser.add_argument("--debug", action="store_true", default=False, help="Print full commands to log, default: %(default)s")
     args = parser.parse_args()
 
@@ -41,12 +56,121 @@ def __main__():
     conf_options['conf']['vep']['vep_lof_prediction'] = arg_dict['vep_lof_prediction']
     conf_options['conf']['vep']['vep_coding_only'] = arg_dict['vep_coding_only']
     conf_options['conf']['vep']['vep_no_intergenic'] = arg_dict['vep_no_intergenic']
+    conf_options['conf']['vep']['vep_csq_fields'] = None
+    if not arg_dict['vep_infotags_tsv'] is None:
+        conf_options['conf']['vep']['vep_csq_fields'] = get_vep_csq_fields(arg_dict['vep_infotags_tsv'])
     
-    run_vep(arg_dict['vep_cache_dir'], conf_options, arg_dict['vcf_file_in'], arg_dict['vcf_file_out'], logger, arg_dict['debug'])
+    run_vep(arg_dict['vep_cache_dir'], conf_options, arg_dict['vcf_file_in'], arg_dict['vcf_file_out'], logger, arg_dict['debug'],
+            vep_store = arg_dict['vep_store'], vep_store_max_entries = arg_dict['vep_store_max_entries'],
+            vep_n_workers = arg_dict['vep_n_workers'], vep_n_chunks = arg_dict['vep_n_chunks'])
 
-def run_vep(vep_cache_dir, conf_options, input_vcf, output_vcf, logger, debug = False):
+def run_vep(vep_cache_dir, conf_options, input_vcf, output_vcf, logger, debug = False, vep_store = None, vep_store_max_entries = 5000000,
+            vep_n_workers = 0, vep_n_chunks = 1):
     
+    ## VEP output is compressed (BGZF) while it is written, i.e. only '<output_vcf>.gz' is written to disk
     output_vcf_gz = f'{output_vcf}.gz'
+
+    vep_tabix_command = f'tabix -f -p vcf {output_vcf_gz}'
+    if vep_store is None:
+        annotate_vcf_with_vep(vep_cache_dir, conf_options, input_vcf, output_vcf_gz, logger, debug, vep_n_workers, vep_n_chunks)
+    else:
+        run_vep_novel_sites(vep_cache_dir, conf_options, input_vcf, output_vcf_gz, vep_store, vep_store_max_entries, logger, debug,
+                            vep_n_workers, vep_n_chunks)
+    
+    check_subprocess(logger, vep_tabix_command, debug)
+    logger.info('Finished gvanno-vep')
+    
+    return 0
+
+def annotate_vcf_with_vep(vep_cache_dir, conf_options, input_vcf, output_vcf, logger, debug = False, vep_n_workers = 0, vep_n_chunks = 1):
+    """
+    Function that runs VEP on a VCF file, either as a single VEP process, with a pool of warm VEP workers (vep_n_workers > 0)
+    that are started ahead of subsequent VEP runs of this process (cache, FASTA index and plugins are loaded while the
+    workers wait for input), or as independent VEP processes for genomic chunks of the VCF file (vep_n_chunks > 1).
+    Output VCF files ending with '.gz' are bgzipped
+    """
+    if vep_n_workers > 0:
+        vep_worker_command = get_vep_command(vep_cache_dir, conf_options, 'STDIN', 'STDOUT', logger, debug)
+        if debug:
+            print(vep_worker_command)
+        if run_vep_pool(vep_worker_command, vep_n_workers, input_vcf, output_vcf,
+                        conf_options['conf']['vep']['vep_buffer_size'], logger) > 0:
+            return
+        ## no records - a single VEP process writes the VEP header
+    elif vep_n_chunks > 1:
+        run_vep_chunks(vep_cache_dir, conf_options, input_vcf, output_vcf, vep_n_chunks, logger, debug)
+        return
+    vep_main_command = get_vep_command(vep_cache_dir, conf_options, input_vcf, output_vcf, logger, debug)
+    if debug:
+        print(vep_main_command)
+    check_subprocess(logger, vep_main_command, debug)
+
+
+def run_vep_chunks(vep_cache_dir, conf_options, input_vcf, output_vcf, vep_n_chunks, logger, debug = False):
+    """
+    Function that splits a (coordinate-sorted) VCF file into 'vep_n_chunks' genomic chunks with approximately the same
+    number of variant records, runs an independent VEP process for each chunk in parallel, and concatenates the VEP
+    output of all chunks (bgzipped, in coordinate order) into 'output_vcf' (bgzipped if it ends with '.gz')
+    """
+    prefix = re.sub(r'\.gz$', '', output_vcf)
+    chunk_vcfs = split_vcf_by_density(input_vcf, [f'{prefix}.tmp.chunk{i}.vcf' for i in range(vep_n_chunks)], logger)
+    chunk_vep_vcfs = [f'{prefix}.tmp.chunk{i}.vep.vcf.gz' for i in range(len(chunk_vcfs))]
+    vep_commands = [get_vep_command(vep_cache_dir, conf_options, chunk_vcf, chunk_vep_vcf, logger, debug, log_configuration = (i == 0))
+                    for i, (chunk_vcf, chunk_vep_vcf) in enumerate(zip(chunk_vcfs, chunk_vep_vcfs))]
+    logger.info(f'VEP configuration - number of parallel VEP processes (genomic chunks): {len(vep_commands)}')
+    if debug:
+        for vep_command in vep_commands:
+            print(vep_command)
+
+    vep_procs = [subprocess.Popen(vep_command, shell=True) for vep_command in vep_commands]
+    failed_chunks = [str(i) for i, vep_proc in enumerate(vep_procs) if vep_proc.wait() != 0]
+    if failed_chunks:
+        error_message(f'VEP exited with an error code for genomic chunk(s) {", ".join(failed_chunks)}', logger)
+
+    concat_vcf_shards(chunk_vep_vcfs, output_vcf, logger)
+    if not debug:
+        for fname in chunk_vcfs + chunk_vep_vcfs + [f'{f}_warnings.txt' for f in chunk_vep_vcfs]:
+            remove_file(fname)
+
+
+def run_vep_novel_sites(vep_cache_dir, conf_options, input_vcf, output_vcf, vep_store, vep_store_max_entries, logger, debug = False,
+                        vep_n_workers = 0, vep_n_chunks = 1):
+    """
+    Function that runs VEP only on variants that are not present in the VEP store (keyed by CHROM_POS_REF_ALT and the
+    VEP configuration scope), and merges cached and novel VEP annotations back into the record order of the input
+    VCF file. VEP annotations of novel variants are added to the store. The output VCF ('output_vcf') is bgzipped if it
+    ends with '.gz'
+    """
+    scope = get_vep_store_scope(conf_options)
+    prefix = re.sub(r'\.gz$', '', output_vcf)
+    novel_vcf = f'{prefix}.tmp.novel_sites.vcf'
+    novel_vep_vcf = f'{prefix}.tmp.novel_sites.vep.vcf.gz'
+    cached_sites_tsv = f'{prefix}.tmp.cached_sites.tsv'
+
+    logger.info(f'VEP store: {vep_store}')
+    num_cached, num_novel = split_cached_sites(input_vcf, vep_store, scope, novel_vcf, cached_sites_tsv, logger,
+                                               cache_label = 'VEP store')
+    novel_vep_output = None
+    ## VEP is also run when there are no records at all, i.e. to obtain the VEP header of an empty store
+    if num_novel > 0 or num_cached == 0:
+        annotate_vcf_with_vep(vep_cache_dir, conf_options, novel_vcf, novel_vep_vcf, logger, debug, vep_n_workers, vep_n_chunks)
+        novel_vep_output = novel_vep_vcf
+    else:
+        logger.info('VEP store: all variants have a stored VEP annotation - skipping VEP')
+
+    merge_cached_annotations(input_vcf, cached_sites_tsv, novel_vep_output, output_vcf, vep_store, scope, logger)
+    evict_cache_entries(vep_store, vep_store_max_entries, logger, cache_label = 'VEP store')
+    if not debug:
+        for fname in [novel_vcf, novel_vep_vcf, f'{novel_vep_vcf}_warnings.txt', cached_sites_tsv]:
+            remove_file(fname)
+
+
+def get_vep_command(vep_cache_dir, conf_options, input_vcf, output_vcf, logger, debug = False, log_configuration = True):
+    """
+    Function that composes the full VEP command for a given input/output VCF (input may be 'STDIN', output may be 'STDOUT',
+    output ending with '.gz' is bgzipped), and logs the VEP configuration in use (unless 'log_configuration' is False)
+    """
+    
     genome_assembly = conf_options['genome_assembly']
     
     fasta_assembly = os.path.join(
@@ -86,40 +210,46 @@ def run_vep(vep_cache_dir, conf_options, input_vcf, output_vcf, logger, debug =
     if conf_options['conf']['vep']['vep_gencode_basic'] is True:
         vep_options += ' --gencode_basic'
         gencode_set_in_use = "GENCODE - basic transcript set (--gencode_basic)"
+    ## CSQ output restricted to the fields consumed by gvanno
+    csq_fields_in_use = "all"
+    if not conf_options['conf']['vep'].get('vep_csq_fields') is None:
+        vep_options += f' --fields {",".join(conf_options["conf"]["vep"]["vep_csq_fields"])}'
+        csq_fields_in_use = f'{len(conf_options["conf"]["vep"]["vep_csq_fields"])} fields consumed by gvanno (--fields)'
 
     ## LOFTEE plugin - variant loss-of-function annotation        
     loftee_dir = get_loftee_dir()
     assert os.path.isdir(loftee_dir), f'LoF VEP plugin is not found in {loftee_dir}. Please make sure you installed pcgr conda package and have corresponding conda environment active.'
     vep_options += f" --plugin LoF,loftee_path:{loftee_dir},human_ancestor_fa:{ancestor_assembly},use_gerp_end_trunc:0 --dir_plugins {loftee_dir}"
 
-    logger.info(f'VEP configuration: Version: {gvanno_vars.VEP_VERSION}' + \
-                f', GENCODE release {gvanno_vars.GENCODE_VERSION[genome_assembly]}, genome assembly {conf_options["genome_assembly"]}')
-    logger.info(f'VEP configuration - one primary consequence block pr. alternative allele (--flag_pick_allele)')
-    logger.info(f'VEP configuration - transcript pick order: {conf_options["conf"]["vep"]["vep_pick_order"]}')
-    logger.info(f'VEP configuration - transcript pick order: See more at https://www.ensembl.org/info/docs/tools/vep/script/vep_other.html#pick_options')
-    logger.info(f'VEP configuration - GENCODE set: {gencode_set_in_use}')
-    logger.info(f'VEP configuration - skip intergenic variants: {"ON" if conf_options["conf"]["vep"]["vep_no_intergenic"] == 1 else "OFF"}')
-    logger.info(f'VEP configuration - regulatory variant annotation: {"ON" if conf_options["conf"]["vep"]["vep_regulatory"] == 1 else "OFF"}')
-    logger.info(f'VEP configuration - loss-of-function prediction: {"ON" if conf_options["conf"]["vep"]["vep_lof_prediction"] == 1 else "OFF"}')
-
-    logger.info((
-        f'VEP configuration - buffer size/number of forks: '
-        f'{conf_options["conf"]["vep"]["vep_buffer_size"]}/{conf_options["conf"]["vep"]["vep_n_forks"]}'))
-    logger.info(f'VEP - plugins in use: {plugins_in_use}')
-    
-    # Compose full VEP command
-    vep_main_command = f'vep --input_file {input_vcf} --output_file {output_vcf} {vep_options}'
-    vep_bgzip_command = f'bgzip -f -c {output_vcf} > {output_vcf_gz}'
-    vep_tabix_command = f'tabix -f -p vcf {output_vcf_gz}'
-    if debug:
-        print(vep_main_command)
+    if log_configuration:
+        logger.info(f'VEP configuration: Version: {gvanno_vars.VEP_VERSION}' + \
+                    f', GENCODE release {gvanno_vars.GENCODE_VERSION[genome_assembly]}, genome assembly {conf_options["genome_assembly"]}')
+        logger.info(f'VEP configuration - one primary consequence block pr. alternative allele (--flag_pick_allele)')
+        logger.info(f'VEP configuration - transcript pick order: {conf_options["conf"]["vep"]["vep_pick_order"]}')
+        logger.info(f'VEP configuration - transcript pick order: See more at https://www.ensembl.org/info/docs/tools/vep/script/vep_other.html#pick_options')
+        logger.info(f'VEP configuration - GENCODE set: {gencode_set_in_use}')
+        logger.info(f'VEP configuration - CSQ fields: {csq_fields_in_use}')
+        logger.info(f'VEP configuration - skip intergenic variants: {"ON" if conf_options["conf"]["vep"]["vep_no_intergenic"] == 1 else "OFF"}')
+        logger.info(f'VEP configuration - regulatory variant annotation: {"ON" if conf_options["conf"]["vep"]["vep_regulatory"] == 1 else "OFF"}')
+        logger.info(f'VEP configuration - loss-of-function prediction: {"ON" if conf_options["conf"]["vep"]["vep_lof_prediction"] == 1 else "OFF"}')
+
+        logger.info((
+            f'VEP configuration - buffer size/number of forks: '
+            f'{conf_options["conf"]["vep"]["vep_buffer_size"]}/{conf_options["conf"]["vep"]["vep_n_forks"]}'))
+        logger.info(f'VEP - plugins in use: {plugins_in_use}')
     
-    check_subprocess(logger, vep_main_command, debug)
-    check_subprocess(logger, vep_bgzip_command, debug)
-    check_subprocess(logger, vep_tabix_command, debug)
-    logger.info('Finished gvanno-vep')
+    ## VEP output streamed to stdout - keep warnings out of the VCF stream
+    if output_vcf == 'STDOUT':
+        vep_options += ' --warning_file STDERR'
+    ## VEP output compressed (BGZF) by VEP itself
+    elif output_vcf.endswith('.gz'):
+        vep_options += ' --compress_output bgzip'
+
+    # Compose full VEP command (VEP reads from stdin without --input_file)
+    vep_input = '' if input_vcf == 'STDIN' else f'--input_file {input_vcf} '
+    vep_main_command = f'vep {vep_input}--output_file {output_vcf} {vep_options}'
     
-    return 0
+    return vep_main_command
 
 if __name__=="__main__": __main__()
 
@@ -0,0 +1,660 @@
+#!/usr/bin/env python
+
+import argparse
+import concurrent.futures
+import copy
+import glob
+import multiprocessing
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+
+from cyvcf2 import VCF
+
+from lib.gvanno.utils import getlogger, check_subprocess, remove_file, error_message
+from lib.gvanno.vcf import get_vcf_info_tags, swap_vcf_info_header
+from lib.gvanno.annoutils import write_pass_vcf
+from lib.gvanno.shard import split_vcf_by_density, concat_vcf_shards
+from lib.gvanno.checkpoint import get_manifest_fname, step_is_complete, write_step_manifest
+from lib.gvanno.annotation_cache import get_cache_scope, split_cached_sites, merge_cached_annotations, evict_cache_entries
+from lib.gvanno.metrics import get_resource_usage, get_step_metrics, init_metrics, record_step_metrics, count_records
+from lib.gvanno.tuning import auto_tune_resources
+from lib.gvanno.gvanno_vars import VCF_SORT_MAX_MEMORY_MB
+from lib.gvanno.normalize import get_contig_rank
+from lib.gvanno.target import merge_off_target_records
+from lib.gvanno.vep import get_vep_csq_fields
+from gvanno_validate_input import validate_gvanno_input
+from gvanno_vep import run_vep, get_vep_command
+from gvanno_vcfanno import annotate_vcf, write_vcfanno_conf
+from gvanno_summarise import extend_vcf_annotations
+from gvanno_vcf2tsv import convert_vcf_to_tsv
+from gvanno_finalize import finalize_variant_set
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description='Run all steps of the gvanno workflow (validate, VEP, vcfanno, summarise, vcf2tsv, finalize) ' + \
+                                     'within a single container session')
+    parser.add_argument('gvanno_dir', help='Docker location of gvanno base directory with accompanying data directory, e.g. /data')
+    parser.add_argument('vep_cache_dir', help='Directory with VEP cache files')
+    parser.add_argument('input_vcf', help='VCF input file with query variants (SNVs/InDels)')
+    parser.add_argument('output_dir', help='Output directory')
+    parser.add_argument('genome_assembly', help='Genome assembly (grch37/grch38)')
+    parser.add_argument('sample_id', help='Sample identifier - prefix for output files')
+    add_workflow_arguments(parser)
+    args = parser.parse_args()
+
+    arg_dict = vars(args)
+    run_gvanno_workflow(arg_dict)
+
+
+def add_workflow_arguments(parser):
+    """
+    Function that adds the annotation options shared by gvanno-workflow and gvanno-batch to an argument parser
+    """
+    parser.add_argument('--vep_pick_order', default="mane_select,mane_plus_clinical,canonical,appris,biotype,ccds,rank,tsl,length",
+                        help=f"Comma-separated string of ordered transcript/variant properties for selection of primary variant consequence")
+    parser.add_argument('--vep_regulatory', action="store_true", help='Inclusion of VEP regulatory annotations')
+    parser.add_argument('--vep_buffer_size', default=500, type=int, help='Buffer size for VEP')
+    parser.add_argument('--vep_gencode_basic', action="store_true", help='Only consider basic GENCODE transcripts')
+    parser.add_argument('--vep_n_forks', default=4, type=int, help='Number of forks for VEP processing')
+    parser.add_argument('--vep_lof_prediction', action="store_true", help='Perform LoF prediction with the LOFTEE plugin in VEP')
+    parser.add_argument('--vep_coding_only', action="store_true", help="Only consider coding variants")
+    parser.add_argument('--vep_no_intergenic', action="store_true", help="Skip intergenic variants")
+    parser.add_argument('--vcfanno_n_processes', default=4, type=int, help="Number of processes for vcfanno processing")
+    parser.add_argument('--annotation_engine', choices=['vcfanno', 'native'], default='vcfanno', help="Engine for annotation against ClinVar/dbNSFP/" + \
+                        "GWAS/ncER/gene transcript tracks: vcfanno, or native (tabix-indexed merge-join, one process per track), default: %(default)s")
+    parser.add_argument('--vcfanno_per_track', action="store_true", help="Run a separate vcfanno process per annotation track (--vcfanno_n_processes " + \
+                        "shared by track size), merged onto the query records by ordinal (not with --streaming), default: %(default)s")
+    parser.add_argument('--oncogenicity_annotation', action="store_true", help='Classify variants according to oncogenicity')
+    parser.add_argument('--streaming', action="store_true", help="Connect VEP, vcfanno and summarise through pipes, i.e. without " + \
+                        "compressing/indexing intermediate VCF files")
+    parser.add_argument('--n_shards', default=1, type=int, help="Number of genomic chunks (balanced by variant density) that are annotated " + \
+                        "in parallel (VEP, vcfanno, summarise), each chunk uses --vep_n_forks/--vcfanno_n_processes, default: %(default)s")
+    parser.add_argument('--resume', action="store_true", help="Keep intermediate files and record a manifest (checksums of inputs/outputs, options " + \
+                        "and versions) for each workflow step, steps with a matching manifest are skipped on re-runs, default: %(default)s")
+    parser.add_argument('--annotation_cache', default=None, help="SQLite file with annotations of previously seen variants (shared across runs), " + \
+                        "only novel variants are annotated with VEP/vcfanno/summarise, default: %(default)s")
+    parser.add_argument('--annotation_cache_max_entries', default=5000000, type=int, help="Maximum number of variants in the annotation cache, " + \
+                        "least recently used variants are evicted, default: %(default)s")
+    parser.add_argument('--vep_n_workers', default=0, type=int, help="Number of warm VEP worker processes fed with batches of --vep_buffer_size " + \
+                        "records (0: a single VEP process per VCF file, not with --streaming), default: %(default)s")
+    parser.add_argument('--vep_n_chunks', default=1, type=int, help="Number of genomic chunks (balanced by variant count) that are annotated by " + \
+                        "independent VEP processes in parallel, each with --vep_n_forks forks (not with --streaming), default: %(default)s")
+    parser.add_argument('--vep_store', default=None, help="SQLite file with VEP annotations of previously seen variants (shared across runs), " + \
+                        "only novel variants are annotated with VEP (not with --streaming), default: %(default)s")
+    parser.add_argument('--vep_store_max_entries', default=5000000, type=int, help="Maximum number of variants in the VEP store, " + \
+                        "least recently used variants are evicted, default: %(default)s")
+    parser.add_argument('--auto_tune', action="store_true", help="Pick --vep_n_forks, --vep_buffer_size and --vcfanno_n_processes from the available " + \
+                        "CPUs/memory (cgroup-aware) and the number of query variants, default: %(default)s")
+    parser.add_argument('--sort_max_memory_mb', default=VCF_SORT_MAX_MEMORY_MB, type=int, help="Maximum memory (MB) for sorting unsorted query VCFs " + \
+                        "(sorted query VCFs are not re-sorted), default: %(default)s")
+    parser.add_argument('--target_bed', default=None, help="BED file with target regions (e.g. panel/exome), only query variants in " + \
+                        "target regions are annotated, default: %(default)s")
+    parser.add_argument('--target_padding', default=0, type=int, help="Padding (bp) added on each side of the target regions, default: %(default)s")
+    parser.add_argument('--keep_off_target', action="store_true", help="Pass off-target variants through to the output VCF/TSV without " + \
+                        "annotation (instead of skipping them), default: %(default)s")
+    parser.add_argument('--genotype_depth', action="store_true", help="Keep sample depth (DP) and allelic depths (AD) of the query VCF " + \
+                        "next to genotypes (GT), appended to the TSV output as SAMPLE_DP/SAMPLE_AD, default: %(default)s")
+    parser.add_argument('--metrics_record_counts', action="store_true", help="Count the records of all input/output files of each step for " + \
+                        "the metrics file (extra passes over these files), instead of taking record counts from step counters, default: %(default)s")
+    parser.add_argument("--debug", action="store_true", default=False, help="Print full commands to log and keep intermediate files, default: %(default)s")
+
+
+def get_workflow_files(output_dir, sample_id, genome_assembly):
+    """
+    Function that defines the names of all intermediate and final output files of the gvanno workflow
+    """
+    prefix = os.path.join(output_dir, f'{sample_id}_gvanno_{genome_assembly}')
+
+    workflow_files = {}
+    workflow_files['prefix'] = prefix
+    workflow_files['input_vcf_validated'] = f'{prefix}.gvanno_ready.vcf'
+    workflow_files['vep_vcf'] = f'{prefix}.vep.vcf'
+    workflow_files['vep_vcfanno_vcf'] = f'{prefix}.vep.vcfanno.vcf'
+    workflow_files['vep_vcfanno_summarised_vcf'] = f'{prefix}.vep.vcfanno.summarised.vcf'
+    workflow_files['vep_vcfanno_summarised_pass_vcf'] = f'{prefix}.vep.vcfanno.summarised.pass.vcf'
+    workflow_files['output_vcf'] = f'{prefix}.vcf.gz'
+    workflow_files['output_pass_vcf'] = f'{prefix}.pass.vcf.gz'
+    workflow_files['output_vcf2tsv'] = f'{prefix}.vcf2tsv.tsv'
+    workflow_files['output_pass_vcf2tsv'] = f'{prefix}.pass.vcf2tsv.tsv'
+    workflow_files['output_pass_tsv'] = f'{prefix}.pass.tsv.gz'
+    workflow_files['genotype_store'] = f'{prefix}.genotypes.npz'
+    workflow_files['off_target_vcf'] = f'{prefix}.off_target.vcf'
+    workflow_files['metrics'] = os.path.join(output_dir, f'{sample_id}_gvanno_metrics.json')
+
+    return workflow_files
+
+
+def get_conf_options(arg_dict):
+    """
+    Function that collects the VEP configuration (as used by gvanno-vep) from the workflow options
+    """
+    conf_options = {}
+    conf_options['sample_id'] = arg_dict['sample_id']
+    conf_options['genome_assembly'] = arg_dict['genome_assembly']
+    conf_options['conf'] = {}
+    conf_options['conf']['vep'] = {}
+    for vep_option in ['vep_n_forks', 'vep_pick_order', 'vep_buffer_size', 'vep_gencode_basic', 'vep_regulatory',
+                       'vep_lof_prediction', 'vep_no_intergenic', 'vep_coding_only']:
+        conf_options['conf']['vep'][vep_option] = arg_dict[vep_option]
+    conf_options['conf']['vep']['vep_csq_fields'] = \
+        get_vep_csq_fields(os.path.join(arg_dict['gvanno_dir'], 'data', arg_dict['genome_assembly'], 'vcf_infotags_vep.tsv'))
+    return conf_options
+
+
+def get_vcfanno_tracks():
+    vcfanno_tracks = {}
+    for track in ['gene_transcript_xref', 'gwas', 'dbnsfp', 'clinvar', 'ncer']:
+        vcfanno_tracks[track] = True
+    return vcfanno_tracks
+
+
+def get_summarise_args(arg_dict, workflow_files):
+    """
+    Function that collects the gvanno-summarise configuration from the workflow options
+    """
+    summarise_args = {}
+    summarise_args['vcf_file_in'] = f'{workflow_files["vep_vcfanno_vcf"]}.gz'
+    summarise_args['vcf_file_out'] = workflow_files['vep_vcfanno_summarised_vcf']
+    summarise_args['regulatory_annotation'] = int(arg_dict['vep_regulatory'])
+    summarise_args['oncogenicity_annotation'] = int(arg_dict['oncogenicity_annotation'])
+    summarise_args['vep_pick_order'] = arg_dict['vep_pick_order']
+    summarise_args['gvanno_db_dir'] = os.path.join(arg_dict['gvanno_dir'], 'data', arg_dict['genome_assembly'])
+    summarise_args['compress_output_vcf'] = True
+    summarise_args['debug'] = arg_dict['debug']
+    return summarise_args
+
+
+def add_counters(total_counters, counters):
+    for counter in counters:
+        total_counters[counter] = total_counters.get(counter, 0) + counters[counter]
+    return total_counters
+
+
+def remove_files(file_patterns):
+    """
+    Function that removes all files matching a list of glob patterns (i.e. 'rm -f <pattern>')
+    """
+    for pattern in file_patterns:
+        for fname in glob.glob(pattern):
+            remove_file(fname)
+
+
+def run_streaming_annotation(arg_dict, conf_options, workflow_files, vcfanno_tracks, summarise_args):
+    """
+    Function that runs VEP, vcfanno and gvanno-summarise as one streaming pipeline, i.e.
+    VEP (stdout) -> vcfanno (stdin/stdout) -> INFO header swap -> gvanno-summarise. 
+    No intermediate VCF files are written, only the final (summarised) VCF is compressed and indexed
+    """
+    debug = arg_dict['debug']
+    data_dir_assembly = os.path.join(arg_dict['gvanno_dir'], 'data', arg_dict['genome_assembly'])
+    vcfanno_conf_fname = f'{workflow_files["vep_vcfanno_vcf"]}.tmp.conf.toml'
+    vcfanno_log = f'{workflow_files["vep_vcfanno_vcf"]}.tmp.vcfanno.log'
+
+    print('----')
+    logger = getlogger("gvanno-streaming")
+    logger.info("gvanno - STEP 1-3: VEP, vcfanno and gvanno-summarise connected as a streaming pipeline")
+    if not arg_dict['vep_store'] is None:
+        logger.warning(f"VEP store {arg_dict['vep_store']} is not used in streaming mode, all variants are annotated with VEP")
+    if arg_dict['annotation_engine'] == 'native':
+        logger.warning("Native annotation engine is not used in streaming mode, variants are annotated with vcfanno")
+    if arg_dict['vcfanno_per_track']:
+        logger.warning("vcfanno runs per track are not used in streaming mode, all tracks are annotated in a single vcfanno run")
+    vep_command = get_vep_command(arg_dict['vep_cache_dir'], conf_options, workflow_files['input_vcf_validated'],
+                                  'STDOUT', logger, debug)
+
+    remove_file(vcfanno_conf_fname)
+    vcfanno_header_lines = []
+    query_info_tags = get_vcf_info_tags(workflow_files['input_vcf_validated'])
+    for tags_fname in write_vcfanno_conf(vcfanno_tracks, query_info_tags, data_dir_assembly, vcfanno_conf_fname, logger):
+        with open(tags_fname, 'r') as f:
+            vcfanno_header_lines.extend([line for line in f if line.strip() != ''])
+    vcfanno_command = f'vcfanno -p={arg_dict["vcfanno_n_processes"]} {vcfanno_conf_fname} /dev/stdin'
+    logger.info('vcfanno configuration - number of processes (-p): ' + str(arg_dict['vcfanno_n_processes']))
+    if debug:
+        logger.info(f'VEP command: {vep_command}')
+        logger.info(f'vcfanno command: {vcfanno_command}')
+
+    vcfanno_log_fh = open(vcfanno_log, 'w')
+    vep_proc = subprocess.Popen(vep_command, shell=True, stdout=subprocess.PIPE, start_new_session=True)
+    vcfanno_proc = subprocess.Popen(vcfanno_command, shell=True, stdin=vep_proc.stdout,
+                                    stdout=subprocess.PIPE, stderr=vcfanno_log_fh, start_new_session=True)
+    vep_proc.stdout.close()
+
+    ## swap the generic vcfanno INFO header lines with gvanno INFO descriptions while streaming into gvanno-summarise.
+    ## NOTE: this runs in a separate (forked) process, cyvcf2 does not release the GIL while it waits for input
+    read_fd, write_fd = os.pipe()
+    header_swap_out = os.fdopen(write_fd, 'wb')
+    header_swap = multiprocessing.Process(target=swap_vcf_info_header,
+                                          args=(vcfanno_proc.stdout, header_swap_out, vcfanno_header_lines))
+    header_swap.start()
+    header_swap_out.close()
+    vcfanno_proc.stdout.close()
+
+    try:
+        logger = getlogger("gvanno-summarise")
+        logger.info("Configuration - oncogenicity classification: " + str(int(arg_dict['oncogenicity_annotation'])))
+        summarise_args['vcf_file_in'] = read_fd
+        counters = extend_vcf_annotations(summarise_args, logger)
+    except BaseException:
+        for proc in [vep_proc, vcfanno_proc]:
+            if proc.poll() is None:
+                os.killpg(proc.pid, signal.SIGKILL)
+        header_swap.terminate()
+        raise
+    header_swap.join()
+    vcfanno_proc.wait()
+    vep_proc.wait()
+    vcfanno_log_fh.close()
+
+    logger = getlogger("gvanno-streaming")
+    if vep_proc.returncode != 0:
+        error_message(f'VEP exited with error code {vep_proc.returncode} in streaming mode', logger)
+    if vcfanno_proc.returncode != 0:
+        error_message(f'vcfanno exited with error code {vcfanno_proc.returncode} in streaming mode (see {vcfanno_log})', logger)
+    if not debug:
+        remove_file(vcfanno_conf_fname)
+        remove_file(vcfanno_log)
+    logger.info("Finished")
+    return counters
+
+
+def run_vep_step(arg_dict, conf_options, workflow_files):
+    """
+    Function that runs VEP (STEP 1) on the bgzipped, validated VCF file
+    """
+    print('----')
+    logger = getlogger("gvanno-run-vep")
+    logger.info("gvanno - STEP 1: Variant Effect Predictor (VEP)")
+    run_vep(arg_dict['vep_cache_dir'], conf_options, f'{workflow_files["input_vcf_validated"]}.gz',
+            workflow_files['vep_vcf'], logger, arg_dict['debug'], vep_store = arg_dict['vep_store'],
+            vep_store_max_entries = arg_dict['vep_store_max_entries'], vep_n_workers = arg_dict['vep_n_workers'],
+            vep_n_chunks = arg_dict['vep_n_chunks'])
+
+
+def run_vcfanno_step(arg_dict, workflow_files, vcfanno_tracks):
+    """
+    Function that runs vcfanno (STEP 2) on the VEP-annotated VCF file
+    """
+    data_dir_assembly = os.path.join(arg_dict['gvanno_dir'], 'data', arg_dict['genome_assembly'])
+    print("----")
+    logger = getlogger('gvanno-vcfanno')
+    logger.info("STEP 2: Clinical/functional variant annotations with gvanno-vcfanno (Clinvar, ncER, dbNSFP, GWAS catalog)")
+    logger.info('vcfanno configuration - number of processes (-p): ' + str(arg_dict['vcfanno_n_processes']))
+    annotate_vcf(f'{workflow_files["vep_vcf"]}.gz', workflow_files['vep_vcfanno_vcf'], data_dir_assembly,
+                 vcfanno_tracks, arg_dict['vcfanno_n_processes'], arg_dict['debug'], logger,
+                 annotation_engine = arg_dict['annotation_engine'], vcfanno_per_track = arg_dict['vcfanno_per_track'])
+    logger.info("Finished")
+
+
+def run_summarise_step(arg_dict, summarise_args):
+    """
+    Function that runs gvanno-summarise (STEP 3) on the VEP/vcfanno-annotated VCF file
+    """
+    print("----")
+    logger = getlogger("gvanno-summarise")
+    logger.info("STEP 3: Summarise gene and variant annotations with gvanno-summarise")
+    logger.info("Configuration - oncogenicity classification: " + str(int(arg_dict['oncogenicity_annotation'])))
+    counters = extend_vcf_annotations(summarise_args, logger)
+    logger.info("Finished")
+    return counters
+
+
+def run_file_annotation(arg_dict, conf_options, workflow_files, vcfanno_tracks, summarise_args):
+    """
+    Function that runs VEP, vcfanno and gvanno-summarise one after the other, with bgzipped
+    and indexed intermediate VCF files
+    """
+    run_vep_step(arg_dict, conf_options, workflow_files)
+    run_vcfanno_step(arg_dict, workflow_files, vcfanno_tracks)
+    return run_summarise_step(arg_dict, summarise_args)
+
+
+def run_annotation(arg_dict, conf_options, workflow_files, vcfanno_tracks, summarise_args):
+    """
+    Function that runs VEP, vcfanno and gvanno-summarise for a validated VCF file, either as a
+    streaming pipeline or with intermediate files. Returns the gvanno-summarise counters
+    """
+    if arg_dict['streaming']:
+        return run_streaming_annotation(arg_dict, conf_options, workflow_files, vcfanno_tracks, summarise_args)
+    return run_file_annotation(arg_dict, conf_options, workflow_files, vcfanno_tracks, summarise_args)
+
+
+def run_shard_annotation(arg_dict, conf_options, shard_files, vcfanno_tracks, summarise_args):
+    """
+    Function that annotates a single genomic chunk (run in a worker process), the summarised VCF
+    of the chunk is left uncompressed. Returns the summarised VCF and the gvanno-summarise counters of the chunk
+    """
+    if not arg_dict['streaming']:
+        logger = getlogger("gvanno-shard")
+        check_subprocess(logger, f'bgzip -f {shard_files["input_vcf_validated"]}', arg_dict['debug'])
+        check_subprocess(logger, f'tabix -f -p vcf {shard_files["input_vcf_validated"]}.gz', arg_dict['debug'])
+    ## chunks are never checkpointed individually
+    shard_arg_dict = copy.deepcopy(arg_dict)
+    shard_arg_dict['resume'] = False
+    shard_summarise_args = copy.deepcopy(summarise_args)
+    shard_summarise_args['vcf_file_in'] = f'{shard_files["vep_vcfanno_vcf"]}.gz'
+    shard_summarise_args['vcf_file_out'] = shard_files['vep_vcfanno_summarised_vcf']
+    shard_summarise_args['compress_output_vcf'] = False
+    counters = run_annotation(shard_arg_dict, conf_options, shard_files, vcfanno_tracks, shard_summarise_args)
+    return shard_files['vep_vcfanno_summarised_vcf'], counters
+
+
+def run_sharded_annotation(arg_dict, conf_options, workflow_files, vcfanno_tracks, summarise_args):
+    """
+    Function that splits the validated VCF file into genomic chunks of similar variant density, runs
+    VEP, vcfanno and gvanno-summarise for all chunks in a pool of worker processes, and concatenates
+    the summarised chunks (in coordinate order) into a single bgzipped and indexed VCF file
+    """
+    debug = arg_dict['debug']
+    print('----')
+    logger = getlogger("gvanno-shard")
+    logger.info(f"gvanno - STEP 1-3: VEP, vcfanno and gvanno-summarise across {arg_dict['n_shards']} genomic chunks in parallel")
+
+    all_shard_files = []
+    for i in range(arg_dict['n_shards']):
+        all_shard_files.append(get_workflow_files(arg_dict['output_dir'], f'{arg_dict["sample_id"]}.shard{i}', arg_dict['genome_assembly']))
+    shard_vcfs = split_vcf_by_density(workflow_files['input_vcf_validated'], [f['input_vcf_validated'] for f in all_shard_files], logger)
+    all_shard_files = all_shard_files[:len(shard_vcfs)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(all_shard_files)) as executor:
+        shard_jobs = [executor.submit(run_shard_annotation, arg_dict, conf_options, shard_files, vcfanno_tracks, summarise_args)
+                      for shard_files in all_shard_files]
+        shard_results = [job.result() for job in shard_jobs]
+    summarised_shard_vcfs = [shard_vcf for shard_vcf, shard_counters in shard_results]
+    counters = {}
+    for shard_vcf, shard_counters in shard_results:
+        add_counters(counters, shard_counters)
+
+    concat_vcf_shards(summarised_shard_vcfs, workflow_files['vep_vcfanno_summarised_vcf'], logger)
+    check_subprocess(logger, f'bgzip -f {workflow_files["vep_vcfanno_summarised_vcf"]}', debug)
+    check_subprocess(logger, f'tabix -f -p vcf {workflow_files["vep_vcfanno_summarised_vcf"]}.gz', debug)
+    write_pass_vcf(f'{workflow_files["vep_vcfanno_summarised_vcf"]}.gz', logger)
+    if not debug:
+        remove_files([re.sub(r'\.gvanno_ready\.vcf$', '*', shard_files['input_vcf_validated']) for shard_files in all_shard_files])
+    logger.info("Finished")
+    return counters
+
+
+def run_cached_annotation(arg_dict, conf_options, workflow_files, vcfanno_tracks, summarise_args):
+    """
+    Function that annotates a validated VCF file through the persistent annotation cache: variants with a cached
+    annotation payload (same versions and annotation options) are split off, only novel variants are annotated
+    (VEP, vcfanno, gvanno-summarise), and cached payloads are merged back in coordinate order. Annotations of
+    novel variants are added to the cache. The merged VCF is bgzipped and indexed
+    """
+    debug = arg_dict['debug']
+    data_dir_assembly = os.path.join(arg_dict['gvanno_dir'], 'data', arg_dict['genome_assembly'])
+    print('----')
+    logger = getlogger("gvanno-annotation-cache")
+    logger.info(f"gvanno - STEP 1-3: VEP, vcfanno and gvanno-summarise for variants not present in annotation cache {arg_dict['annotation_cache']}")
+    scope = get_cache_scope(arg_dict, conf_options, data_dir_assembly)
+
+    novel_arg_dict = copy.deepcopy(arg_dict)
+    novel_arg_dict['sample_id'] = f'{arg_dict["sample_id"]}.novel'
+    novel_files = get_workflow_files(arg_dict['output_dir'], novel_arg_dict['sample_id'], arg_dict['genome_assembly'])
+    cached_sites_tsv = f'{novel_files["prefix"]}.cached_sites.tsv'
+    num_cached, num_novel = split_cached_sites(workflow_files['input_vcf_validated'], arg_dict['annotation_cache'], scope,
+                                   novel_files['input_vcf_validated'], cached_sites_tsv, logger)
+
+    counters = {'annotation_cache_hits': num_cached, 'annotation_cache_misses': num_novel}
+    novel_summarised_vcf = None
+    if num_novel > 0:
+        novel_summarise_args = get_summarise_args(novel_arg_dict, novel_files)
+        if arg_dict['n_shards'] > 1:
+            add_counters(counters, run_sharded_annotation(novel_arg_dict, conf_options, novel_files, vcfanno_tracks, novel_summarise_args))
+        else:
+            if not arg_dict['streaming']:
+                check_subprocess(logger, f'bgzip -f {novel_files["input_vcf_validated"]}', debug)
+                check_subprocess(logger, f'tabix -f -p vcf {novel_files["input_vcf_validated"]}.gz', debug)
+            add_counters(counters, run_annotation(novel_arg_dict, conf_options, novel_files, vcfanno_tracks, novel_summarise_args))
+        novel_summarised_vcf = f'{novel_files["vep_vcfanno_summarised_vcf"]}.gz'
+
+    ## cached records are passed through with their cached annotation
+    counters['records_in'] = num_cached + counters.get('records_in', 0)
+    counters['records_out'] = num_cached + counters.get('records_out', 0)
+    logger = getlogger("gvanno-annotation-cache")
+    merge_cached_annotations(workflow_files['input_vcf_validated'], cached_sites_tsv, novel_summarised_vcf,
+                             workflow_files['vep_vcfanno_summarised_vcf'], arg_dict['annotation_cache'], scope, logger)
+    evict_cache_entries(arg_dict['annotation_cache'], arg_dict['annotation_cache_max_entries'], logger)
+    check_subprocess(logger, f'bgzip -f {workflow_files["vep_vcfanno_summarised_vcf"]}', debug)
+    check_subprocess(logger, f'tabix -f -p vcf {workflow_files["vep_vcfanno_summarised_vcf"]}.gz', debug)
+    write_pass_vcf(f'{workflow_files["vep_vcfanno_summarised_vcf"]}.gz', logger)
+    if not debug:
+        remove_files([re.sub(r'\.gvanno_ready\.vcf$', '*', novel_files['input_vcf_validated'])])
+    logger.info("Finished")
+    return counters
+
+
+def checkpoint_is_valid(arg_dict, workflow_files, step, input_files, options, output_files):
+    """
+    Function that checks (with --resume only) whether a workflow step can be skipped
+    """
+    if not arg_dict['resume']:
+        return False
+    logger = getlogger("gvanno-checkpoint")
+    data_dir_assembly = os.path.join(arg_dict['gvanno_dir'], 'data', arg_dict['genome_assembly'])
+    return step_is_complete(get_manifest_fname(workflow_files['prefix'], step), step, input_files, options,
+                            output_files, data_dir_assembly, logger)
+
+
+def record_checkpoint(arg_dict, workflow_files, step, input_files, options, output_files):
+    """
+    Function that records (with --resume only) the manifest of a completed workflow step
+    """
+    if not arg_dict['resume']:
+        return
+    data_dir_assembly = os.path.join(arg_dict['gvanno_dir'], 'data', arg_dict['genome_assembly'])
+    write_step_manifest(get_manifest_fname(workflow_files['prefix'], step), step, input_files, options,
+                        output_files, data_dir_assembly)
+
+
+def record_metrics(workflow_files, step, start_usage, input_files, output_files, counters = None):
+    """
+    Function that records the metrics of a workflow step (start_usage = None for steps skipped through a checkpoint)
+    """
+    if start_usage is None:
+        record_step_metrics(workflow_files['metrics'], step, {'skipped': True})
+    else:
+        record_step_metrics(workflow_files['metrics'], step, get_step_metrics(start_usage, input_files, output_files, counters))
+
+
+def add_off_target_records(workflow_files):
+    """
+    Function that passes off-target variants (--keep_off_target) through to the summarised VCF files (all/PASS variants)
+    without annotation
+    """
+    logger = getlogger("gvanno-target")
+    summarised_vcf = workflow_files['vep_vcfanno_summarised_vcf']
+    vcf = VCF(f'{summarised_vcf}.gz')
+    contig_rank = get_contig_rank(vcf.raw_header.split('\n'))
+    vcf.close()
+    merge_off_target_records(f'{summarised_vcf}.gz', workflow_files['off_target_vcf'], summarised_vcf, contig_rank, logger)
+    check_subprocess(logger, f'bgzip -f {summarised_vcf}', False)
+    check_subprocess(logger, f'tabix -f -p vcf {summarised_vcf}.gz', False)
+    write_pass_vcf(f'{summarised_vcf}.gz', logger)
+
+
+def move_summarised_output(workflow_files):
+    """
+    Function that moves the summarised VCF files (all/PASS variants) to their final output location, after
+    adding off-target variants (if any)
+    """
+    if os.path.exists(workflow_files['off_target_vcf']):
+        add_off_target_records(workflow_files)
+    shutil.move(f'{workflow_files["vep_vcfanno_summarised_vcf"]}.gz', workflow_files['output_vcf'])
+    shutil.move(f'{workflow_files["vep_vcfanno_summarised_vcf"]}.gz.tbi', f'{workflow_files["output_vcf"]}.tbi')
+    shutil.move(f'{workflow_files["vep_vcfanno_summarised_pass_vcf"]}.gz', workflow_files['output_pass_vcf'])
+    shutil.move(f'{workflow_files["vep_vcfanno_summarised_pass_vcf"]}.gz.tbi', f'{workflow_files["output_pass_vcf"]}.tbi')
+
+
+def run_output_conversion(arg_dict, workflow_files, keep_intermediate_files):
+    """
+    Function that converts the summarised VCF files of a sample to TSV (STEP 4), and appends ClinVar traits,
+    official gene names and protein domain annotations to the TSV of PASS variants (STEP 5)
+    """
+    data_dir_assembly = os.path.join(arg_dict['gvanno_dir'], 'data', arg_dict['genome_assembly'])
+
+    ## gvanno|vcf2tsv - convert VCF to TSV (PASS and non-PASS variants, PASS variants only) in a single pass
+    vcf2tsv_files = [f'{workflow_files["output_vcf2tsv"]}.gz', f'{workflow_files["output_pass_vcf2tsv"]}.gz']
+    start_usage = None
+    if not checkpoint_is_valid(arg_dict, workflow_files, 'vcf2tsv', [workflow_files['output_vcf']], {}, vcf2tsv_files):
+        start_usage = get_resource_usage(arg_dict['metrics_record_counts'])
+        print("----")
+        logger = getlogger("gvanno-vcf2tsv")
+        logger.info("STEP 4: Converting genomic VCF to TSV - PASS and non-PASS variants, and PASS variants only")
+        convert_vcf_to_tsv(workflow_files['output_vcf'], f'{workflow_files["output_pass_vcf2tsv"]}.gz',
+                           f'{workflow_files["output_vcf2tsv"]}.gz', logger)
+        logger.info("Finished")
+        record_checkpoint(arg_dict, workflow_files, 'vcf2tsv', [workflow_files['output_vcf']], {}, vcf2tsv_files)
+    record_metrics(workflow_files, 'vcf2tsv', start_usage, [workflow_files['output_vcf']], vcf2tsv_files)
+
+    ## gvanno|finalize - append ClinVar traits, official gene names, and protein domain annotations
+    finalize_input = [f'{workflow_files["output_pass_vcf2tsv"]}.gz']
+    genotype_store = workflow_files['genotype_store'] if os.path.exists(workflow_files['genotype_store']) else None
+    if not genotype_store is None:
+        finalize_input.append(genotype_store)
+    start_usage = None
+    if not checkpoint_is_valid(arg_dict, workflow_files, 'finalize', finalize_input, {}, [workflow_files['output_pass_tsv']]):
+        start_usage = get_resource_usage(arg_dict['metrics_record_counts'])
+        print("----")
+        logger = getlogger("gvanno-finalize")
+        logger.info("STEP 5: Appending ClinVar traits, official gene names, and protein domain annotations")
+        finalize_variant_set(data_dir_assembly, f'{workflow_files["output_pass_vcf2tsv"]}.gz', workflow_files['output_pass_tsv'],
+                             arg_dict['genome_assembly'], arg_dict['sample_id'], logger, genotype_store = genotype_store)
+        logger.info("Finished")
+        record_checkpoint(arg_dict, workflow_files, 'finalize', finalize_input, {}, [workflow_files['output_pass_tsv']])
+    record_metrics(workflow_files, 'finalize', start_usage, finalize_input, [workflow_files['output_pass_tsv']])
+    if not keep_intermediate_files:
+        remove_files([f'{workflow_files["output_pass_vcf2tsv"]}*', f'{workflow_files["output_vcf2tsv"]}*', workflow_files['genotype_store']])
+
+
+def run_gvanno_workflow(arg_dict):
+    """
+    Function that runs all steps of the gvanno workflow in the current process, i.e.
+    without launching a new container for each individual step, move or clean-up.
+
+    With 'resume', each step records a manifest (checksums of input and output files, step options and
+    software/database versions), and steps with a matching manifest are skipped, i.e. the workflow resumes at the
+    first invalidated step. VEP and vcfanno output can thus be re-used when only gvanno-summarise options change
+    (not with 'streaming', 'n_shards' > 1 or 'annotation_cache', where VEP, vcfanno and gvanno-summarise form a single step).
+
+    Metrics of each step (wall time, CPU time, peak RSS, record counts, file sizes, throughput) are written
+    to '<sample_id>_gvanno_metrics.json' in the output directory
+    """
+    debug = arg_dict['debug']
+    keep_intermediate_files = debug or arg_dict['resume']
+    workflow_files = get_workflow_files(arg_dict['output_dir'], arg_dict['sample_id'], arg_dict['genome_assembly'])
+    fused_annotation = arg_dict['streaming'] or arg_dict['n_shards'] > 1 or not arg_dict['annotation_cache'] is None
+    init_metrics(workflow_files['metrics'], arg_dict['sample_id'], arg_dict['genome_assembly'])
+
+    ## options that may change the output of each step (i.e. not number of forks/processes)
+    step_options = {}
+    step_options['validate'] = {'genome_assembly': arg_dict['genome_assembly'], 'compress_output': not fused_annotation,
+                                'genotype_depth': arg_dict['genotype_depth'], 'target_padding': arg_dict['target_padding'],
+                                'keep_off_target': arg_dict['keep_off_target']}
+    step_options['summarise'] = {'vep_regulatory': arg_dict['vep_regulatory'], 'vep_pick_order': arg_dict['vep_pick_order'],
+                                 'oncogenicity_annotation': arg_dict['oncogenicity_annotation'], 'keep_off_target': arg_dict['keep_off_target']}
+
+    ## gvanno|validate_input - verify that VCF is of appropriate format
+    validated_vcf = workflow_files['input_vcf_validated'] if fused_annotation else f'{workflow_files["input_vcf_validated"]}.gz'
+    validate_input = [arg_dict['input_vcf']] if arg_dict['target_bed'] is None else [arg_dict['input_vcf'], arg_dict['target_bed']]
+    validate_output = [validated_vcf, workflow_files['off_target_vcf']] if arg_dict['keep_off_target'] else [validated_vcf]
+    ## sample data of the input VCF is kept in the genotype store (written by gvanno-validate-input)
+    if len(VCF(arg_dict['input_vcf']).samples) > 0:
+        validate_output.append(workflow_files['genotype_store'])
+    start_usage = None
+    if not checkpoint_is_valid(arg_dict, workflow_files, 'validate', validate_input, step_options['validate'], validate_output):
+        start_usage = get_resource_usage(arg_dict['metrics_record_counts'])
+        remove_file(workflow_files['off_target_vcf'])
+        logger = getlogger("gvanno-validate-input")
+        print('')
+        logger.info("gvanno - STEP 0: Validate input data and options")
+        ret = validate_gvanno_input(arg_dict['gvanno_dir'], arg_dict['input_vcf'], workflow_files['input_vcf_validated'],
+                                    arg_dict['sample_id'], arg_dict['genome_assembly'], arg_dict['output_dir'], debug,
+                                    compress_output = not fused_annotation, sort_max_memory_mb = arg_dict['sort_max_memory_mb'],
+                                    genotype_store = workflow_files['genotype_store'], genotype_depth = arg_dict['genotype_depth'],
+                                    target_bed = arg_dict['target_bed'], target_padding = arg_dict['target_padding'],
+                                    off_target_vcf = workflow_files['off_target_vcf'] if arg_dict['keep_off_target'] else None)
+        if ret != 0:
+            sys.exit(-1)
+        logger.info('Finished gvanno-validate-input')
+        record_checkpoint(arg_dict, workflow_files, 'validate', validate_input, step_options['validate'], validate_output)
+    record_metrics(workflow_files, 'validate', start_usage, validate_input, validate_output)
+
+    if arg_dict['auto_tune']:
+        arg_dict.update(auto_tune_resources(count_records(validated_vcf), arg_dict['n_shards'], arg_dict['vep_n_chunks'], arg_dict['vep_n_workers'],
+                                            arg_dict['streaming'], getlogger('gvanno-auto-tune')))
+    conf_options = get_conf_options(arg_dict)
+    step_options['vep'] = {}
+    for vep_option in ['vep_pick_order', 'vep_gencode_basic', 'vep_regulatory', 'vep_lof_prediction', 'vep_no_intergenic',
+                       'vep_coding_only', 'vep_csq_fields']:
+        step_options['vep'][vep_option] = conf_options['conf']['vep'][vep_option]
+    vcfanno_tracks = get_vcfanno_tracks()
+    step_options['vcfanno'] = dict(vcfanno_tracks)
+    step_options['vcfanno']['annotation_engine'] = arg_dict['annotation_engine']
+    summarise_args = get_summarise_args(arg_dict, workflow_files)
+
+    summarised_vcfs = [workflow_files['output_vcf'], workflow_files['output_pass_vcf']]
+    ## off-target variants (--keep_off_target) are merged into the summarised VCF files
+    off_target_input = [workflow_files['off_target_vcf']] if arg_dict['keep_off_target'] else []
+    if fused_annotation:
+        annotate_options = {}
+        for step in ['vep', 'vcfanno', 'summarise']:
+            annotate_options[step] = step_options[step]
+        annotate_input = [validated_vcf] + off_target_input
+        start_usage = None
+        counters = None
+        if not checkpoint_is_valid(arg_dict, workflow_files, 'annotate', annotate_input, annotate_options, summarised_vcfs):
+            start_usage = get_resource_usage(arg_dict['metrics_record_counts'])
+            if not arg_dict['annotation_cache'] is None:
+                counters = run_cached_annotation(arg_dict, conf_options, workflow_files, vcfanno_tracks, summarise_args)
+            elif arg_dict['n_shards'] > 1:
+                counters = run_sharded_annotation(arg_dict, conf_options, workflow_files, vcfanno_tracks, summarise_args)
+            else:
+                counters = run_streaming_annotation(arg_dict, conf_options, workflow_files, vcfanno_tracks, summarise_args)
+            move_summarised_output(workflow_files)
+            record_checkpoint(arg_dict, workflow_files, 'annotate', annotate_input, annotate_options, summarised_vcfs)
+        record_metrics(workflow_files, 'annotate', start_usage, annotate_input, summarised_vcfs[:1], counters)
+    else:
+        vep_vcf = f'{workflow_files["vep_vcf"]}.gz'
+        vep_vcfanno_vcf = f'{workflow_files["vep_vcfanno_vcf"]}.gz'
+        start_usage = None
+        if not checkpoint_is_valid(arg_dict, workflow_files, 'vep', [validated_vcf], step_options['vep'], [vep_vcf]):
+            start_usage = get_resource_usage(arg_dict['metrics_record_counts'])
+            run_vep_step(arg_dict, conf_options, workflow_files)
+            record_checkpoint(arg_dict, workflow_files, 'vep', [validated_vcf], step_options['vep'], [vep_vcf])
+        record_metrics(workflow_files, 'vep', start_usage, [validated_vcf], [vep_vcf])
+        start_usage = None
+        if not checkpoint_is_valid(arg_dict, workflow_files, 'vcfanno', [vep_vcf], step_options['vcfanno'], [vep_vcfanno_vcf]):
+            start_usage = get_resource_usage(arg_dict['metrics_record_counts'])
+            run_vcfanno_step(arg_dict, workflow_files, vcfanno_tracks)
+            record_checkpoint(arg_dict, workflow_files, 'vcfanno', [vep_vcf], step_options['vcfanno'], [vep_vcfanno_vcf])
+        record_metrics(workflow_files, 'vcfanno', start_usage, [vep_vcf], [vep_vcfanno_vcf])
+        summarise_input = [vep_vcfanno_vcf] + off_target_input
+        start_usage = None
+        counters = None
+        if not checkpoint_is_valid(arg_dict, workflow_files, 'summarise', summarise_input, step_options['summarise'], summarised_vcfs):
+            start_usage = get_resource_usage(arg_dict['metrics_record_counts'])
+            counters = run_summarise_step(arg_dict, summarise_args)
+            move_summarised_output(workflow_files)
+            record_checkpoint(arg_dict, workflow_files, 'summarise', summarise_input, step_options['summarise'], summarised_vcfs)
+        record_metrics(workflow_files, 'summarise', start_usage, summarise_input, summarised_vcfs[:1], counters)
+
+    ## gvanno|clean - clean up temporary files (with --resume, only files that are not checkpointed)
+    if not keep_intermediate_files:
+        remove_files([f'{workflow_files["vep_vcf"]}*', workflow_files['vep_vcfanno_summarised_vcf'],
+                      f'{workflow_files["vep_vcfanno_summarised_pass_vcf"]}*', f'{workflow_files["vep_vcfanno_vcf"]}*',
+                      f'{workflow_files["input_vcf_validated"]}*', workflow_files['off_target_vcf']])
+    elif not debug:
+        remove_files([workflow_files['vep_vcf'], workflow_files['vep_vcfanno_summarised_vcf'],
+                      f'{workflow_files["vep_vcfanno_summarised_pass_vcf"]}*', f'{workflow_files["vep_vcfanno_vcf"]}.tmp*'])
+
+    run_output_conversion(arg_dict, workflow_files, keep_intermediate_files)
+
+
+if __name__ == "__main__":
+    __main__()
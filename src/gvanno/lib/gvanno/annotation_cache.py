@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import sqlite3
+import time
+
+from lib.gvanno.shard import open_vcf_text, open_vcf_output
+from lib.gvanno.batch import get_info_header_id
+from lib.gvanno.checkpoint import get_software_versions
+from lib.gvanno import gvanno_vars
+
+## number of variants that are looked up/inserted per SQL statement
+CACHE_CHUNK_SIZE = 500
+
+## VEP/gvanno-summarise options that change the annotation payload of a variant
+CACHE_SCOPE_OPTIONS = ['genome_assembly', 'vep_pick_order', 'vep_gencode_basic', 'vep_regulatory', 'vep_lof_prediction',
+                       'vep_no_intergenic', 'vep_coding_only', 'vep_csq_fields', 'oncogenicity_annotation']
+
+## VEP options that change the VEP annotation (CSQ) of a variant, i.e. the scope of the VEP stage store
+VEP_STORE_SCOPE_OPTIONS = ['vep_pick_order', 'vep_gencode_basic', 'vep_regulatory', 'vep_lof_prediction',
+                           'vep_no_intergenic', 'vep_coding_only', 'vep_csq_fields']
+
+
+def get_cache_scope(arg_dict, conf_options, gvanno_db_dir):
+    """
+    Function that returns the scope of cache entries, i.e. a checksum of software/database versions
+    (DB_VERSION, VEP_VERSION etc.) and all options that affect the annotation payload of a variant
+    (workflow options, or the VEP configuration for options that are not set on the command line)
+    """
+    scope = {}
+    scope['versions'] = get_software_versions(gvanno_db_dir)
+    for option in CACHE_SCOPE_OPTIONS:
+        scope[option] = arg_dict[option] if option in arg_dict else conf_options['conf']['vep'][option]
+    return hashlib.sha256(json.dumps(scope, sort_keys = True).encode()).hexdigest()
+
+
+def get_vep_store_scope(conf_options):
+    """
+    Function that returns the scope of VEP store entries, i.e. a checksum of the VEP (cache) version, GENCODE release,
+    genome assembly and all VEP options that affect the VEP annotation (CSQ) of a variant
+    """
+    genome_assembly = conf_options['genome_assembly']
+    scope = {}
+    scope['vep_version'] = gvanno_vars.VEP_VERSION
+    scope['gencode_version'] = gvanno_vars.GENCODE_VERSION[genome_assembly]
+    scope['vep_assembly'] = gvanno_vars.VEP_ASSEMBLY[genome_assembly]
+    for option in VEP_STORE_SCOPE_OPTIONS:
+        scope[option] = conf_options['conf']['vep'].get(option)
+    return hashlib.sha256(json.dumps(scope, sort_keys = True).encode()).hexdigest()
+
+
+def get_variant_key(fields):
+    """
+    Function that returns the cache key (CHROM_POS_REF_ALT) of a (split) VCF record
+    """
+    chrom = fields[0][3:] if fields[0].startswith('chr') else fields[0]
+    return f'{chrom}_{fields[1]}_{fields[3]}_{fields[4]}'
+
+
+def open_annotation_cache(cache_fname):
+    """
+    Function that opens (and initializes) the annotation cache, an SQLite database in WAL mode, i.e. any number of
+    concurrent readers (workflow runs) and one writer at a time (other writers wait for the lock)
+    """
+    conn = sqlite3.connect(cache_fname, timeout = 600)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS annotation (scope TEXT NOT NULL, variant_key TEXT NOT NULL, '
+                     'info TEXT NOT NULL, last_access INTEGER NOT NULL, PRIMARY KEY (scope, variant_key))')
+        conn.execute('CREATE INDEX IF NOT EXISTS annotation_last_access ON annotation (last_access)')
+        conn.execute('CREATE TABLE IF NOT EXISTS header (scope TEXT PRIMARY KEY, header_lines TEXT NOT NULL)')
+    return conn
+
+
+def get_cached_header_lines(conn, scope):
+    row = conn.execute('SELECT header_lines FROM header WHERE scope = ?', (scope,)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+
+def lookup_cached_annotations(conn, scope, variant_keys):
+    """
+    Function that looks up the cached INFO payloads of a chunk of variants, and marks them as recently used
+    """
+    cached_annotations = {}
+    unique_keys = list(set(variant_keys))
+    for i in range(0, len(unique_keys), CACHE_CHUNK_SIZE):
+        chunk = unique_keys[i:i + CACHE_CHUNK_SIZE]
+        query = f'SELECT variant_key, info FROM annotation WHERE scope = ? AND variant_key IN ({",".join("?" * len(chunk))})'
+        for variant_key, info in conn.execute(query, [scope] + chunk):
+            cached_annotations[variant_key] = info
+    hit_keys = list(cached_annotations.keys())
+    if hit_keys:
+        with conn:
+            for i in range(0, len(hit_keys), CACHE_CHUNK_SIZE):
+                chunk = hit_keys[i:i + CACHE_CHUNK_SIZE]
+                conn.execute(f'UPDATE annotation SET last_access = ? WHERE scope = ? AND variant_key IN ({",".join("?" * len(chunk))})',
+                             [int(time.time()), scope] + chunk)
+    return cached_annotations
+
+
+def split_cached_sites(validated_vcf, cache_fname, scope, novel_vcf, cached_sites_tsv, logger, cache_label = 'Annotation cache'):
+    """
+    Function that splits a validated VCF file into records with a cached annotation payload (written in
+    record order to 'cached_sites_tsv', i.e. '<CHROM_POS_REF_ALT> <payload>'), and novel records (written to 'novel_vcf',
+    with the header of the validated VCF). Returns the number of cached and novel records
+    """
+    conn = open_annotation_cache(cache_fname)
+    use_cache = not get_cached_header_lines(conn, scope) is None
+    num_cached = 0
+    num_novel = 0
+
+    def write_chunk(chunk):
+        nonlocal num_cached, num_novel
+        keys = [get_variant_key(line.split('\t', 5)) for line in chunk]
+        cached_annotations = lookup_cached_annotations(conn, scope, keys) if use_cache else {}
+        for key, line in zip(keys, chunk):
+            if key in cached_annotations:
+                cached_out.write(f'{key}\t{cached_annotations[key]}\n')
+                num_cached += 1
+            else:
+                novel_out.write(line)
+                num_novel += 1
+
+    chunk = []
+    with open_vcf_text(validated_vcf) as f, open(novel_vcf, 'w') as novel_out, open(cached_sites_tsv, 'w') as cached_out:
+        for line in f:
+            if line.startswith('#'):
+                novel_out.write(line)
+                continue
+            chunk.append(line)
+            if len(chunk) == 10 * CACHE_CHUNK_SIZE:
+                write_chunk(chunk)
+                chunk = []
+        write_chunk(chunk)
+    conn.close()
+
+    logger.info(f'{cache_label}: {num_cached} variants with a cached annotation, {num_novel} novel variants')
+    return num_cached, num_novel
+
+
+def get_annotation_payload(info, sample_info_tags):
+    """
+    Function that extracts the annotation payload from the INFO column of an annotated record, i.e. all
+    INFO elements that are not present in the query VCF
+    """
+    payload = [e for e in info.split(';') if not e.split('=')[0] in sample_info_tags]
+    return ';'.join(payload) if payload else '.'
+
+
+def merge_cached_annotations(validated_vcf, cached_sites_tsv, novel_summarised_vcf, out_vcf, cache_fname, scope, logger):
+    """
+    Function that merges the cached annotation payloads ('cached_sites_tsv') and the annotated novel records
+    ('novel_summarised_vcf', None if there were no novel records) back into the (coordinate) order of the validated
+    VCF file. The annotation payloads of novel records are added to the cache. The output VCF ('out_vcf') is bgzipped if it ends with '.gz'
+    """
+    conn = open_annotation_cache(cache_fname)
+    validated_header = []
+    sample_info_tags = {}
+    with open_vcf_text(validated_vcf) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            validated_header.append(line)
+            tag = get_info_header_id(line)
+            if not tag is None:
+                sample_info_tags[tag] = 1
+
+    novel_f = open_vcf_text(novel_summarised_vcf) if not novel_summarised_vcf is None else None
+    novel_header = []
+    novel_line = None
+    if not novel_f is None:
+        for line in novel_f:
+            if not line.startswith('#'):
+                novel_line = line
+                break
+            novel_header.append(line)
+        annotation_header_lines = [l for l in novel_header if not l in validated_header and not l.startswith('##contig')]
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO header (scope, header_lines) VALUES (?, ?)', (scope, json.dumps(annotation_header_lines)))
+        out_header = novel_header
+    else:
+        out_header = validated_header[:-1] + get_cached_header_lines(conn, scope) + validated_header[-1:]
+
+    annotation_info_tags = {}
+    for line in out_header:
+        tag = get_info_header_id(line)
+        if not tag is None and not tag in sample_info_tags:
+            annotation_info_tags[tag] = 1
+
+    new_entries = []
+    num_written = 0
+
+    def flush_entries():
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO annotation (scope, variant_key, info, last_access) VALUES (?, ?, ?, ?)',
+                             [(scope, key, info, int(time.time())) for key, info in new_entries])
+        new_entries.clear()
+
+    with open_vcf_text(validated_vcf) as f, open(cached_sites_tsv, 'r') as cached_f, open_vcf_output(out_vcf, logger) as out:
+        out.writelines(out_header)
+        cached_line = cached_f.readline()
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            key = get_variant_key(fields)
+            if cached_line and cached_line.split('\t', 1)[0] == key:
+                payload = cached_line.rstrip('\n').split('\t', 1)[1]
+                info = [e for e in fields[7].split(';') if e != '.' and not e.split('=')[0] in annotation_info_tags]
+                if payload != '.':
+                    info.append(payload)
+                fields[7] = ';'.join(info) if info else '.'
+                out.write('\t'.join(fields) + '\n')
+                num_written += 1
+                cached_line = cached_f.readline()
+            elif novel_line and get_variant_key(novel_line.split('\t', 5)) == key:
+                out.write(novel_line)
+                num_written += 1
+                new_entries.append((key, get_annotation_payload(novel_line.rstrip('\n').split('\t')[7], sample_info_tags)))
+                if len(new_entries) == 10 * CACHE_CHUNK_SIZE:
+                    flush_entries()
+                novel_line = novel_f.readline()
+    flush_entries()
+    if not novel_f is None:
+        novel_f.close()
+    conn.close()
+
+    logger.info(f'Merged cached and novel variant annotations: {num_written} annotated records')
+    return num_written
+
+
+def evict_cache_entries(cache_fname, max_entries, logger, cache_label = 'Annotation cache'):
+    """
+    Function that limits the size of the annotation cache, i.e. removes the least recently used entries
+    (across all scopes) when the cache holds more than 'max_entries' variants
+    """
+    conn = open_annotation_cache(cache_fname)
+    num_entries = conn.execute('SELECT COUNT(*) FROM annotation').fetchone()[0]
+    if num_entries > max_entries:
+        with conn:
+            conn.execute('DELETE FROM annotation WHERE rowid IN (SELECT rowid FROM annotation ORDER BY last_access LIMIT ?)',
+                         (num_entries - max_entries,))
+            conn.execute('DELETE FROM header WHERE NOT scope IN (SELECT DISTINCT scope FROM annotation)')
+        logger.info(f'{cache_label}: evicted {num_entries - max_entries} least recently used entries (maximum: {max_entries})')
+    conn.close()
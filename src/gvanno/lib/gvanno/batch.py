@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import heapq
+import re
+
+from cyvcf2 import VCF
+
+from lib.gvanno.utils import error_message
+from lib.gvanno.shard import open_vcf_text
+
+CANONICAL_CHROMOSOMES = [str(x) for x in [*range(1, 23), 'X', 'Y', 'M', 'MT']]
+
+
+def read_query_vcf_list(query_vcf_list, logger):
+    """
+    Function that reads a batch file with one query VCF per line, i.e. '<sample_id> <query_vcf>'
+    (whitespace-separated). Returns a list of (sample_id, query_vcf) tuples
+    """
+    samples = []
+    sample_ids = {}
+    with open(query_vcf_list, 'r') as f:
+        for line in f:
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            fields = line.strip().split()
+            if len(fields) != 2:
+                error_message(f"Batch file {query_vcf_list} should list one sample per line: '<sample_id> <query_vcf>' - found '{line.strip()}'", logger)
+            if fields[0] in sample_ids:
+                error_message(f"Sample identifier '{fields[0]}' is listed more than once in batch file {query_vcf_list}", logger)
+            sample_ids[fields[0]] = 1
+            samples.append((fields[0], fields[1]))
+    if not samples:
+        error_message(f"Batch file {query_vcf_list} does not list any query VCF files", logger)
+    return samples
+
+
+def iter_vcf_sites(vcf, chrom):
+    for rec in vcf(chrom):
+        yield (rec.POS, rec.REF, ','.join(rec.ALT))
+
+
+def write_union_sites(validated_vcfs, out_vcf, logger):
+    """
+    Function that writes the union of unique CHROM/POS/REF/ALT sites in a set of validated (bgzipped and indexed)
+    VCF files to a sites-only VCF file ('out_vcf', uncompressed). Contigs are processed one at a time, and sites
+    within each contig are merged from all (sorted) VCF files, so that memory usage does not depend on the number
+    of sites. Returns the number of unique sites
+    """
+    vcfs = [VCF(fname) for fname in validated_vcfs]
+    contigs = []
+    for vcf in vcfs:
+        for chrom in vcf.seqnames:
+            if not chrom in contigs:
+                contigs.append(chrom)
+    contigs = sorted(contigs, key = lambda c: (CANONICAL_CHROMOSOMES.index(c) if c in CANONICAL_CHROMOSOMES else len(CANONICAL_CHROMOSOMES), c))
+
+    num_sites = 0
+    num_sample_sites = 0
+    with open(out_vcf, 'w') as out:
+        out.write('##fileformat=VCFv4.2\n')
+        for chrom in contigs:
+            out.write(f'##contig=<ID={chrom}>\n')
+        out.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for chrom in contigs:
+            sample_sites = [iter_vcf_sites(vcf, chrom) for vcf in vcfs if chrom in vcf.seqnames]
+            current_pos = None
+            sites_at_pos = set()
+            for pos, ref, alt in heapq.merge(*sample_sites, key = lambda site: site[0]):
+                num_sample_sites += 1
+                if pos != current_pos:
+                    for site in sorted(sites_at_pos):
+                        out.write(f'{chrom}\t{site[0]}\t.\t{site[1]}\t{site[2]}\t.\tPASS\t.\n')
+                    num_sites += len(sites_at_pos)
+                    sites_at_pos = set()
+                    current_pos = pos
+                sites_at_pos.add((pos, ref, alt))
+            for site in sorted(sites_at_pos):
+                out.write(f'{chrom}\t{site[0]}\t.\t{site[1]}\t{site[2]}\t.\tPASS\t.\n')
+            num_sites += len(sites_at_pos)
+    for vcf in vcfs:
+        vcf.close()
+
+    logger.info(f'Union of {len(validated_vcfs)} query VCF files: {num_sites} unique sites (out of {num_sample_sites} sample records)')
+    return num_sites
+
+
+def get_info_header_id(header_line):
+    match = re.match(r'^##INFO=<ID=([^,>]+)', header_line)
+    if match:
+        return match.group(1)
+    return None
+
+
+def project_site_annotations(sample_vcf, annotated_sites_vcf, out_vcf, logger):
+    """
+    Function that projects the annotations of a (bgzipped and indexed) sites-only VCF file ('annotated_sites_vcf')
+    onto the records of a validated sample VCF file. All columns of the sample records are kept, and the INFO
+    column is extended with the annotated INFO tags of the matching CHROM/POS/REF/ALT site (INFO tags
+    of the sample that collide with annotation tags are replaced). Sample records with no annotated site
+    are skipped (as in gvanno-summarise, e.g. records with no CSQ). The output VCF ('out_vcf') is uncompressed
+    """
+    annotated_vcf = VCF(annotated_sites_vcf)
+    annotation_header_lines = []
+    annotation_info_tags = {}
+    for line in annotated_vcf.raw_header.rstrip('\n').split('\n'):
+        if line.startswith('##fileformat') or line.startswith('##contig') or line.startswith('##FILTER') or line.startswith('#CHROM'):
+            continue
+        annotation_header_lines.append(line)
+        tag = get_info_header_id(line)
+        if tag is not None:
+            annotation_info_tags[tag] = 1
+
+    num_projected = 0
+    num_skipped = 0
+    current_chrom = None
+    sites = None
+    site = None
+    annotations_at_pos = {}
+    with open_vcf_text(sample_vcf) as f, open(out_vcf, 'w') as out:
+        for line in f:
+            if line.startswith('##'):
+                tag = get_info_header_id(line)
+                if tag is None or not tag in annotation_info_tags:
+                    out.write(line)
+                continue
+            if line.startswith('#CHROM'):
+                for header_line in annotation_header_lines:
+                    out.write(header_line + '\n')
+                out.write(line)
+                continue
+
+            fields = line.rstrip('\n').split('\t')
+            chrom = fields[0]
+            pos = int(fields[1])
+            if chrom != current_chrom:
+                current_chrom = chrom
+                sites = iter(annotated_vcf(chrom)) if chrom in annotated_vcf.seqnames else iter([])
+                site = next(sites, None)
+                annotations_at_pos = {}
+
+            ## both VCF files are sorted by position within each contig - collect all annotated sites at 'pos'
+            if not annotations_at_pos or next(iter(annotations_at_pos))[0] != pos:
+                annotations_at_pos = {}
+                while site is not None and site.POS < pos:
+                    site = next(sites, None)
+                while site is not None and site.POS == pos:
+                    annotations_at_pos[(site.POS, site.REF, ','.join(site.ALT))] = str(site).rstrip('\n').split('\t')[7]
+                    site = next(sites, None)
+
+            key = (pos, fields[3], fields[4])
+            if not key in annotations_at_pos:
+                num_skipped += 1
+                continue
+
+            info_elements = []
+            if fields[7] != '.':
+                for element in fields[7].split(';'):
+                    if not element.split('=')[0] in annotation_info_tags:
+                        info_elements.append(element)
+            if annotations_at_pos[key] != '.':
+                info_elements.append(annotations_at_pos[key])
+            fields[7] = ';'.join(info_elements) if info_elements else '.'
+            out.write('\t'.join(fields) + '\n')
+            num_projected += 1
+    annotated_vcf.close()
+
+    logger.info(f'Projected site annotations onto {num_projected} sample records ({num_skipped} records with no annotated site)')
+    return num_projected
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+
+from lib.gvanno.gvanno_vars import GVANNO_VERSION, DB_VERSION, VEP_VERSION
+from lib.gvanno.utils import remove_file
+
+
+def file_checksum(fname, block_size = 1 << 20):
+    """
+    Function that returns the SHA-256 checksum of a file (None if the file does not exist)
+    """
+    if not os.path.isfile(fname):
+        return None
+    sha256 = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def get_software_versions(gvanno_db_dir):
+    """
+    Function that lists the software/database versions that a workflow step manifest depends on. The checksum
+    of the data bundle RELEASE_NOTES is included so that an updated bundle invalidates all previous steps
+    """
+    versions = {}
+    versions['GVANNO_VERSION'] = GVANNO_VERSION
+    versions['DB_VERSION'] = DB_VERSION
+    versions['VEP_VERSION'] = VEP_VERSION
+    versions['DATA_BUNDLE_RELEASE_NOTES'] = file_checksum(os.path.join(gvanno_db_dir, 'RELEASE_NOTES'))
+    return versions
+
+
+def get_manifest_fname(output_prefix, step):
+    return f'{output_prefix}.{step}.manifest.json'
+
+
+def get_step_manifest(step, input_files, options, output_files, gvanno_db_dir):
+    """
+    Function that assembles the manifest of a workflow step, i.e. checksums of all input and output files,
+    the step options, and software/database versions
+    """
+    manifest = {}
+    manifest['step'] = step
+    manifest['versions'] = get_software_versions(gvanno_db_dir)
+    manifest['options'] = options
+    manifest['input_files'] = {}
+    for fname in input_files:
+        manifest['input_files'][os.path.basename(fname)] = file_checksum(fname)
+    manifest['output_files'] = {}
+    for fname in output_files:
+        manifest['output_files'][os.path.basename(fname)] = file_checksum(fname)
+    return manifest
+
+
+def write_step_manifest(manifest_fname, step, input_files, options, output_files, gvanno_db_dir):
+    """
+    Function that records the manifest of a successfully completed workflow step
+    """
+    manifest = get_step_manifest(step, input_files, options, output_files, gvanno_db_dir)
+    with open(manifest_fname + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent = 2, sort_keys = True)
+    os.replace(manifest_fname + '.tmp', manifest_fname)
+
+
+def step_is_complete(manifest_fname, step, input_files, options, output_files, gvanno_db_dir, logger):
+    """
+    Function that checks whether a workflow step can be skipped, i.e. whether its recorded manifest still matches
+    the current input files, options, software/database versions and (existing, unmodified) output files.
+    A manifest that does not match is removed
+    """
+    if not os.path.exists(manifest_fname):
+        return False
+    try:
+        with open(manifest_fname, 'r') as f:
+            recorded_manifest = json.load(f)
+    except ValueError:
+        recorded_manifest = {}
+
+    ## cheap checks first - file checksums are only computed if versions and options match
+    current_options = json.loads(json.dumps(options))
+    reason = None
+    if recorded_manifest.get('step') != step:
+        reason = 'manifest is invalid'
+    elif recorded_manifest.get('versions') != get_software_versions(gvanno_db_dir):
+        reason = 'software/database versions changed'
+    elif recorded_manifest.get('options') != current_options:
+        reason = 'options changed'
+    else:
+        current_manifest = get_step_manifest(step, input_files, options, output_files, gvanno_db_dir)
+        if recorded_manifest.get('input_files') != current_manifest['input_files']:
+            reason = 'input files changed'
+        elif None in current_manifest['output_files'].values() or \
+            recorded_manifest.get('output_files') != current_manifest['output_files']:
+            reason = 'output files are missing or modified'
+
+    if reason is not None:
+        logger.info(f"Checkpoint for step '{step}' is invalidated ({reason}) - running step")
+        remove_file(manifest_fname)
+        return False
+
+    logger.info(f"Checkpoint for step '{step}' matches inputs, options and versions - skipping step")
+    return True
@@ -120,6 +120,14 @@ def map_dbnsfp_predictions(dbnsfp_tag, algorithms):
 def vep_dbnsfp_meta_vcf(query_vcf, info_tags_wanted):
     
     vcf = VCF(query_vcf)
+    return vep_dbnsfp_meta_header(vcf, info_tags_wanted)
+
+
+def vep_dbnsfp_meta_header(vcf, info_tags_wanted):
+    """
+    Function that parses the CSQ (VEP) and DBNSFP (vcfanno) INFO header elements of an opened VCF 
+    (cyvcf2 VCF object), i.e. without reading the VCF file once more
+    """
     vep_csq_index2fields = {}
     vep_csq_fields2index = {}
     dbnsfp_prediction_algorithms = []
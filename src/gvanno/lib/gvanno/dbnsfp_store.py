@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+import gzip
+import json
+import os
+import shutil
+from array import array
+
+import numpy as np
+
+from lib.gvanno.utils import error_message
+from lib.gvanno.vcf import get_vcf_info_tag_numbers
+
+## format version of the columnar dbNSFP store (stores with another version are not used)
+DBNSFP_STORE_VERSION = 3
+
+
+def get_dbnsfp_store_dir(gvanno_db_dir):
+    return os.path.join(gvanno_db_dir, 'variant', 'vcf', 'dbnsfp', 'dbnsfp_store')
+
+
+def get_source_signature(vcf_fname):
+    """
+    Function that returns the size and modification time of the dbNSFP VCF a store was built from
+    """
+    vcf_stat = os.stat(vcf_fname)
+    return {'size': vcf_stat.st_size, 'mtime': int(vcf_stat.st_mtime)}
+
+
+def get_code_dtype(num_codes):
+    """
+    Function that returns the smallest unsigned integer type for 'num_codes' distinct codes
+    """
+    if num_codes <= 2**8:
+        return np.uint8
+    if num_codes <= 2**16:
+        return np.uint16
+    return np.uint32
+
+
+def write_store_chromosome(store_dir, chrom, positions, allele_codes, field_codes, vocabularies):
+    np.save(os.path.join(store_dir, f'{chrom}.pos.npy'), np.array(positions, dtype=np.int32))
+    np.save(os.path.join(store_dir, f'{chrom}.allele.npy'), np.array(allele_codes, dtype=get_code_dtype(len(vocabularies['alleles']))))
+    for i, codes in enumerate(field_codes):
+        np.save(os.path.join(store_dir, f'{chrom}.field{i}.npy'), np.array(codes, dtype=get_code_dtype(len(vocabularies['fields'][i]))))
+
+
+def build_dbnsfp_store(dbnsfp_vcf, info_tag, store_dir, logger):
+    """
+    Function that converts the dbNSFP track (position-sorted VCF, packed 'info_tag' INFO values with '|'-separated
+    fields) into a columnar store: per chromosome, sorted positions, allele codes (REF>ALT) and integer-coded
+    field values (one array per field, values are looked up in per-field vocabularies), saved as numpy arrays
+    that are memory-mapped during annotation. Multi-allelic records and packed values with several ','-separated
+    entries are stored as one entry per ALT allele and value entry (in input order), values of a Number=A tag are
+    stored for their own ALT allele only (as selected by vcfanno)
+    """
+    store_tmp_dir = f'{store_dir}.tmp'
+    if os.path.exists(store_tmp_dir):
+        shutil.rmtree(store_tmp_dir)
+    os.makedirs(store_tmp_dir)
+
+    vocabularies = {'alleles': [], 'fields': None}
+    vocabulary_index = {'alleles': {}, 'fields': None}
+    chromosomes = {}
+    chrom = None
+    positions = array('i')
+    allele_codes = array('I')
+    field_codes = None
+    num_entries = 0
+    per_allele = get_vcf_info_tag_numbers(dbnsfp_vcf).get(info_tag) == 'A'
+    with gzip.open(dbnsfp_vcf, 'rt') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] != chrom:
+                if len(positions) > 0:
+                    write_store_chromosome(store_tmp_dir, chrom, positions, allele_codes, field_codes, vocabularies)
+                    chromosomes[chrom] = len(positions)
+                    logger.info(f'dbNSFP store: chromosome {chrom} - {len(positions)} entries')
+                chrom = fields[0]
+                if chrom in chromosomes:
+                    error_message(f'dbNSFP VCF ({dbnsfp_vcf}) is not sorted - records on chromosome {chrom} are not contiguous', logger)
+                positions = array('i')
+                allele_codes = array('I')
+                field_codes = None if vocabularies['fields'] is None else [array('I') for i in vocabularies['fields']]
+            value = None
+            for info_element in fields[7].split(';'):
+                if info_element.startswith(f'{info_tag}='):
+                    value = info_element[len(info_tag) + 1:]
+            if value is None:
+                continue
+            alts = fields[4].split(',')
+            value_entries = value.split(',')
+            for j, value_entry in enumerate(value_entries):
+                value_fields = value_entry.split('|')
+                if vocabularies['fields'] is None:
+                    vocabularies['fields'] = [[] for i in value_fields]
+                    vocabulary_index['fields'] = [{} for i in value_fields]
+                    field_codes = [array('I') for i in value_fields]
+                if len(value_fields) != len(vocabularies['fields']):
+                    error_message(f'dbNSFP VCF record {fields[0]}:{fields[1]} has {len(value_fields)} {info_tag} fields ' + \
+                                  f'(expected {len(vocabularies["fields"])})', logger)
+                ## a record matches a query allele once, also if the allele is listed more than once
+                entry_alts = [alts[j]] if per_allele and len(value_entries) == len(alts) else alts
+                for alt in dict.fromkeys(entry_alts):
+                    allele = f'{fields[3]}>{alt}'
+                    if not allele in vocabulary_index['alleles']:
+                        vocabulary_index['alleles'][allele] = len(vocabularies['alleles'])
+                        vocabularies['alleles'].append(allele)
+                    positions.append(int(fields[1]))
+                    allele_codes.append(vocabulary_index['alleles'][allele])
+                    for i, field_value in enumerate(value_fields):
+                        if not field_value in vocabulary_index['fields'][i]:
+                            vocabulary_index['fields'][i][field_value] = len(vocabularies['fields'][i])
+                            vocabularies['fields'][i].append(field_value)
+                        field_codes[i].append(vocabulary_index['fields'][i][field_value])
+                    num_entries += 1
+    if len(positions) > 0:
+        write_store_chromosome(store_tmp_dir, chrom, positions, allele_codes, field_codes, vocabularies)
+        chromosomes[chrom] = len(positions)
+        logger.info(f'dbNSFP store: chromosome {chrom} - {len(positions)} entries')
+
+    manifest = {'version': DBNSFP_STORE_VERSION, 'info_tag': info_tag, 'source': get_source_signature(dbnsfp_vcf),
+                'chromosomes': chromosomes, 'alleles': vocabularies['alleles'], 'fields': vocabularies['fields'] or []}
+    with open(os.path.join(store_tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(store_tmp_dir, store_dir)
+    logger.info(f'dbNSFP store: {num_entries} entries on {len(chromosomes)} chromosomes written to {store_dir}')
+    return num_entries
+
+
+def read_dbnsfp_store_manifest(store_dir, dbnsfp_vcf, info_tag):
+    """
+    Function that reads the manifest of a dbNSFP store, returns None if there is no store, or if the store was built
+    from another dbNSFP VCF (size/modification time), for another INFO tag or with another store format version
+    """
+    manifest_fname = os.path.join(store_dir, 'manifest.json')
+    if not os.path.exists(manifest_fname) or not os.path.exists(dbnsfp_vcf):
+        return None
+    with open(manifest_fname, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != DBNSFP_STORE_VERSION or manifest.get('info_tag') != info_tag or \
+        manifest.get('source') != get_source_signature(dbnsfp_vcf):
+        return None
+    return manifest
+
+
+def load_dbnsfp_store_chromosome(store_dir, manifest, chrom):
+    """
+    Function that memory-maps the arrays of a chromosome in the dbNSFP store
+    """
+    arrays = {}
+    arrays['pos'] = np.load(os.path.join(store_dir, f'{chrom}.pos.npy'), mmap_mode='r')
+    arrays['allele'] = np.load(os.path.join(store_dir, f'{chrom}.allele.npy'), mmap_mode='r')
+    arrays['fields'] = [np.load(os.path.join(store_dir, f'{chrom}.field{i}.npy'), mmap_mode='r')
+                        for i in range(len(manifest['fields']))]
+    return arrays
+
+
+def lookup_dbnsfp_store(arrays, manifest, allele_index, sites):
+    """
+    Function that looks up query sites ((start, end, ref, alt), 0-based) of a chromosome in the dbNSFP store by
+    binary search on positions, returns the packed values of the entries matching position, REF and ALT of each
+    site (list of values per site, in store order)
+    """
+    site_positions = np.array([site[0] + 1 for site in sites], dtype=np.int64)
+    first = np.searchsorted(arrays['pos'], site_positions, side='left')
+    last = np.searchsorted(arrays['pos'], site_positions, side='right')
+    site_values = [[] for site in sites]
+    for i in np.nonzero(last > first)[0]:
+        allele_code = allele_index.get(f'{sites[i][2]}>{sites[i][3]}')
+        if allele_code is None:
+            continue
+        for j in range(first[i], last[i]):
+            if arrays['allele'][j] == allele_code:
+                site_values[i].append('|'.join([manifest['fields'][k][arrays['fields'][k][j]]
+                                                for k in range(len(manifest['fields']))]))
+    return site_values
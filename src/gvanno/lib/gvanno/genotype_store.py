@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+import pandas as pd
+
+## missing value of integer columns (DP/AD) in the genotype store
+MISSING_INT = -1
+
+
+def init_genotype_store(depth = False):
+    """
+    Function that initializes the (in-memory) genotype store, i.e. columns of sample data (GT, and optionally DP/AD)
+    keyed by ordinal of the normalized VCF records (CHROM/POS/REF/ALT are kept for the join with annotated variants)
+    """
+    store = {}
+    for column in ['CHROM', 'POS', 'REF', 'ALT', 'GT']:
+        store[column] = []
+    if depth:
+        for column in ['DP', 'AD_REF', 'AD_ALT']:
+            store[column] = []
+    return store
+
+
+def get_format_int(rec, tag, index = 0):
+    """
+    Function that returns an integer FORMAT value of the first sample of a VCF record (cyvcf2), MISSING_INT if absent
+    """
+    values = rec.format(tag)
+    if values is None or index >= values.shape[1]:
+        return MISSING_INT
+    value = int(values[0][index])
+    return value if value >= 0 else MISSING_INT
+
+
+def append_genotype(store, fields, rec, allele_index):
+    """
+    Function that appends the sample data of the first sample of a VCF record (cyvcf2) to the genotype store, for the
+    normalized record 'fields' (site columns). 'allele_index' is the alternative allele of a (decomposed) multiallelic
+    record: its allele becomes '1', other alternative alleles become reference ('0'), as with 'bcftools norm -m-'
+    """
+    gt = '.'
+    if 'GT' in rec.FORMAT:
+        genotype = rec.genotypes[0]
+        alleles = []
+        for allele in genotype[:-1]:
+            if allele < 0:
+                alleles.append('.')
+            else:
+                alleles.append('1' if allele == allele_index else '0')
+        gt = ('|' if genotype[-1] else '/').join(alleles)
+    store['CHROM'].append(fields[0])
+    store['POS'].append(int(fields[1]))
+    store['REF'].append(fields[3])
+    store['ALT'].append(fields[4])
+    store['GT'].append(gt)
+    if 'DP' in store:
+        store['DP'].append(get_format_int(rec, 'DP'))
+        store['AD_REF'].append(get_format_int(rec, 'AD', 0))
+        store['AD_ALT'].append(get_format_int(rec, 'AD', allele_index))
+
+
+def write_genotype_store(store, genotype_store_fname, logger):
+    """
+    Function that writes the genotype store as a compressed numpy archive (one array per column)
+    """
+    arrays = {}
+    for column in store.keys():
+        if column in ['POS', 'DP', 'AD_REF', 'AD_ALT']:
+            arrays[column] = np.array(store[column], dtype = np.int32)
+        else:
+            arrays[column] = np.array(store[column], dtype = str)
+    ## np.savez_compressed appends '.npz' to file names without that extension
+    with open(genotype_store_fname, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    logger.info(f"Genotype store: sample data ({', '.join(c for c in store.keys() if not c in ['CHROM', 'POS', 'REF', 'ALT'])}) for {len(store['GT'])} records")
+
+
+def join_genotypes(variant_set: pd.DataFrame, genotype_store_fname, logger) -> pd.DataFrame:
+    """
+    Function that appends sample data from the genotype store (written during input validation) to the annotated
+    variant set, joined by CHROM/POS/REF/ALT: GT, and optionally DP (as 'SAMPLE_DP') and AD (as 'SAMPLE_AD', 'ref,alt')
+    """
+    if genotype_store_fname is None or not os.path.exists(genotype_store_fname) or \
+            not {'CHROM','POS','REF','ALT'}.issubset(variant_set.columns):
+        return variant_set
+
+    store = np.load(genotype_store_fname)
+    genotypes = pd.DataFrame({'CHROM': store['CHROM'], 'POS': store['POS'].astype(str), 'REF': store['REF'],
+                              'ALT': store['ALT'], 'GT': store['GT']})
+    if 'DP' in store.files:
+        genotypes['SAMPLE_DP'] = pd.Series(store['DP']).astype(str).replace(str(MISSING_INT), '.')
+        ad = pd.Series(store['AD_REF']).astype(str) + ',' + pd.Series(store['AD_ALT']).astype(str)
+        ad[(store['AD_REF'] == MISSING_INT) & (store['AD_ALT'] == MISSING_INT)] = '.'
+        genotypes['SAMPLE_AD'] = ad.str.replace(str(MISSING_INT), '.', regex = False)
+    genotypes = genotypes.drop_duplicates(subset = ['CHROM','POS','REF','ALT'])
+    logger.info(f'Appending sample data (genotypes) for {len(genotypes)} variants from genotype store')
+
+    for column in [c for c in genotypes.columns if c in variant_set.columns and not c in ['CHROM','POS','REF','ALT']]:
+        variant_set.drop(column, inplace=True, axis=1)
+    keys = variant_set[['CHROM','POS','REF','ALT']].astype(str)
+    genotypes = keys.merge(genotypes, on = ['CHROM','POS','REF','ALT'], how = "left")
+    for column in [c for c in genotypes.columns if not c in ['CHROM','POS','REF','ALT']]:
+        variant_set[column] = genotypes[column].values
+    return variant_set
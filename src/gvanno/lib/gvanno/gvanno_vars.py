@@ -9,11 +9,19 @@ MAX_VARIANTS_FOR_REPORT = 500_000
 CODING_EXOME_SIZE_MB = 34.0
 RECOMMENDED_N_MUT_SIGNATURE = 200
 
+## sorting of unsorted query VCFs (external merge sort, gvanno-validate-input)
+VCF_SORT_MAX_MEMORY_MB = 768
+VCF_SORT_MAX_PROC = 4
+
+## compression threads of bgzip processes that compress VCF output while it is written (e.g. VEP output)
+BGZIP_N_THREADS = 4
+
 ## GENCODE
 GENCODE_VERSION = {'grch38': 44,'grch37': 19}
 
 ## vcfanno
 VCFANNO_MAX_PROC = 15
+VCFANNO_PROCESS_MEMORY_MB = 500
 
 ## VEP settings/versions
 VEP_VERSION = '110'
@@ -22,7 +30,14 @@ VEP_MIN_FORKS = 1
 VEP_MAX_FORKS = 8
 VEP_MIN_BUFFER_SIZE = 50
 VEP_MAX_BUFFER_SIZE = 30000
+## approximate resource requirements used for automatic tuning of forks/buffer size/processes (--auto_tune)
+VEP_FORK_MEMORY_MB = 1500
+VEP_FORK_BUFFER_SIZE = 1000
+VEP_BUFFER_VARIANT_MEMORY_KB = 40
 VEP_PICK_CRITERIA = ['mane_select','mane_plus_clinical','canonical','appris','tsl','biotype','ccds','rank','length']
+## CSQ fields that are always requested from VEP (--fields), i.e. fields used to pick the primary consequence (gvanno-summarise)
+VEP_CSQ_PICK_FIELDS = ['Allele','Consequence','SYMBOL','Feature_type','Feature','BIOTYPE','EXON','HGVSc','HGVSp','PICK',
+                       'MANE_SELECT','MANE_PLUS_CLINICAL','CANONICAL','APPRIS','TSL','CCDS']
 
 ## https://www.ensembl.org/info/genome/variation/prediction/predicted_data.html#consequences
 VEP_consequence_rank = {
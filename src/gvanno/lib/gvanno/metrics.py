@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+import gzip
+import json
+import os
+import resource
+import threading
+import time
+
+from lib.gvanno.gvanno_vars import GVANNO_VERSION, DB_VERSION, VEP_VERSION
+
+## record counts of files that were already counted (i.e. output of one step and input of the next), keyed by name/size/mtime
+_record_counts = {}
+
+## interval (seconds) at which the RSS of the process tree is sampled during a workflow step
+RSS_SAMPLE_INTERVAL = 0.5
+
+
+def get_cpu_usage():
+    """
+    Function that takes a snapshot of wall time and CPU time of the current process and of all its terminated child
+    processes (e.g. VEP, vcfanno, worker processes), and of the peak RSS (kilobytes on Linux) of terminated child processes
+    """
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage = {}
+    usage['wall_time'] = time.time()
+    usage['user_cpu'] = usage_self.ru_utime + usage_children.ru_utime
+    usage['sys_cpu'] = usage_self.ru_stime + usage_children.ru_stime
+    usage['children_max_rss_kb'] = usage_children.ru_maxrss
+    return usage
+
+
+def get_process_tree_rss_kb(pid):
+    """
+    Function that returns the total RSS (kilobytes) of a process and all its descendants (Linux /proc, pages shared
+    between processes are counted for each process)
+    """
+    children = {}
+    rss_pages = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                stat = f.read()
+            ## fields after the command name (in parentheses): state, ppid, ..., rss (pages)
+            fields = stat[stat.rindex(')') + 2:].split()
+            children.setdefault(int(fields[1]), []).append(int(entry))
+            rss_pages[int(entry)] = int(fields[21])
+        except (OSError, ValueError, IndexError):
+            continue
+    total_pages = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        total_pages += rss_pages.get(pid, 0)
+        pids.extend(children.get(pid, []))
+    return total_pages * (resource.getpagesize() // 1024)
+
+
+def start_rss_monitor():
+    """
+    Function that starts sampling the total RSS of the process tree of the current process (e.g. with VEP, vcfanno
+    and worker processes) in a background thread, and resets the peak RSS of the current process (VmHWM), so that
+    the peak RSS of a workflow step is measured independently of earlier steps. Returns None without /proc (non-Linux)
+    """
+    if not os.path.exists('/proc/self/stat'):
+        return None
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    monitor = {'peak_kb': 0, 'stop': threading.Event()}
+
+    def sample():
+        while True:
+            monitor['peak_kb'] = max(monitor['peak_kb'], get_process_tree_rss_kb(os.getpid()))
+            if monitor['stop'].wait(RSS_SAMPLE_INTERVAL):
+                break
+
+    monitor['thread'] = threading.Thread(target=sample, daemon=True)
+    monitor['thread'].start()
+    return monitor
+
+
+def stop_rss_monitor(monitor):
+    """
+    Function that stops an RSS monitor, and returns the peak RSS (kilobytes) of the process tree while it was running
+    (sampled), or the peak RSS of the current process since the monitor was started (VmHWM) if that is higher
+    """
+    monitor['stop'].set()
+    monitor['thread'].join()
+    peak_kb = monitor['peak_kb']
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                peak_kb = max(peak_kb, int(line.split()[1]))
+    return peak_kb
+
+
+def get_resource_usage(count_records = False):
+    """
+    Function that takes a snapshot of wall time and CPU time at the start of a workflow step, and starts measuring
+    the peak RSS of the step. With 'count_records', the records of all input/output files of the step are counted
+    for the step metrics (i.e. extra passes over these files), otherwise record counts are taken from step counters
+    """
+    usage = get_cpu_usage()
+    usage['rss_monitor'] = start_rss_monitor()
+    usage['count_records'] = count_records
+    return usage
+
+
+def count_records(fname):
+    """
+    Function that counts the data records of a (gzipped) VCF or TSV file, i.e. all lines except
+    meta lines ('#') and the column header of TSV files
+    """
+    if not os.path.isfile(fname):
+        return None
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+    if not key in _record_counts:
+        num_records = 0
+        with (gzip.open(fname, 'rb') if fname.endswith('.gz') else open(fname, 'rb')) as f:
+            line = f.readline()
+            while line.startswith(b'#'):
+                line = f.readline()
+            if line:
+                num_records += 1
+            last_block = b'\n'
+            for block in iter(lambda: f.read(1 << 20), b''):
+                num_records += block.count(b'\n')
+                last_block = block
+            ## last record without a trailing newline
+            if not last_block.endswith(b'\n'):
+                num_records += 1
+        if (fname.endswith('.tsv') or fname.endswith('.tsv.gz')) and num_records > 0:
+            num_records -= 1
+        _record_counts[key] = num_records
+    return _record_counts[key]
+
+
+def get_step_metrics(start_usage, input_files, output_files, counters = None):
+    """
+    Function that assembles the metrics of a completed workflow step: wall time, user/sys CPU time, peak RSS of the
+    step (process tree), input/output record counts and file sizes, and throughput (input records per second).
+    Record counts are taken from the step counters ('records_in'/'records_out', e.g. from gvanno-summarise), or
+    from all input/output files if the step was started with 'count_records' (None if unknown). Step-specific
+    counters are included as is
+    """
+    end_usage = get_cpu_usage()
+    metrics = {}
+    metrics['wall_time_sec'] = round(end_usage['wall_time'] - start_usage['wall_time'], 3)
+    metrics['user_cpu_sec'] = round(end_usage['user_cpu'] - start_usage['user_cpu'], 3)
+    metrics['sys_cpu_sec'] = round(end_usage['sys_cpu'] - start_usage['sys_cpu'], 3)
+    peak_rss_kb = None
+    if not start_usage['rss_monitor'] is None:
+        peak_rss_kb = stop_rss_monitor(start_usage['rss_monitor'])
+    ## a child process that terminated during the step raised the peak RSS of all terminated child processes
+    if end_usage['children_max_rss_kb'] > start_usage['children_max_rss_kb']:
+        peak_rss_kb = max(peak_rss_kb or 0, end_usage['children_max_rss_kb'])
+    metrics['peak_rss_mb'] = None if peak_rss_kb is None else round(peak_rss_kb / 1024.0, 1)
+    if start_usage['count_records']:
+        metrics['input_records'] = sum([count_records(fname) or 0 for fname in input_files])
+        metrics['output_records'] = sum([count_records(fname) or 0 for fname in output_files])
+    else:
+        metrics['input_records'] = counters.get('records_in') if counters else None
+        metrics['output_records'] = counters.get('records_out') if counters else None
+    metrics['input_bytes'] = sum([os.path.getsize(fname) for fname in input_files if os.path.isfile(fname)])
+    metrics['output_bytes'] = sum([os.path.getsize(fname) for fname in output_files if os.path.isfile(fname)])
+    metrics['records_per_sec'] = None
+    if not metrics['input_records'] is None and metrics['wall_time_sec'] > 0:
+        metrics['records_per_sec'] = round(metrics['input_records'] / metrics['wall_time_sec'], 1)
+    if counters:
+        metrics['counters'] = counters
+    return metrics
+
+
+def write_metrics(metrics_fname, metrics):
+    with open(metrics_fname + '.tmp', 'w') as f:
+        json.dump(metrics, f, indent = 2)
+    os.replace(metrics_fname + '.tmp', metrics_fname)
+
+
+def init_metrics(metrics_fname, sample_id, genome_assembly):
+    """
+    Function that starts a new metrics file (JSON) for a workflow run
+    """
+    metrics = {}
+    metrics['sample_id'] = sample_id
+    metrics['genome_assembly'] = genome_assembly
+    metrics['versions'] = {'GVANNO_VERSION': GVANNO_VERSION, 'DB_VERSION': DB_VERSION, 'VEP_VERSION': VEP_VERSION}
+    metrics['start_time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    metrics['steps'] = {}
+    write_metrics(metrics_fname, metrics)
+
+
+def record_step_metrics(metrics_fname, step, step_metrics):
+    """
+    Function that adds the metrics of a workflow step to the metrics file of a run (written after each
+    step, so that the metrics of failed runs are kept up to the last completed step)
+    """
+    with open(metrics_fname, 'r') as f:
+        metrics = json.load(f)
+    metrics['steps'][step] = step_metrics
+    metrics['total_wall_time_sec'] = round(sum([m.get('wall_time_sec', 0) for m in metrics['steps'].values()]), 3)
+    write_metrics(metrics_fname, metrics)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+from cyvcf2 import VCF
+
+from lib.gvanno.gvanno_vars import VCF_SORT_MAX_MEMORY_MB
+from lib.gvanno.vcfsort import sort_vcf_records
+from lib.gvanno.genotype_store import init_genotype_store, append_genotype, write_genotype_store
+from lib.gvanno.target import is_on_target
+from lib.gvanno.utils import remove_file
+
+OLD_MULTIALLELIC_HEADER_LINE = '##INFO=<ID=OLD_MULTIALLELIC,Number=1,Type=String,Description="Original chr:pos:ref:alt encoding">'
+
+
+def get_chromosomes_to_keep():
+    """
+    Function that lists the chromosome names that are kept in the validated VCF (autosomal/sex/mito chromosomes,
+    with and without 'chr' prefix)
+    """
+    chrom_to_keep = [str(x) for x in [*range(1,23), 'X', 'Y', 'M', 'MT']]
+    return [*['chr' + chrom for chrom in chrom_to_keep], *[chrom for chrom in chrom_to_keep]]
+
+
+def strip_chr_prefix(chrom):
+    return chrom[3:] if chrom.startswith('chr') else chrom
+
+
+def get_normalized_header_lines(vcf, chrom_to_keep, decompose):
+    """
+    Function that makes the header of the normalized VCF from the header of the input VCF (cyvcf2 object):
+    FORMAT lines are removed, contig lines are limited to the kept chromosomes (without 'chr' prefix), the '#CHROM'
+    line is limited to the first eight (site) columns, and the OLD_MULTIALLELIC tag is added if records are decomposed
+    """
+    header_lines = []
+    seen_contigs = {}
+    for line in vcf.raw_header.rstrip('\n').split('\n'):
+        if line.startswith('##FORMAT='):
+            continue
+        if line.startswith('##contig=<ID='):
+            contig = line[13:].split(',')[0].rstrip('>')
+            if not contig in chrom_to_keep or strip_chr_prefix(contig) in seen_contigs:
+                continue
+            seen_contigs[strip_chr_prefix(contig)] = 1
+            line = '##contig=<ID=' + strip_chr_prefix(contig) + line[13 + len(contig):]
+        if line.startswith('##INFO=<ID=OLD_MULTIALLELIC,'):
+            continue
+        if line.startswith('#CHROM'):
+            if decompose:
+                header_lines.append(OLD_MULTIALLELIC_HEADER_LINE)
+            line = '\t'.join(line.split('\t')[:8])
+        header_lines.append(line)
+    return header_lines
+
+
+def decompose_record(fields, info_numbers):
+    """
+    Function that splits a multiallelic record (VCF site columns) into one record per alternative allele, as
+    'vt decompose -s': INFO values with Number=A/R/G are reduced to the values of the allele (Number=G: diploid
+    genotypes 0/0, 0/i and i/i), and the original site is recorded in OLD_MULTIALLELIC (chr:pos:ref/alt1/alt2..)
+    """
+    alts = fields[4].split(',')
+    num_alts = len(alts)
+    info_elements = fields[7].split(';') if fields[7] != '.' else []
+    old_multiallelic = f'OLD_MULTIALLELIC={fields[0]}:{fields[1]}:{fields[3]}/' + '/'.join(alts)
+    records = []
+    for i, alt in enumerate(alts, start = 1):
+        info = []
+        for element in info_elements:
+            key, sep, value = element.partition('=')
+            number = info_numbers.get(key)
+            if sep and (number == 'A' or number == 'R' or number == 'G'):
+                values = value.split(',')
+                if number == 'A' and len(values) == num_alts:
+                    element = f'{key}={values[i - 1]}'
+                elif number == 'R' and len(values) == num_alts + 1:
+                    element = f'{key}={values[0]},{values[i]}'
+                elif number == 'G' and len(values) == (num_alts + 1) * (num_alts + 2) // 2:
+                    het_index = i * (i + 1) // 2
+                    element = f'{key}={values[0]},{values[het_index]},{values[het_index + i]}'
+            info.append(element)
+        info.append(old_multiallelic)
+        records.append(fields[:4] + [alt] + fields[5:7] + [';'.join(info)])
+    return records
+
+
+def get_normalized_records(vcf, chrom_to_keep, info_numbers, decompose, counts, genotypes = None):
+    """
+    Function that yields the normalized record lines (site columns) of a VCF file (cyvcf2 object), counting
+    written/decomposed records in 'counts'. Sample data of normalized records is appended to 'genotypes' (genotype store)
+    """
+    for rec in vcf:
+        if not rec.CHROM in chrom_to_keep:
+            continue
+        fields = str(rec).rstrip('\n').split('\t', 8)[:8]
+        fields[0] = strip_chr_prefix(fields[0])
+        if decompose and ',' in fields[4]:
+            records = decompose_record(fields, info_numbers)
+            counts['decomposed'] += 1
+        else:
+            records = [fields]
+        for i, r in enumerate(records, start = 1):
+            counts['written'] += 1
+            if not genotypes is None:
+                append_genotype(genotypes, r, rec, i)
+            yield '\t'.join(r) + '\n'
+
+
+def get_contig_rank(header_lines):
+    """
+    Function that ranks the (normalized) chromosomes for sorting: contigs in the order of the VCF header, followed
+    by remaining chromosomes in their natural order (1-22, X, Y, M, MT)
+    """
+    contig_rank = {}
+    for line in header_lines:
+        if line.startswith('##contig=<ID='):
+            contig_rank[line[13:].split(',')[0].rstrip('>')] = len(contig_rank)
+    for chrom in get_chromosomes_to_keep():
+        if not chrom.startswith('chr') and not chrom in contig_rank:
+            contig_rank[chrom] = len(contig_rank)
+    return contig_rank
+
+
+def normalize_vcf(input_vcf, out_stream, decompose, logger, sort_records = False, temp_dir = None,
+                  sort_max_memory_mb = VCF_SORT_MAX_MEMORY_MB, sort_n_processes = 1, genotype_store = None, genotype_depth = False,
+                  target_index = None, off_target_vcf = None):
+    """
+    Function that normalizes a VCF file in a single streaming pass, writing the normalized VCF text to
+    'out_stream' (binary file object):
+    1. Only records on autosomal/sex/mito chromosomes (1-22, X, Y, M/MT) are kept, the 'chr' prefix is stripped (records and header contigs)
+    2. FORMAT and sample columns are dropped
+    3. If 'decompose' is True, multiallelic records are split into one record per alternative allele (decompose_record)
+    4. If 'sort_records' is True (input VCF not sorted), normalized records are sorted by contig and position with a
+       bounded-memory external merge sort (lib.gvanno.vcfsort, temporary files in 'temp_dir')
+    5. If 'genotype_store' is given and the VCF has samples, sample data (GT, and DP/AD with 'genotype_depth') of the
+       first sample is written to the genotype store (lib.gvanno.genotype_store) instead of the normalized VCF
+    6. If 'target_index' is given (lib.gvanno.target), only records that overlap target regions are written, off-target
+       records are dropped, or written to 'off_target_vcf' (uncompressed VCF) if given
+    Returns the number of records written
+    """
+    vcf = VCF(input_vcf)
+    chrom_to_keep = {}
+    for chrom in get_chromosomes_to_keep():
+        chrom_to_keep[chrom] = 1
+    info_numbers = {}
+    for e in vcf.header_iter():
+        header_element = e.info()
+        if 'ID' in header_element.keys() and header_element.get('HeaderType') == 'INFO':
+            info_numbers[str(header_element['ID'])] = str(header_element['Number'])
+
+    header_lines = get_normalized_header_lines(vcf, chrom_to_keep, decompose)
+    out_stream.write(('\n'.join(header_lines) + '\n').encode())
+
+    genotypes = None
+    if not genotype_store is None:
+        remove_file(genotype_store)
+        if len(vcf.samples) > 0:
+            if len(vcf.samples) > 1:
+                logger.warning(f'Input VCF contains {len(vcf.samples)} samples - keeping sample data of the first sample ({vcf.samples[0]}) only')
+            genotypes = init_genotype_store(depth = genotype_depth)
+
+    counts = {'written': 0, 'decomposed': 0}
+    records = get_normalized_records(vcf, chrom_to_keep, info_numbers, decompose, counts, genotypes = genotypes)
+    if sort_records:
+        records = sort_vcf_records(records, get_contig_rank(header_lines), temp_dir, sort_max_memory_mb, sort_n_processes, logger)
+    off_target = None
+    if not target_index is None and not off_target_vcf is None:
+        off_target = open(off_target_vcf, 'w')
+        off_target.write('\n'.join(header_lines) + '\n')
+    num_written = 0
+    batch = []
+    for line in records:
+        if not target_index is None and not is_on_target(target_index, line):
+            if not off_target is None:
+                off_target.write(line)
+            continue
+        num_written += 1
+        batch.append(line)
+        if len(batch) == 1000:
+            out_stream.write(''.join(batch).encode())
+            batch = []
+    out_stream.write(''.join(batch).encode())
+    vcf.close()
+    if not off_target is None:
+        off_target.close()
+    if not genotypes is None:
+        write_genotype_store(genotypes, genotype_store, logger)
+
+    if decompose:
+        logger.info(f"Decomposed {counts['decomposed']} multiallelic sites into biallelic records")
+    logger.info(f"Normalized VCF: {counts['written']} records on autosomal/sex/mito chromosomes")
+    if not target_index is None:
+        logger.info(f"Target regions: {num_written} on-target records, {counts['written'] - num_written} off-target records " + \
+                    f"({'passed through without annotation' if not off_target is None else 'skipped'})")
+    return num_written
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import contextlib
+import gzip
+import subprocess
+
+from lib.gvanno.utils import error_message
+from lib.gvanno.gvanno_vars import BGZIP_N_THREADS
+
+
+def open_vcf_text(vcf_fname, mode = 'rt'):
+    if vcf_fname.endswith('.gz'):
+        return gzip.open(vcf_fname, mode)
+    return open(vcf_fname, mode)
+
+
+@contextlib.contextmanager
+def open_vcf_output(vcf_fname, logger):
+    """
+    Function that opens an output VCF file for writing (text), files ending with '.gz' are compressed (BGZF) by a
+    multithreaded bgzip process while they are written, i.e. no uncompressed copy is written to disk
+    """
+    if not vcf_fname.endswith('.gz'):
+        with open(vcf_fname, 'w') as out:
+            yield out
+        return
+    with open(vcf_fname, 'wb') as out_gz:
+        bgzip_proc = subprocess.Popen(['bgzip', '-@', str(BGZIP_N_THREADS), '-c'], stdin = subprocess.PIPE, stdout = out_gz,
+                                      universal_newlines = True)
+        try:
+            yield bgzip_proc.stdin
+        finally:
+            bgzip_proc.stdin.close()
+            bgzip_proc.wait()
+    if bgzip_proc.returncode != 0:
+        error_message(f'Compression of {vcf_fname} failed (bgzip exit code {bgzip_proc.returncode})', logger)
+
+
+def split_vcf_by_density(vcf_fname, shard_vcf_fnames, logger):
+    """
+    Function that splits a coordinate-sorted VCF file into (at most) len(shard_vcf_fnames) contiguous genomic chunks
+    with approximately the same number of variant records each, i.e. chunk boundaries follow the variant density
+    along the genome rather than fixed chromosome/region sizes. Records with identical CHROM/POS are never
+    split across chunks. Each chunk is written as an uncompressed VCF with the full header of the input VCF
+
+    Returns the list of chunk files that were written (chunks are skipped if there are fewer records than chunks)
+    """
+    num_records = 0
+    with open_vcf_text(vcf_fname) as f:
+        for line in f:
+            if not line.startswith('#'):
+                num_records += 1
+
+    num_shards = max(1, min(len(shard_vcf_fnames), num_records))
+    records_per_shard = -(-num_records // num_shards)
+    logger.info(f'Splitting {num_records} variant records into {num_shards} chunks of ~{records_per_shard} records')
+
+    header_lines = []
+    shard_fnames_written = []
+    shard_index = -1
+    shard_records = records_per_shard
+    prev_locus = None
+    out = None
+    with open_vcf_text(vcf_fname) as f:
+        for line in f:
+            if line.startswith('#'):
+                header_lines.append(line)
+                continue
+            fields = line.split('\t', 2)
+            locus = (fields[0], fields[1])
+            if shard_records >= records_per_shard and locus != prev_locus and shard_index < num_shards - 1:
+                if out is not None:
+                    out.close()
+                shard_index += 1
+                shard_records = 0
+                out = open(shard_vcf_fnames[shard_index], 'w')
+                out.writelines(header_lines)
+                shard_fnames_written.append(shard_vcf_fnames[shard_index])
+            out.write(line)
+            shard_records += 1
+            prev_locus = locus
+
+    if out is None:
+        ## no variant records - a single chunk with the header only
+        with open(shard_vcf_fnames[0], 'w') as out:
+            out.writelines(header_lines)
+        shard_fnames_written.append(shard_vcf_fnames[0])
+    else:
+        out.close()
+
+    return shard_fnames_written
+
+
+def concat_vcf_shards(shard_vcf_fnames, out_vcf, logger):
+    """
+    Function that concatenates the (uncompressed or bgzipped) VCF files of consecutive genomic chunks into 'out_vcf'
+    (bgzipped if it ends with '.gz'), keeping the header of the first chunk. Since chunks are contiguous and given in coordinate order,
+    the concatenated VCF remains sorted
+    """
+    num_records = 0
+    with open_vcf_output(out_vcf, logger) as out:
+        for i, shard_vcf in enumerate(shard_vcf_fnames):
+            with open_vcf_text(shard_vcf) as f:
+                for line in f:
+                    if line.startswith('#'):
+                        if i == 0:
+                            out.write(line)
+                        continue
+                    out.write(line)
+                    num_records += 1
+    logger.info(f'Concatenated {num_records} variant records from {len(shard_vcf_fnames)} chunks')
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import bisect
+import gzip
+import heapq
+import itertools
+
+from lib.gvanno.utils import error_message
+from lib.gvanno.vcfsort import get_record_sort_key
+
+
+def read_target_regions(target_bed, padding, logger):
+    """
+    Function that reads the target regions (BED, plain or gzipped) into a sorted interval index: for each chromosome
+    ('chr' prefix stripped), sorted start and end positions (0-based, half-open) of the target regions extended by
+    'padding' bp on each side, with overlapping regions merged
+    """
+    regions = {}
+    num_regions = 0
+    f = gzip.open(target_bed, 'rt') if target_bed.endswith('.gz') else open(target_bed, 'r')
+    for line in f:
+        if line.startswith('#') or line.startswith('track') or line.startswith('browser') or not line.strip():
+            continue
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 3 or not fields[1].isdigit() or not fields[2].isdigit():
+            error_message(f'Target BED file {target_bed} should have (at least) three tab-separated columns (chrom, start, end) - found \'{line.strip()}\'', logger)
+        chrom = fields[0][3:] if fields[0].startswith('chr') else fields[0]
+        if not chrom in regions:
+            regions[chrom] = []
+        regions[chrom].append((max(0, int(fields[1]) - padding), int(fields[2]) + padding))
+        num_regions += 1
+    f.close()
+    if num_regions == 0:
+        error_message(f'Target BED file {target_bed} does not contain any regions', logger)
+
+    target_index = {}
+    target_size = 0
+    for chrom in regions:
+        starts = []
+        ends = []
+        for start, end in sorted(regions[chrom]):
+            if starts and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        target_index[chrom] = (starts, ends)
+        target_size += sum(e - s for s, e in zip(starts, ends))
+    logger.info(f'Target regions: {num_regions} regions in {target_bed} (padding {padding} bp), ' + \
+                f'{sum(len(target_index[c][0]) for c in target_index)} merged regions covering {target_size} bp')
+    return target_index
+
+
+def is_on_target(target_index, line):
+    """
+    Function that checks whether a (normalized) VCF record line overlaps a target region
+    """
+    chrom, pos, _, ref, _ = line.split('\t', 4)
+    if not chrom in target_index:
+        return False
+    starts, ends = target_index[chrom]
+    var_start = int(pos) - 1
+    var_end = var_start + len(ref)
+    ## last region that starts before the end of the variant (regions are merged, i.e. non-overlapping)
+    i = bisect.bisect_left(starts, var_end) - 1
+    return i >= 0 and ends[i] > var_start
+
+
+def read_off_target_records(off_target, counts):
+    for line in off_target:
+        if not line.startswith('#'):
+            counts['off_target'] += 1
+            yield line
+
+
+def merge_off_target_records(annotated_vcf, off_target_vcf, merged_vcf, contig_rank, logger):
+    """
+    Function that merges off-target records (sorted VCF, not annotated, written by gvanno-validate-input) into the
+    (sorted, bgzipped) annotated VCF, i.e. off-target records are passed through to the output without annotation
+    """
+    counts = {'off_target': 0}
+    with gzip.open(annotated_vcf, 'rt') as annotated, open(off_target_vcf, 'r') as off_target, open(merged_vcf, 'w') as out:
+        first_record = []
+        for line in annotated:
+            if not line.startswith('#'):
+                first_record.append(line)
+                break
+            out.write(line)
+        for line in heapq.merge(itertools.chain(first_record, annotated), read_off_target_records(off_target, counts),
+                                key = lambda line: get_record_sort_key(line, contig_rank)):
+            out.write(line)
+    logger.info(f"Passed {counts['off_target']} off-target records through to the output (not annotated)")
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import subprocess
+
+import numpy as np
+
+from lib.gvanno.shard import open_vcf_text, open_vcf_output
+from lib.gvanno.utils import error_message, remove_file
+from lib.gvanno.dbnsfp_store import load_dbnsfp_store_chromosome, lookup_dbnsfp_store
+
+
+def get_track_contigs(track_fname):
+    """
+    Function that lists the contigs of a tabix-indexed annotation track
+    """
+    return set(subprocess.check_output(['tabix', '-l', track_fname], universal_newlines=True).split())
+
+
+def get_track_contig(chrom, track_contigs):
+    """
+    Function that maps a query chromosome to the contig name of an annotation track (with or without 'chr' prefix,
+    as vcfanno does), returns None if the track has no records on this chromosome
+    """
+    if chrom in track_contigs:
+        return chrom
+    chrom_alias = chrom[3:] if chrom.startswith('chr') else 'chr' + chrom
+    if chrom_alias in track_contigs:
+        return chrom_alias
+    return None
+
+
+def read_query_blocks(query_vcf):
+    """
+    Generator over the records of a query VCF, yields a (chrom, sites) tuple for each block of records on the
+    same chromosome, where sites is a list of (start, end, ref, alt) (0-based, half-open intervals)
+    """
+    chrom = None
+    sites = []
+    with open_vcf_text(query_vcf) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.split('\t', 5)
+            if fields[0] != chrom:
+                if sites:
+                    yield chrom, sites
+                chrom = fields[0]
+                sites = []
+            start = int(fields[1]) - 1
+            sites.append((start, start + len(fields[3]), fields[3], fields[4]))
+    if sites:
+        yield chrom, sites
+
+
+def get_query_regions(sites):
+    """
+    Function that merges the intervals of query sites into sorted, non-overlapping regions (1-based, inclusive)
+    """
+    regions = []
+    for start, end, ref, alt in sorted(sites):
+        if regions and start <= regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], end)
+        else:
+            regions.append([start + 1, end])
+    return regions
+
+
+def fetch_track_records(track, contig, regions, regions_fname):
+    """
+    Generator over the records of an annotation track that overlap the query regions, in sorted order, yields
+    (start, end, ref, alts, values) tuples, where values holds the annotation value(s) of each track tag
+    """
+    with open(regions_fname, 'w') as f:
+        for start, end in regions:
+            f.write(f'{contig}\t{start}\t{end}\n')
+    proc = subprocess.Popen(['tabix', '-R', regions_fname, track['track_fname']], stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    max_start = -1
+    lines_at_max_start = set()
+    for line in proc.stdout:
+        if line.startswith('#'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        start = int(fields[1]) - 1 if track['format'] == 'vcf' else int(fields[1])
+        ## tabix reports a record once for each (merged) query region it overlaps, records that are out of order
+        ## are copies of records that were already reported
+        if start < max_start or (start == max_start and line in lines_at_max_start):
+            continue
+        if start > max_start:
+            max_start = start
+            lines_at_max_start = set()
+        lines_at_max_start.add(line)
+        if track['format'] == 'bed':
+            yield start, int(fields[2]), None, None, {track['tags'][0]: fields[3]}
+            continue
+        values = {}
+        for info_element in fields[7].split(';'):
+            tag, sep, value = info_element.partition('=')
+            if tag in track['tag_types']:
+                values[tag] = True if track['tag_types'][tag] == 'Flag' else value
+        yield start, start + len(fields[3]), fields[3], fields[4].split(','), values
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise RuntimeError(f'tabix exited with error code {proc.returncode} for {track["track_fname"]}')
+
+
+def format_mean(values):
+    """
+    Function that computes the mean of numeric track values, in double precision and formatted with the shortest
+    decimal representation (as done by vcfanno's 'mean' operation), returns None if no value is numeric
+    """
+    numbers = []
+    for value in values:
+        try:
+            numbers.append(float(value))
+        except ValueError:
+            continue
+    if not numbers:
+        return None
+    return np.format_float_positional(np.float64(sum(numbers) / len(numbers)), trim='-')
+
+
+def select_allele_values(track, alts, alt, values):
+    """
+    Function that selects the values of Number=A tags of a (multi-allelic) track record for the query ALT allele,
+    as vcfanno does, values of other tags are kept as is
+    """
+    selected_values = {}
+    for tag, value in values.items():
+        if track['tag_numbers'].get(tag) == 'A' and not value is True:
+            allele_values = value.split(',')
+            if len(allele_values) == len(alts):
+                value = ','.join([allele_value for allele_value, track_alt in zip(allele_values, alts) if track_alt == alt])
+        selected_values[tag] = value
+    return selected_values
+
+
+def get_site_annotation(track, matches):
+    """
+    Function that reduces the values of all track records matching a query site with the vcfanno operation of the
+    track ('concat' or 'mean'), returns the VCF INFO elements of the site (in the order of the track tags)
+    """
+    info_elements = []
+    for tag in track['tags']:
+        values = [m[tag] for m in matches if tag in m]
+        if not values:
+            continue
+        if track['tag_types'].get(tag) == 'Flag':
+            info_elements.append(tag)
+        elif track['op'] == 'mean':
+            mean_value = format_mean(values)
+            if not mean_value is None:
+                info_elements.append(f'{tag}={mean_value}')
+        else:
+            info_elements.append(f'{tag}={",".join(values)}')
+    return ';'.join(info_elements)
+
+
+def annotate_track(track, query_vcf, annotation_fname):
+    """
+    Function that annotates the query VCF against a single tabix-indexed track, by a sorted merge-join of the query
+    sites and the track records overlapping them (per chromosome). VCF track records match query sites with the
+    same position, REF and ALT, BED track records match all query sites they overlap. The INFO elements of each
+    query record (empty if no match) are written to 'annotation_fname', one line per query record in input order.
+    Tracks with a columnar store (track['store'], dbNSFP) are looked up in the store instead.
+    Returns the number of annotated query records
+    """
+    if 'store' in track:
+        track_contigs = set(track['store']['manifest']['chromosomes'].keys())
+        allele_index = {allele: i for i, allele in enumerate(track['store']['manifest']['alleles'])}
+    else:
+        track_contigs = get_track_contigs(track['track_fname'])
+    regions_fname = f'{annotation_fname}.regions.tsv'
+    num_annotated = 0
+    with open(annotation_fname, 'w') as out:
+        for chrom, sites in read_query_blocks(query_vcf):
+            site_annotations = [''] * len(sites)
+            contig = get_track_contig(chrom, track_contigs)
+            if not contig is None and 'store' in track:
+                store_arrays = load_dbnsfp_store_chromosome(track['store']['dir'], track['store']['manifest'], contig)
+                for i, values in enumerate(lookup_dbnsfp_store(store_arrays, track['store']['manifest'], allele_index, sites)):
+                    if values:
+                        site_annotations[i] = get_site_annotation(track, [{track['tags'][0]: value} for value in values])
+            elif not contig is None:
+                records = fetch_track_records(track, contig, get_query_regions(sites), regions_fname)
+                next_record = next(records, None)
+                active_records = []
+                for i in sorted(range(len(sites)), key=lambda i: sites[i][0]):
+                    start, end, ref, alt = sites[i]
+                    while not next_record is None and next_record[0] < end:
+                        active_records.append(next_record)
+                        next_record = next(records, None)
+                    active_records = [r for r in active_records if r[1] > start]
+                    if track['format'] == 'bed':
+                        matches = [r[4] for r in active_records if r[0] < end]
+                    else:
+                        matches = [select_allele_values(track, r[3], alt, r[4]) for r in active_records
+                                   if r[0] == start and r[2] == ref and alt in r[3]]
+                    if matches:
+                        site_annotations[i] = get_site_annotation(track, matches)
+                ## read the remaining track records (tabix exit code is checked at the end)
+                for next_record in records:
+                    pass
+            for site_annotation in site_annotations:
+                out.write(site_annotation + '\n')
+                if site_annotation != '':
+                    num_annotated += 1
+    remove_file(regions_fname)
+    return num_annotated
+
+
+def set_info_elements(info, info_elements):
+    """
+    Function that adds INFO elements to the INFO column of a VCF record, existing INFO tags are overwritten
+    """
+    if info_elements == '':
+        return info
+    elements = [] if info == '.' else info.split(';')
+    tag_index = {e.partition('=')[0]: i for i, e in enumerate(elements)}
+    for element in info_elements.split(';'):
+        tag = element.partition('=')[0]
+        if tag in tag_index:
+            elements[tag_index[tag]] = element
+        else:
+            tag_index[tag] = len(elements)
+            elements.append(element)
+    return ';'.join(elements)
+
+
+def merge_track_annotations(query_vcf, annotation_fnames, vcfheader_lines, output_vcf, logger):
+    """
+    Function that merges per-track annotations (files with the INFO elements of each query record, one line per
+    query record in input order) into the query records by ordinal, written to 'output_vcf' (bgzipped if it ends
+    with '.gz') with header 'vcfheader_lines'. Existing INFO tags are overwritten, new tags are appended in track order
+    """
+    annotation_files = [open(annotation_fname, 'r') for annotation_fname in annotation_fnames]
+    num_records = 0
+    with open_vcf_text(query_vcf) as f, open_vcf_output(output_vcf, logger) as out:
+        out.writelines(vcfheader_lines)
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            for annotation_file in annotation_files:
+                annotation = annotation_file.readline()
+                if annotation == '':
+                    error_message(f'Annotation file {annotation_file.name} has fewer records than {query_vcf}', logger)
+                fields[7] = set_info_elements(fields[7], annotation.rstrip('\n'))
+            out.write('\t'.join(fields) + '\n')
+            num_records += 1
+    for annotation_file in annotation_files:
+        if annotation_file.readline() != '':
+            error_message(f'Annotation file {annotation_file.name} has more records than {query_vcf}', logger)
+        annotation_file.close()
+    return num_records
+
+
+def run_track_annotation(query_vcf, tracks, vcfheader_lines, output_vcf, num_processes, debug, logger):
+    """
+    Function that annotates a query VCF against annotation tracks without vcfanno: each track is annotated by a
+    separate process (at most 'num_processes' concurrently), and the per-track annotations are merged into the
+    query records (in input order) of 'output_vcf' (bgzipped if it ends with '.gz'), with header 'vcfheader_lines'
+    """
+    prefix = output_vcf[:-3] if output_vcf.endswith('.gz') else output_vcf
+    annotation_fnames = [f'{prefix}.tmp.{track["name"]}.annotation.txt' for track in tracks]
+    if tracks:
+        pool = multiprocessing.Pool(max(1, min(int(num_processes), len(tracks))))
+        track_runs = [pool.apply_async(annotate_track, (track, query_vcf, annotation_fname))
+                      for track, annotation_fname in zip(tracks, annotation_fnames)]
+        pool.close()
+        for track, track_run in zip(tracks, track_runs):
+            try:
+                num_annotated = track_run.get()
+            except Exception as e:
+                pool.terminate()
+                error_message(f'Annotation against {track["name"]} ({track["track_fname"]}) failed: {e}', logger)
+            logger.info(f'Track {track["name"]}: {num_annotated} annotated variant records')
+        pool.join()
+
+    merge_track_annotations(query_vcf, annotation_fnames, vcfheader_lines, output_vcf, logger)
+    if not debug:
+        for annotation_fname in annotation_fnames:
+            remove_file(annotation_fname)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import math
+import os
+
+from lib.gvanno.gvanno_vars import VEP_MIN_FORKS, VEP_MAX_FORKS, VEP_MIN_BUFFER_SIZE, VEP_MAX_BUFFER_SIZE, VEP_FORK_MEMORY_MB, \
+    VEP_FORK_BUFFER_SIZE, VEP_BUFFER_VARIANT_MEMORY_KB, VCFANNO_MAX_PROC, VCFANNO_PROCESS_MEMORY_MB
+
+
+def read_cgroup_value(fname):
+    try:
+        with open(fname, 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def get_available_cpus():
+    """
+    Function that returns the number of CPUs available to the current process, i.e. the CPU affinity
+    of the process, limited by the CPU quota of its cgroup (v2: cpu.max, v1: cpu.cfs_quota_us/cpu.cfs_period_us)
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        num_cpus = len(os.sched_getaffinity(0))
+    else:
+        num_cpus = os.cpu_count() or 1
+
+    cgroup_cpus = None
+    cpu_max = read_cgroup_value('/sys/fs/cgroup/cpu.max')
+    if not cpu_max is None:
+        quota, period = (cpu_max.split() + ['100000'])[:2]
+        if quota != 'max':
+            cgroup_cpus = int(quota) / int(period)
+    else:
+        quota = read_cgroup_value('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = read_cgroup_value('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+        if not quota is None and not period is None and int(quota) > 0:
+            cgroup_cpus = int(quota) / int(period)
+
+    if not cgroup_cpus is None:
+        num_cpus = min(num_cpus, max(1, int(cgroup_cpus)))
+    return num_cpus
+
+
+def get_available_memory_mb():
+    """
+    Function that returns the memory (MB) available to the current process, i.e. the available memory of the
+    host (MemAvailable), limited by the unused part of the memory limit of its cgroup (v2: memory.max, v1: memory.limit_in_bytes).
+    Returns None if the available memory can not be determined
+    """
+    available_mb = None
+    meminfo = read_cgroup_value('/proc/meminfo')
+    if not meminfo is None:
+        for line in meminfo.split('\n'):
+            if line.startswith('MemAvailable:'):
+                available_mb = int(line.split()[1]) / 1024.0
+
+    limit = read_cgroup_value('/sys/fs/cgroup/memory.max')
+    usage = read_cgroup_value('/sys/fs/cgroup/memory.current')
+    if limit is None:
+        limit = read_cgroup_value('/sys/fs/cgroup/memory/memory.limit_in_bytes')
+        usage = read_cgroup_value('/sys/fs/cgroup/memory/memory.usage_in_bytes')
+    if not limit is None and limit.isdigit():
+        cgroup_available_mb = (int(limit) - int(usage or 0)) / (1024.0 * 1024.0)
+        ## cgroup v1 reports an unlimited cgroup as a very large number
+        if available_mb is None or cgroup_available_mb < available_mb:
+            available_mb = cgroup_available_mb
+
+    return max(0.0, available_mb) if not available_mb is None else None
+
+
+def auto_tune_resources(num_variants, n_shards, vep_n_chunks, vep_n_workers, streaming, logger):
+    """
+    Function that picks the number of VEP forks, the VEP buffer size and the number of vcfanno processes from the
+    available CPUs/memory (cgroup-aware) and the number of query variants, for each of 'n_shards' concurrently annotated chunks.
+    The CPUs/memory of a shard are divided over its concurrent VEP processes, i.e. 'vep_n_chunks' genomic chunks or
+    'vep_n_workers' VEP workers:
+
+    1. VEP forks - one per CPU (one CPU is left for vcfanno/summarise with 'streaming'), limited by memory (VEP_FORK_MEMORY_MB
+       plus VEP_FORK_BUFFER_SIZE buffered variants per fork) and by the input size (forks for less
+       than VEP_FORK_BUFFER_SIZE variants mostly spend time on start-up), within VEP_MIN_FORKS/VEP_MAX_FORKS
+    2. VEP buffer size - VEP_FORK_BUFFER_SIZE variants per fork, limited by the input size and by the memory left
+       after the forks (VEP_BUFFER_VARIANT_MEMORY_KB per variant), within VEP_MIN_BUFFER_SIZE/VEP_MAX_BUFFER_SIZE
+    3. vcfanno processes - one per CPU (CPUs not used by VEP forks when VEP and vcfanno run concurrently ('streaming')),
+       limited by memory (VCFANNO_PROCESS_MEMORY_MB per process), within 1/VCFANNO_MAX_PROC
+
+    The choices and the reasoning behind them are logged
+    """
+    num_cpus = get_available_cpus()
+    memory_mb = get_available_memory_mb()
+    cpus_per_shard = max(1, num_cpus // n_shards)
+    memory_per_shard_mb = memory_mb / n_shards if not memory_mb is None else None
+    variants_per_shard = max(1, int(math.ceil(num_variants / n_shards)))
+    ## VEP processes that run concurrently within a shard (genomic chunks and VEP workers are not combined)
+    n_vep_processes = max(1, vep_n_chunks, vep_n_workers)
+    cpus_per_vep = max(1, cpus_per_shard // n_vep_processes)
+    memory_per_vep_mb = memory_per_shard_mb / n_vep_processes if not memory_per_shard_mb is None else None
+    variants_per_vep = max(1, int(math.ceil(variants_per_shard / n_vep_processes)))
+
+    memory_msg = f'{int(memory_mb)} MB memory' if not memory_mb is None else 'unknown amount of memory (no memory limit applied)'
+    logger.info(f'Auto-tune: {num_cpus} CPU(s) and {memory_msg} available, {num_variants} variants in {n_shards} shard(s) - ' + \
+                f'{cpus_per_shard} CPU(s) and {variants_per_shard} variants per shard')
+    if n_vep_processes > 1:
+        logger.info(f'Auto-tune: {n_vep_processes} concurrent VEP processes per shard - {cpus_per_vep} CPU(s) and ' + \
+                    f'{variants_per_vep} variants per VEP process')
+
+    ## VEP forks (memory of a fork includes its share of the variant buffer)
+    n_forks = cpus_per_vep
+    reason = f'one per CPU ({cpus_per_vep})'
+    if streaming and cpus_per_vep > 1:
+        n_forks = cpus_per_vep - 1
+        reason = f'one per CPU ({cpus_per_vep}), except one CPU for vcfanno/summarise running concurrently'
+    fork_memory_mb = VEP_FORK_MEMORY_MB + VEP_FORK_BUFFER_SIZE * VEP_BUFFER_VARIANT_MEMORY_KB / 1024.0
+    if not memory_per_vep_mb is None and int(memory_per_vep_mb // fork_memory_mb) < n_forks:
+        n_forks = int(memory_per_vep_mb // fork_memory_mb)
+        reason = f'limited by memory ({int(memory_per_vep_mb)} MB per VEP process, ~{int(fork_memory_mb)} MB per fork)'
+    if int(math.ceil(variants_per_vep / VEP_FORK_BUFFER_SIZE)) < n_forks:
+        n_forks = int(math.ceil(variants_per_vep / VEP_FORK_BUFFER_SIZE))
+        reason = f'limited by input size ({variants_per_vep} variants, ~{VEP_FORK_BUFFER_SIZE} variants per fork)'
+    if n_forks < VEP_MIN_FORKS or n_forks > VEP_MAX_FORKS:
+        n_forks = min(max(n_forks, VEP_MIN_FORKS), VEP_MAX_FORKS)
+        reason = reason + f', bounded to {VEP_MIN_FORKS}-{VEP_MAX_FORKS}'
+    logger.info(f'Auto-tune: VEP forks (--vep_n_forks) = {n_forks} - {reason}')
+
+    ## VEP buffer size
+    buffer_size = n_forks * VEP_FORK_BUFFER_SIZE
+    reason = f'{VEP_FORK_BUFFER_SIZE} variants per fork'
+    if variants_per_vep < buffer_size:
+        buffer_size = variants_per_vep
+        reason = f'limited by input size ({variants_per_vep} variants)'
+    if not memory_per_vep_mb is None:
+        max_buffer_size = int(max(0, memory_per_vep_mb - n_forks * VEP_FORK_MEMORY_MB) * 1024 // VEP_BUFFER_VARIANT_MEMORY_KB)
+        if max_buffer_size < buffer_size:
+            buffer_size = max_buffer_size
+            reason = f'limited by memory left after VEP forks (~{VEP_BUFFER_VARIANT_MEMORY_KB} KB per variant)'
+    if buffer_size < VEP_MIN_BUFFER_SIZE or buffer_size > VEP_MAX_BUFFER_SIZE:
+        buffer_size = min(max(buffer_size, VEP_MIN_BUFFER_SIZE), VEP_MAX_BUFFER_SIZE)
+        reason = reason + f', bounded to {VEP_MIN_BUFFER_SIZE}-{VEP_MAX_BUFFER_SIZE}'
+    logger.info(f'Auto-tune: VEP buffer size (--vep_buffer_size) = {buffer_size} - {reason}')
+
+    ## vcfanno processes
+    n_processes = cpus_per_shard
+    reason = f'one per CPU ({cpus_per_shard})'
+    if streaming:
+        n_processes = max(1, cpus_per_shard - n_forks)
+        reason = 'one per CPU not used by VEP forks (VEP and vcfanno run concurrently)'
+    if not memory_per_shard_mb is None:
+        max_processes = max(1, int(max(0, memory_per_shard_mb - n_forks * VEP_FORK_MEMORY_MB) // VCFANNO_PROCESS_MEMORY_MB)) \
+            if streaming else max(1, int(memory_per_shard_mb // VCFANNO_PROCESS_MEMORY_MB))
+        if max_processes < n_processes:
+            n_processes = max_processes
+            reason = f'limited by memory (~{VCFANNO_PROCESS_MEMORY_MB} MB per process)'
+    if n_processes > VCFANNO_MAX_PROC:
+        n_processes = VCFANNO_MAX_PROC
+        reason = reason + f', bounded to 1-{VCFANNO_MAX_PROC}'
+    logger.info(f'Auto-tune: vcfanno processes (--vcfanno_n_processes) = {n_processes} - {reason}')
+
+    tuned_options = {}
+    tuned_options['vep_n_forks'] = n_forks
+    tuned_options['vep_buffer_size'] = buffer_size
+    tuned_options['vcfanno_n_processes'] = n_processes
+    return tuned_options
@@ -14,6 +14,9 @@ import random
 def getlogger(logger_name):
     logger = logging.getLogger(logger_name)
     logger.setLevel(logging.DEBUG)
+    # avoid duplicated log messages if the logger is requested multiple times within the same process
+    if logger.handlers:
+        return logger
     # create console handler and set level to debug
     ch = logging.StreamHandler(sys.stdout)
     ch.setLevel(logging.DEBUG)
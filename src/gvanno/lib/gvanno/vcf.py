@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
 import logging
+import re
 
-from lib.gvanno.utils import error_message, warn_message, check_subprocess
+from lib.gvanno.utils import error_message, warn_message
+from lib.gvanno.shard import open_vcf_text
 from cyvcf2 import VCF
 from typing import Union
 
@@ -18,13 +20,64 @@ def get_vcf_info_tags(vcf_fname):
     return info_tags
 
 
-def print_vcf_header(vcf_fname, vcfheader_file, logger, chromline_only=False):
-    if chromline_only == True:
-        check_subprocess(
-            logger, f'bgzip -dc {vcf_fname} | egrep \'^#\' | egrep \'^#CHROM\' >> {vcfheader_file}', debug=False)
-    else:
-        check_subprocess(
-            logger, f'bgzip -dc {vcf_fname} | egrep \'^#\' | egrep -v \'^#CHROM\' > {vcfheader_file}', debug=False)
+def read_vcf_header_lines(vcf_fname):
+    """
+    Function that reads the header lines of a (plain or bgzipped) VCF file, i.e. reading stops at the '#CHROM' line
+    (only the first BGZF blocks are decompressed). Returns the meta-information lines ('##') and the '#CHROM' line
+    """
+    meta_lines = []
+    chrom_line = None
+    with open_vcf_text(vcf_fname) as f:
+        for line in f:
+            if line.startswith('#CHROM'):
+                chrom_line = line
+                break
+            if not line.startswith('#'):
+                break
+            meta_lines.append(line)
+    return meta_lines, chrom_line
+
+
+def get_vcf_info_tag_numbers(vcf_fname):
+    """
+    Function that returns the Number (e.g. '1', 'A', '.') of each INFO tag declared in the header of a VCF file
+    """
+    info_tag_numbers = {}
+    meta_lines, chrom_line = read_vcf_header_lines(vcf_fname)
+    for line in meta_lines:
+        if not line.startswith('##INFO=<'):
+            continue
+        tag = re.search(r'[<,]ID=([^,>]+)', line)
+        number = re.search(r'[<,]Number=([^,>]+)', line)
+        if not tag is None and not number is None:
+            info_tag_numbers[tag.group(1)] = number.group(1)
+    return info_tag_numbers
+
+
+def swap_vcf_info_header(vcf_stream, out_stream, info_header_lines):
+    """
+    Function that copies an uncompressed VCF stream (binary file objects) line by line, replacing 
+    the INFO header lines of any tag defined in 'info_header_lines' with the given lines. 
+    The replacement lines are written just before the '#CHROM' line
+    """
+    replaced_info_tags = {}
+    for line in info_header_lines:
+        if line.startswith('##INFO=<ID='):
+            replaced_info_tags[line.split(',')[0].replace('##INFO=<ID=', '')] = 1
+
+    in_header = True
+    for line in vcf_stream:
+        if in_header:
+            if line.startswith(b'##INFO=<ID='):
+                tag = line.split(b',')[0].replace(b'##INFO=<ID=', b'').decode()
+                if tag in replaced_info_tags:
+                    continue
+            elif line.startswith(b'#CHROM'):
+                for header_line in info_header_lines:
+                    out_stream.write((header_line.rstrip('\n') + '\n').encode())
+                in_header = False
+        out_stream.write(line)
+    out_stream.close()
 
 def detect_reserved_info_tag(tag, tag_name, logger):
     reserved_tags = ['AA', 'AC', 'AF', 'AN', 'BQ', 'CIGAR', 'DB', 'DP', 'END',
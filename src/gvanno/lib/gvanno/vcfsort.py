@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import heapq
+import multiprocessing
+import os
+
+from lib.gvanno.utils import remove_file
+
+## approximate memory (bytes) used by a record line held in memory, in addition to its length (Python string and list overhead)
+LINE_MEMORY_OVERHEAD = 100
+
+
+def get_record_sort_key(line, contig_rank):
+    """
+    Function that returns the sort key (contig rank, position) of a VCF record line
+    """
+    chrom, pos, _ = line.split('\t', 2)
+    return (contig_rank.get(chrom, len(contig_rank)), int(pos))
+
+
+def write_sorted_run(lines, contig_rank, run_fname):
+    """
+    Function that sorts a chunk of VCF record lines (stable, i.e. records at the same position keep their
+    input order) and writes them to 'run_fname', run in a worker process during run generation
+    """
+    lines.sort(key = lambda line: get_record_sort_key(line, contig_rank))
+    with open(run_fname, 'w') as f:
+        f.writelines(lines)
+    return run_fname
+
+
+def read_run(run_fname):
+    with open(run_fname, 'r') as f:
+        for line in f:
+            yield line
+
+
+def sort_vcf_records(lines, contig_rank, temp_dir, max_memory_mb, n_processes, logger):
+    """
+    Function that sorts VCF record lines (generator, lines end with a newline) by contig (rank in 'contig_rank',
+    unknown contigs last) and position, using a bounded-memory external merge sort:
+    1. Run generation - chunks of records are sorted and written to temporary run files in 'temp_dir'. With
+       'n_processes' > 1, chunks are sorted/written by a pool of worker processes while the next chunk is read.
+       Chunks that are read or in flight together use at most ~'max_memory_mb'
+    2. Merge - the sorted runs are merged (heapq), records at the same position keep their input order
+    Records that fit in a single chunk are sorted in memory (no temporary files). Yields the sorted lines
+    """
+    n_processes = max(1, int(n_processes))
+    chunk_max_bytes = max(1, int(max_memory_mb * 1024 * 1024 / (n_processes + 1)))
+
+    pool = None
+    pending_runs = []
+    run_fnames = []
+    chunk = []
+    chunk_bytes = 0
+    for line in lines:
+        chunk.append(line)
+        chunk_bytes += len(line) + LINE_MEMORY_OVERHEAD
+        if chunk_bytes < chunk_max_bytes:
+            continue
+        run_fname = os.path.join(temp_dir, f'gvanno_sort.{os.getpid()}.run{len(run_fnames) + 1}.vcf')
+        run_fnames.append(run_fname)
+        if n_processes > 1:
+            if pool is None:
+                pool = multiprocessing.Pool(n_processes)
+            ## bounded number of chunks in flight
+            if len(pending_runs) >= n_processes:
+                pending_runs.pop(0).get()
+            pending_runs.append(pool.apply_async(write_sorted_run, (chunk, contig_rank, run_fname)))
+        else:
+            write_sorted_run(chunk, contig_rank, run_fname)
+        chunk = []
+        chunk_bytes = 0
+
+    if not run_fnames:
+        chunk.sort(key = lambda line: get_record_sort_key(line, contig_rank))
+        for line in chunk:
+            yield line
+        return
+
+    if chunk:
+        run_fname = os.path.join(temp_dir, f'gvanno_sort.{os.getpid()}.run{len(run_fnames) + 1}.vcf')
+        run_fnames.append(run_fname)
+        write_sorted_run(chunk, contig_rank, run_fname)
+        chunk = []
+    for run in pending_runs:
+        run.get()
+    if not pool is None:
+        pool.close()
+        pool.join()
+    logger.info(f'Sorting: merging {len(run_fnames)} sorted runs (max. memory {max_memory_mb} MB, {n_processes} process(es))')
+
+    try:
+        for line in heapq.merge(*[read_run(fname) for fname in run_fnames], key = lambda line: get_record_sort_key(line, contig_rank)):
+            yield line
+    finally:
+        for fname in run_fnames:
+            remove_file(fname)
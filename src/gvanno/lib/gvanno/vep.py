@@ -4,10 +4,26 @@ import os,re
 import csv
 import gzip
 
-from lib.gvanno.annoutils import assign_cds_exon_intron_annotations
+from lib.gvanno.annoutils import assign_cds_exon_intron_annotations, read_infotag_file
 from lib.gvanno import gvanno_vars
 
 
+def get_vep_csq_fields(vep_infotags_tsv):
+    """
+    Function that returns the CSQ fields consumed by gvanno (VEP --fields), i.e. all VEP tags listed in the VEP info
+    tag file (vcf_infotags_vep.tsv), and the fields used to pick the primary consequence (gvanno_vars.VEP_CSQ_PICK_FIELDS).
+    Returns None (all CSQ fields) if the info tag file is not present
+    """
+    vep_info_tags = read_infotag_file(vep_infotags_tsv, scope = "vep")
+    if not vep_info_tags:
+        return None
+    csq_fields = ['Allele']
+    for tag in list(vep_info_tags.keys()) + gvanno_vars.VEP_CSQ_PICK_FIELDS:
+        if not tag in csq_fields:
+            csq_fields.append(tag)
+    return csq_fields
+
+
 def get_csq_record_annotations(csq_fields, varkey, logger, vep_csq_fields_map, transcript_xref_map):
     """
     Generates a dictionary object containing the annotations of a CSQ record.
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+import atexit
+import collections
+import os
+import queue
+import signal
+import subprocess
+import threading
+
+from lib.gvanno.shard import open_vcf_text, open_vcf_output
+from lib.gvanno.utils import error_message
+
+## number of times a VEP worker is restarted without progress (unfinished records are re-submitted) before the
+## worker pool gives up
+VEP_WORKER_MAX_RETRIES = 2
+
+## warm VEP worker pools of this process, keyed by VEP command
+vep_pools = {}
+
+
+def start_vep_worker(vep_command):
+    """
+    Function that starts a VEP worker process (VCF on stdin, VEP-annotated VCF on stdout). VEP loads its configuration,
+    cache index and plugins while it waits for input
+    """
+    proc = subprocess.Popen(vep_command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            universal_newlines=True, start_new_session=True)
+    return {'proc': proc}
+
+
+def stop_vep_worker(worker, kill = False):
+    proc = worker['proc']
+    if kill and proc.poll() is None:
+        ## the worker runs in its own session, i.e. the shell, VEP and its forks are killed together
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    try:
+        proc.stdin.close()
+    except (OSError, ValueError):
+        pass
+    proc.stdout.close()
+    proc.wait()
+
+
+def get_vep_pool(vep_command, n_workers, logger):
+    """
+    Function that returns a pool of 'n_workers' warm VEP worker processes for a given VEP command. VEP only flushes its
+    last buffer at the end of input, so a worker annotates the records of one VEP run, and the pool starts a new worker
+    for each finished worker right away, i.e. workers for subsequent VEP runs of this process are started ahead of time
+    """
+    if not vep_command in vep_pools:
+        vep_pools[vep_command] = {'command': vep_command, 'workers': []}
+    pool = vep_pools[vep_command]
+    while len(pool['workers']) < n_workers:
+        pool['workers'].append(start_vep_worker(vep_command))
+    logger.info(f"VEP worker pool: {len(pool['workers'])} workers")
+    return pool
+
+
+def shutdown_vep_pools():
+    """
+    Function that stops the (idle) workers of all VEP worker pools, registered to run at exit
+    """
+    for vep_command in list(vep_pools.keys()):
+        for worker in vep_pools[vep_command]['workers']:
+            stop_vep_worker(worker, kill = True)
+        del vep_pools[vep_command]
+
+
+atexit.register(shutdown_vep_pools)
+
+
+def get_record_key(line):
+    """
+    Function that returns the key (CHROM, POS, REF, ALT) of a VCF record, used to match VEP output to VEP input records
+    """
+    fields = line.split('\t', 5)
+    return (fields[0], fields[1], fields[3], fields[4])
+
+
+def feed_vep_worker(proc, state, lines):
+    """
+    Function that writes 'lines' (VCF header, and records re-submitted after a crash) to the stdin of a VEP worker,
+    followed by the records of the worker input queue as they arrive. Records are added to the pending records of the
+    worker before they are written. Stdin is closed at the end of input, so that VEP flushes its last buffer
+    """
+    try:
+        proc.stdin.writelines(lines)
+        proc.stdin.flush()
+        while not state['input_done']:
+            records = state['queue'].get()
+            if records is None:
+                state['input_done'] = True
+                break
+            with state['lock']:
+                state['pending'].extend(records)
+            proc.stdin.writelines([record[1] for record in records])
+            proc.stdin.flush()
+        proc.stdin.close()
+    except (OSError, ValueError):
+        ## worker crashed, detected by the reader (end of output)
+        pass
+
+
+def collect_vep_worker_output(proc, state, run):
+    """
+    Function that reads the output of a VEP worker, and matches the annotated records to the pending records of the
+    worker by CHROM/POS/REF/ALT. VEP keeps the input order, i.e. pending records ahead of a match were skipped by VEP
+    (no output record). Returns the number of matched records
+    """
+    output_header_lines = []
+    num_matched = 0
+    for line in proc.stdout:
+        if line.startswith('#'):
+            output_header_lines.append(line)
+            if line.startswith('#CHROM') and run['vep_header_lines'] is None:
+                run['vep_header_lines'] = [l for l in output_header_lines[:-1] if not l in run['header_lines']]
+            continue
+        key = get_record_key(line)
+        with state['lock']:
+            match = next((i for i, record in enumerate(state['pending']) if record[2] == key), None)
+            if match is None:
+                raise RuntimeError(f'VEP output record {":".join(key)} does not match a pending input record')
+            with run['done']:
+                for i in range(match):
+                    run['results'][state['pending'].popleft()[0]] = None
+                run['results'][state['pending'].popleft()[0]] = line
+                run['done'].notify_all()
+        num_matched += 1
+    return num_matched
+
+
+def run_vep_worker(pool, worker_index, state, run, logger):
+    """
+    Function that annotates the input records of a worker with a VEP worker process (written by a feeder thread and
+    read back concurrently). A worker that crashes is restarted, and its pending records are re-submitted (at most
+    VEP_WORKER_MAX_RETRIES times in a row without a matched record)
+    """
+    lines = run['header_lines']
+    attempt = 0
+    while True:
+        worker = pool['workers'][worker_index]
+        feeder = threading.Thread(target=feed_vep_worker, args=(worker['proc'], state, lines))
+        feeder.start()
+        try:
+            num_matched = collect_vep_worker_output(worker['proc'], state, run)
+        except Exception:
+            stop_vep_worker(worker, kill = True)
+            feeder.join()
+            raise
+        feeder.join()
+        returncode = worker['proc'].wait()
+        if returncode == 0 and state['input_done']:
+            with state['lock'], run['done']:
+                for record in state['pending']:
+                    run['results'][record[0]] = None
+                state['pending'].clear()
+                run['done'].notify_all()
+            return
+        stop_vep_worker(worker, kill = True)
+        attempt = 0 if num_matched > 0 else attempt + 1
+        if attempt > VEP_WORKER_MAX_RETRIES:
+            raise RuntimeError(f'VEP worker exited with error code {returncode} - no progress in {attempt} attempts')
+        logger.warning(f'VEP worker {worker_index} exited with error code {returncode} - restarting worker and ' + \
+                       f're-submitting {len(state["pending"])} records')
+        pool['workers'][worker_index] = start_vep_worker(pool['command'])
+        with state['lock']:
+            lines = run['header_lines'] + [record[1] for record in state['pending']]
+
+
+def run_vep_pool(vep_command, n_workers, input_vcf, output_vcf, buffer_size, logger):
+    """
+    Function that annotates a VCF file (plain or bgzipped) with a pool of 'n_workers' warm VEP workers ('vep_command'
+    reads from stdin and writes to stdout): blocks of 'buffer_size' records are distributed over the workers, that are
+    fed continuously, and the annotated records are matched to the input records by CHROM/POS/REF/ALT and reassembled
+    in input order in 'output_vcf' (bgzipped if it ends with '.gz'). Records skipped by VEP are not written.
+    Returns the number of annotated records (0 for input files without annotated records, where nothing is written)
+    """
+    run = {'header_lines': [], 'vep_header_lines': None, 'results': {}, 'done': threading.Condition()}
+    failures = []
+
+    f = open_vcf_text(input_vcf)
+    first_record = None
+    for line in f:
+        if not line.startswith('#'):
+            first_record = line
+            break
+        run['header_lines'].append(line)
+    if first_record is None:
+        f.close()
+        return 0
+
+    pool = get_vep_pool(vep_command, n_workers, logger)
+    states = [{'queue': queue.Queue(maxsize = 2), 'pending': collections.deque(), 'lock': threading.Lock(),
+               'input_done': False} for i in range(n_workers)]
+
+    def run_worker(worker_index):
+        try:
+            run_vep_worker(pool, worker_index, states[worker_index], run, logger)
+        except Exception as e:
+            failures.append(str(e))
+            with run['done']:
+                run['done'].notify_all()
+            ## discard the remaining input of the worker
+            if not states[worker_index]['input_done']:
+                while not states[worker_index]['queue'].get() is None:
+                    pass
+
+    dispatchers = [threading.Thread(target=run_worker, args=(i,)) for i in range(n_workers)]
+    for dispatcher in dispatchers:
+        dispatcher.start()
+
+    num_input_records = 0
+    num_blocks = 0
+    next_record = 0
+    num_records = 0
+
+    def write_ready_records(out):
+        nonlocal next_record, num_records
+        while next_record in run['results']:
+            line = run['results'].pop(next_record)
+            next_record += 1
+            if line is None:
+                continue
+            if num_records == 0:
+                out.writelines(run['header_lines'][:-1] + run['vep_header_lines'] + run['header_lines'][-1:])
+            out.write(line)
+            num_records += 1
+
+    with open_vcf_output(output_vcf, logger) as out:
+        block = [(0, first_record, get_record_key(first_record))]
+        num_input_records = 1
+        for line in f:
+            if failures:
+                break
+            block.append((num_input_records, line, get_record_key(line)))
+            num_input_records += 1
+            if len(block) >= buffer_size:
+                states[num_blocks % n_workers]['queue'].put(block)
+                num_blocks += 1
+                block = []
+                with run['done']:
+                    write_ready_records(out)
+        f.close()
+        if block and not failures:
+            states[num_blocks % n_workers]['queue'].put(block)
+            num_blocks += 1
+        for state in states:
+            state['queue'].put(None)
+        with run['done']:
+            while next_record < num_input_records and not failures:
+                write_ready_records(out)
+                if next_record < num_input_records and not failures:
+                    run['done'].wait()
+        for dispatcher in dispatchers:
+            dispatcher.join()
+
+    if failures:
+        error_message(f'VEP worker pool: {failures[0]}', logger)
+    ## workers have finished their input, start workers for the next VEP run of this process
+    for i, worker in enumerate(pool['workers']):
+        stop_vep_worker(worker)
+        pool['workers'][i] = start_vep_worker(vep_command)
+
+    if num_records < num_input_records:
+        logger.warning(f'VEP worker pool: {num_input_records - num_records} records skipped by VEP')
+    logger.info(f'VEP worker pool: annotated {num_records} records in {num_blocks} blocks')
+    return num_records
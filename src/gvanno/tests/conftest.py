@@ -0,0 +1,5 @@
+import os
+import sys
+
+## gvanno scripts import the library as 'lib.gvanno'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,104 @@
+import glob
+import gzip
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from lib.gvanno import trackanno
+from lib.gvanno.utils import getlogger
+import gvanno_vcfanno
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, os.pardir, 'examples')
+
+## gvanno data bundle (directory with 'data/<assembly>') used to compare the annotation engines on the example VCFs
+TEST_DATA_DIR = os.environ.get('GVANNO_TEST_DATA_DIR')
+
+requires_tabix = pytest.mark.skipif(shutil.which('bgzip') is None or shutil.which('tabix') is None,
+                                    reason='bgzip/tabix not found')
+
+TRACK_HEADER = '##fileformat=VCFv4.2\n' + \
+    '##INFO=<ID=AF,Number=A,Type=Float,Description="Allele frequency, per ALT allele">\n' + \
+    '##INFO=<ID=SRC,Number=.,Type=String,Description="Source">\n' + \
+    '##INFO=<ID=PATHO,Number=0,Type=Flag,Description="Pathogenic">\n' + \
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+
+def write_vcf(fname, header, records):
+    with open(fname, 'w') as f:
+        f.write(header)
+        for record in records:
+            f.write('\t'.join(record) + '\n')
+
+
+def write_track(fname, records):
+    write_vcf(fname[:-3], TRACK_HEADER, records)
+    subprocess.check_call(['bgzip', '-f', fname[:-3]])
+    subprocess.check_call(['tabix', '-f', '-p', 'vcf', fname])
+
+
+def read_info_column(vcf_fname):
+    with gzip.open(vcf_fname, 'rt') as f:
+        return [line.rstrip('\n').split('\t')[7] for line in f if not line.startswith('#')]
+
+
+def test_format_mean_uses_double_precision():
+    assert trackanno.format_mean(['0.1', '0.2']) == '0.15000000000000002'
+    assert trackanno.format_mean(['1', '2', '4']) == '2.3333333333333335'
+    assert trackanno.format_mean(['0.3', '.']) == '0.3'
+    assert trackanno.format_mean(['.']) is None
+
+
+def test_select_allele_values_selects_number_a_entries():
+    track = {'tag_numbers': {'AF': 'A', 'SRC': '.', 'PATHO': '0'}}
+    values = {'AF': '0.1,0.2,0.3', 'SRC': 'x,y', 'PATHO': True}
+    assert trackanno.select_allele_values(track, ['C', 'G', 'T'], 'G', values) == {'AF': '0.2', 'SRC': 'x,y', 'PATHO': True}
+    ## Number=A values that do not have one entry per ALT allele are kept as is
+    assert trackanno.select_allele_values(track, ['C', 'G'], 'G', {'AF': '0.1'}) == {'AF': '0.1'}
+
+
+@requires_tabix
+def test_annotate_track_multiallelic_records(tmp_path):
+    track_fname = str(tmp_path / 'track.vcf.gz')
+    write_track(track_fname, [
+        ['1', '100', '.', 'A', 'C,G,T', '.', '.', 'AF=0.1,0.2,0.3;SRC=a,b;PATHO'],
+        ['1', '100', '.', 'A', 'G', '.', '.', 'AF=0.5;SRC=c'],
+        ['1', '200', '.', 'AT', 'A', '.', '.', 'AF=0.01'],
+    ])
+    query_vcf = str(tmp_path / 'query.vcf')
+    write_vcf(query_vcf, '##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n', [
+        ['1', '100', '.', 'A', 'G', '.', '.', '.'],
+        ['1', '100', '.', 'A', 'T', '.', '.', '.'],
+        ['1', '150', '.', 'G', 'A', '.', '.', '.'],
+        ['1', '200', '.', 'AT', 'A', '.', '.', '.'],
+    ])
+    track = {'name': 'test', 'track_fname': track_fname, 'tags': ['AF', 'SRC', 'PATHO'],
+             'tag_types': {'AF': 'Float', 'SRC': 'String', 'PATHO': 'Flag'},
+             'tag_numbers': {'AF': 'A', 'SRC': '.', 'PATHO': '0'}, 'format': 'vcf', 'op': 'concat'}
+    annotation_fname = str(tmp_path / 'annotation.txt')
+    assert trackanno.annotate_track(track, query_vcf, annotation_fname) == 3
+    with open(annotation_fname) as f:
+        assert f.read().split('\n') == ['AF=0.2,0.5;SRC=a,b,c;PATHO', 'AF=0.3;SRC=a,b;PATHO', '', 'AF=0.01', '']
+
+
+@pytest.mark.skipif(TEST_DATA_DIR is None or shutil.which('vcfanno') is None or shutil.which('tabix') is None,
+                    reason='GVANNO_TEST_DATA_DIR, vcfanno or tabix not available')
+@pytest.mark.parametrize('example_vcf', sorted(glob.glob(os.path.join(EXAMPLES_DIR, '*.vcf.gz'))),
+                         ids=os.path.basename)
+def test_annotation_engines_give_identical_info(tmp_path, example_vcf):
+    assembly = example_vcf.split('.')[-3]
+    gvanno_db_dir = os.path.join(TEST_DATA_DIR, 'data', assembly)
+    if not os.path.isdir(gvanno_db_dir):
+        pytest.skip(f'no {assembly} data bundle in {TEST_DATA_DIR}')
+    vcfanno_tracks = {'clinvar': True, 'gwas': True, 'dbnsfp': True, 'ncer': True, 'gene_transcript_xref': True}
+    info_columns = {}
+    for annotation_engine in ['vcfanno', 'native']:
+        query_vcf = str(tmp_path / f'{annotation_engine}.query.vcf.gz')
+        shutil.copy(example_vcf, query_vcf)
+        out_vcf = str(tmp_path / f'{annotation_engine}.vcfanno.vcf')
+        gvanno_vcfanno.annotate_vcf(query_vcf, out_vcf, gvanno_db_dir, vcfanno_tracks, 4, False,
+                                    getlogger('test'), annotation_engine = annotation_engine)
+        info_columns[annotation_engine] = read_info_column(f'{out_vcf}.gz')
+    assert len(info_columns['native']) > 0
+    assert info_columns['native'] == info_columns['vcfanno']
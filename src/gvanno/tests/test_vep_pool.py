@@ -0,0 +1,128 @@
+import stat
+import sys
+
+import pytest
+
+from lib.gvanno import vep_pool
+from lib.gvanno.utils import getlogger
+
+## stub VEP: reads its input one line ahead in blocks of --buffer_size records, block-buffers stdout (pipe), annotates
+## records with CSQ, skips records with a '*' ALT allele, and exits with an error at record --crash_at if the file
+## --crash_once exists (the file is removed, i.e. the stub crashes once)
+STUB_VEP = r'''
+import os
+import sys
+
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+buffer_size = int(args['--buffer_size'])
+crash_at = int(args.get('--crash_at', 0))
+crash_once = args.get('--crash_once')
+
+def annotate(block):
+    for line in block:
+        fields = line.rstrip('\n').split('\t')
+        if fields[4] == '*':
+            continue
+        fields[7] = f'{fields[7]};CSQ={fields[2]}' if fields[7] != '.' else f'CSQ={fields[2]}'
+        sys.stdout.write('\t'.join(fields) + '\n')
+
+block = []
+num_records = 0
+line = sys.stdin.readline()
+while line.startswith('#'):
+    if line.startswith('#CHROM'):
+        sys.stdout.write('##INFO=<ID=CSQ,Number=.,Type=String,Description="stub">\n')
+    sys.stdout.write(line)
+    line = sys.stdin.readline()
+while line != '':
+    num_records += 1
+    if num_records == crash_at and crash_once and os.path.exists(crash_once):
+        os.remove(crash_once)
+        sys.exit(3)
+    block.append(line)
+    line = sys.stdin.readline()
+    if len(block) == buffer_size and line != '':
+        annotate(block)
+        block = []
+annotate(block)
+'''
+
+
+def write_input_vcf(fname, num_records, skipped = ()):
+    with open(fname, 'w') as f:
+        f.write('##fileformat=VCFv4.2\n')
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for i in range(num_records):
+            alt = '*' if i in skipped else 'T'
+            f.write(f'1\t{1000 + i * 10}\tv{i}\tA\t{alt}\t.\tPASS\t.\n')
+
+
+def read_records(fname):
+    with open(fname) as f:
+        return [line.rstrip('\n').split('\t') for line in f if not line.startswith('#')]
+
+
+@pytest.fixture
+def stub_vep(tmp_path):
+    stub_fname = tmp_path / 'stub_vep.py'
+    stub_fname.write_text(STUB_VEP)
+    stub_fname.chmod(stub_fname.stat().st_mode | stat.S_IXUSR)
+    yield lambda options: f'{sys.executable} {stub_fname} {options}'
+    vep_pool.shutdown_vep_pools()
+
+
+@pytest.mark.parametrize('num_records,buffer_size,n_workers', [(25, 10, 2), (7, 10, 3), (30, 4, 3), (1, 1, 1)])
+def test_vep_pool_reassembles_partial_batches(tmp_path, stub_vep, num_records, buffer_size, n_workers):
+    input_vcf = str(tmp_path / 'input.vcf')
+    output_vcf = str(tmp_path / 'output.vcf')
+    write_input_vcf(input_vcf, num_records)
+    vep_command = stub_vep(f'--buffer_size {buffer_size}')
+    assert vep_pool.run_vep_pool(vep_command, n_workers, input_vcf, output_vcf, buffer_size, getlogger('test')) == num_records
+    records = read_records(output_vcf)
+    assert [r[2] for r in records] == [f'v{i}' for i in range(num_records)]
+    assert all(r[7] == f'CSQ={r[2]}' for r in records)
+    with open(output_vcf) as f:
+        assert sum(1 for line in f if line.startswith('##INFO=<ID=CSQ')) == 1
+
+
+def test_vep_pool_skips_records_without_vep_output(tmp_path, stub_vep):
+    input_vcf = str(tmp_path / 'input.vcf')
+    output_vcf = str(tmp_path / 'output.vcf')
+    write_input_vcf(input_vcf, 23, skipped = (0, 9, 10, 22))
+    vep_command = stub_vep('--buffer_size 5')
+    assert vep_pool.run_vep_pool(vep_command, 2, input_vcf, output_vcf, 5, getlogger('test')) == 19
+    assert [r[2] for r in read_records(output_vcf)] == [f'v{i}' for i in range(23) if not i in (0, 9, 10, 22)]
+
+
+def test_vep_pool_restarts_crashed_worker(tmp_path, stub_vep):
+    input_vcf = str(tmp_path / 'input.vcf')
+    output_vcf = str(tmp_path / 'output.vcf')
+    crash_once = tmp_path / 'crash_once'
+    crash_once.write_text('')
+    write_input_vcf(input_vcf, 37)
+    vep_command = stub_vep(f'--buffer_size 4 --crash_at 6 --crash_once {crash_once}')
+    assert vep_pool.run_vep_pool(vep_command, 2, input_vcf, output_vcf, 4, getlogger('test')) == 37
+    assert not crash_once.exists()
+    assert [r[2] for r in read_records(output_vcf)] == [f'v{i}' for i in range(37)]
+
+
+def test_vep_pool_reuses_pool_across_runs(tmp_path, stub_vep):
+    vep_command = stub_vep('--buffer_size 3')
+    for run in range(2):
+        input_vcf = str(tmp_path / f'input{run}.vcf')
+        output_vcf = str(tmp_path / f'output{run}.vcf')
+        write_input_vcf(input_vcf, 8 + run)
+        assert vep_pool.run_vep_pool(vep_command, 2, input_vcf, output_vcf, 3, getlogger('test')) == 8 + run
+        assert [r[2] for r in read_records(output_vcf)] == [f'v{i}' for i in range(8 + run)]
+    assert len(vep_pool.vep_pools[vep_command]['workers']) == 2
+    assert all(worker['proc'].poll() is None for worker in vep_pool.vep_pools[vep_command]['workers'])
+
+
+def test_vep_pool_fails_on_persistent_crash(tmp_path, stub_vep):
+    input_vcf = str(tmp_path / 'input.vcf')
+    output_vcf = str(tmp_path / 'output.vcf')
+    write_input_vcf(input_vcf, 12)
+    vep_command = f'{sys.executable} -c "import sys; sys.exit(2)"'
+    with pytest.raises(SystemExit):
+        vep_pool.run_vep_pool(vep_command, 2, input_vcf, output_vcf, 4, getlogger('test'))
+    vep_pool.shutdown_vep_pools()